@@ -1,29 +1,54 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, g, request, jsonify, send_file
 from flask_cors import CORS
+import io
 import os
+import threading
+import time
 import uuid
-from music21 import clef, note, stream, interval, meter
-from PIL import Image
-from music21 import environment
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import logging
-
-# Disable automatic rendering by clearing MuseScore paths
-environment.set('musicxmlPath', '')
-environment.set('musescoreDirectPNGPath', '')
-
-# Set up logging to track issues
-logging.basicConfig(level=logging.INFO)
+import metrics
+from image_features import extract_features
+from image_sampling import grid_for_length, sample_pixels, sample_pixels_and_colour
+from keys import DEFAULT_KEY, get_key, key_for_colour
+from note_serialization import NOTE_FORMATS, FastJSONProvider, format_note_data
+from rules import RULESETS, compile_ruleset
+from song_cache import SongCache, cache_key
+from song_index import SongIndex
+from upload_validation import (
+    HEADER_LIMIT, MAX_IMAGE_PIXELS, REJECTED_UPLOADS, SniffedUpload, UploadRejected, check_image_file, check_upload,
+    sniff_image, upload_rejection,
+)
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Set up logging to track issues; LOG_LEVEL=DEBUG adds per-request pixel and pitch logs
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)  # orjson when installed, Flask's encoder otherwise
 
 # Allow only your Render backend and your S3 frontend URL
-CORS(app, resources={r"/upload": {"origins": [
+CORS(app, resources={r"/upload.*": {"origins": [
     "http://notes-on-photos.s3-website.us-east-2.amazonaws.com",  # Your frontend S3 URL
     "https://notes-on-photos-2.onrender.com"  # Replace with your Render backend URL
 ]}})
 
+# Latency of each generation stage and of whole requests, served on /metrics
+STAGE_SECONDS = metrics.Histogram("song_stage_seconds", "Time spent in each stage of generating a song", ["stage"])
+REQUEST_SECONDS = metrics.Histogram(
+    "http_request_seconds", "Time to build each response (to the first byte for streams)", ["endpoint", "status"]
+)
+
+@app.before_request
+def before_request():
+    g.request_start = time.perf_counter()
+
 @app.after_request
 def after_request(response):
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, request.endpoint or "none", str(response.status_code))
     return response
 
 @app.route('/upload', methods=['OPTIONS'])
@@ -33,8 +58,85 @@ def options_upload():
 # Limit upload size to 10MB
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB limit
 
+# /upload/batch takes whole albums: a larger body limit, a cap on photos and a process pool
+app.config['MAX_BATCH_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512MB limit
+app.config['MAX_BATCH_PHOTOS'] = int(os.environ.get("MAX_BATCH_PHOTOS", 500))
+app.config['BATCH_WORKERS'] = int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1))
+
+# Photos with more pixels than this are refused from their header (upload_validation.py)
+app.config['MAX_IMAGE_PIXELS'] = int(os.environ.get("MAX_IMAGE_PIXELS", MAX_IMAGE_PIXELS))
+
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'upload_batch':
+            return app.config['MAX_BATCH_CONTENT_LENGTH']
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Check each photo's image header as it arrives; a bad one stops the body being read any further
+        stream = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if filename and filename.lower().endswith('.zip'):
+            return stream
+        return SniffedUpload(stream, max_pixels=app.config['MAX_IMAGE_PIXELS'], abort=self.endpoint != 'upload_batch')
+
+app.request_class = UploadRequest
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return jsonify({"error": e.description}), e.code
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    REJECTED_UPLOADS.inc("body_too_large")
+    return jsonify({"error": "Upload too large"}), 413
+
+# Decode uploads straight from the request stream; set IN_MEMORY_UPLOADS=0 to save them to UPLOAD_FOLDER first
+app.config['IN_MEMORY_UPLOADS'] = os.environ.get("IN_MEMORY_UPLOADS", "1") != "0"
+
+# Sample photos with JPEG draft decoding + reduce; set FAST_IMAGE_SAMPLING=0 for the full-decode path
+app.config['FAST_IMAGE_SAMPLING'] = os.environ.get("FAST_IMAGE_SAMPLING", "1") != "0"
+
+# Choose the top line from features of the whole photo (image_features.py); set FEATURE_SONGS=0 to
+# read one grid pixel per note as before, which gives the same songs the old sampling did
+app.config['FEATURE_SONGS'] = os.environ.get("FEATURE_SONGS", "1") != "0"
+
 UPLOAD_FOLDER = "uploads"
 SONG_FOLDER = "songs"
+NOTE_DURATION = 4.0  # Every note is a whole note (quarterLength=4)
+SONG_LENGTH = 10  # Notes per line unless a request asks for another length
+
+# Key for requests that do not name one: a name such as "D dorian", or "auto" to pick it from the photo
+app.config['DEFAULT_KEY'] = os.environ.get("DEFAULT_KEY", DEFAULT_KEY.name)
+
+# Bottom-line ruleset from rules.py, used when a request does not name one
+app.config['DEFAULT_RULESET'] = os.environ.get("DEFAULT_RULESET", "app")
+
+# Bottom-line search: 0 keeps the greedy scan, N > 0 runs a beam search keeping N partial lines
+app.config['BEAM_WIDTH'] = int(os.environ.get("BEAM_WIDTH", 0))
+app.config['MAX_BEAM_WIDTH'] = 64
+
+# Longest song a request may ask for; the sampling grid grows with the length (100 notes -> 10x10)
+app.config['MAX_SONG_LENGTH'] = int(os.environ.get("MAX_SONG_LENGTH", 10000))
+
+# Largest length * beamWidth a request may ask for. Beam search costs about 55 us per note per beam
+# (length 1000 at width 64 takes 3.6 s), so this keeps one song well under a second
+app.config['MAX_BEAM_NOTES'] = int(os.environ.get("MAX_BEAM_NOTES", 10000))
+
+# Bump whenever compose_song's output changes so cached songs are not reused
+GENERATOR_VERSION = "app-1"
+
+# In-process LRU of generated songs, bounded by entries and by notes held (about 200 bytes each);
+# set SONG_CACHE_DB to a SQLite file to share hits between workers (its newest SONG_CACHE_DB_ROWS songs)
+song_cache = SongCache(
+    max_entries=int(os.environ.get("SONG_CACHE_SIZE", 1024)),
+    max_notes=int(os.environ.get("SONG_CACHE_NOTES", 200000)),
+    db_path=os.environ.get("SONG_CACHE_DB") or None,
+    db_max_rows=int(os.environ.get("SONG_CACHE_DB_ROWS", 100000)),
+)
+# Bottom lines for every top line of the default options, built by `python song_index.py build`.
+# It is memory-mapped, and ignored (songs are generated live) if missing or built for other rules.
+song_index = SongIndex.load(os.environ.get("SONG_INDEX", "song_index.bin"), GENERATOR_VERSION)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SONG_FOLDER, exist_ok=True)
 
@@ -49,184 +151,368 @@ def upload_photo():
     photo = request.files['photo']
     if photo.filename == '':
         return jsonify({"error": "No file selected"}), 400
-
-    filename = str(uuid.uuid4()) + os.path.splitext(photo.filename)[1]
-    photo_path = os.path.join(UPLOAD_FOLDER, filename)
-    photo.save(photo_path)
-
-    note_data = generate_song(photo_path)
-    os.remove(photo_path)  # Clean up uploaded photo after processing
+    check_upload(photo)
+
+    options, error = generation_options(request.form)
+    if error:
+        return jsonify({"error": error}), 400
+    note_format, error = response_format(request.form)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if app.config['IN_MEMORY_UPLOADS']:
+        # Werkzeug already spools the upload into memory (or a temp file for large bodies)
+        note_data = generate_song(photo.stream, fast_sampling=app.config['FAST_IMAGE_SAMPLING'],
+                                  features=app.config['FEATURE_SONGS'], **options)
+    else:
+        filename = str(uuid.uuid4()) + os.path.splitext(photo.filename)[1]
+        photo_path = os.path.join(UPLOAD_FOLDER, filename)
+        with STAGE_SECONDS.time("save"):
+            photo.save(photo_path)
+
+        note_data = generate_song(photo_path, fast_sampling=app.config['FAST_IMAGE_SAMPLING'],
+                                  features=app.config['FEATURE_SONGS'], **options)
+        with STAGE_SECONDS.time("cleanup"):
+            os.remove(photo_path)  # Clean up uploaded photo after processing
     if not note_data:
         return jsonify({"error": "Error generating song"}), 500
 
 
+    with STAGE_SECONDS.time("serialize"):
+        return jsonify({
+            "noteData": format_note_data(note_data, note_format, NOTE_DURATION)
+        })
+
+@app.route('/upload/batch', methods=['POST', 'OPTIONS'])
+def upload_batch():
+    if request.method == 'OPTIONS':
+        return '', 200  # Handle CORS pre-flight request
+
+    photos = [photo for photo in request.files.getlist('photo') if photo.filename != '']
+    if not photos:
+        return jsonify({"error": "No photo uploaded"}), 400
+    if len(photos) > app.config['MAX_BATCH_PHOTOS']:
+        return jsonify({"error": f"At most {app.config['MAX_BATCH_PHOTOS']} photos per batch"}), 400
+
+    options, error = generation_options(request.form)
+    if error:
+        return jsonify({"error": error}), 400
+    note_format, error = response_format(request.form)
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = []
+    for filename, note_data, error in generate_batch(iter_batch_photos(photos), options):
+        if error:
+            results.append({"filename": filename, "error": error})
+        else:
+            results.append({"filename": filename, "noteData": format_note_data(note_data, note_format, NOTE_DURATION)})
+
     return jsonify({
-        "noteData": note_data
+        "results": results
     })
 
-def generate_song(photo_path):
-    try:
-        if not os.path.exists(photo_path):
-            logging.error("File not found: %s", photo_path)
-            return None
+def generation_options(form):
+    # Return (generate_song keyword arguments, error message) from the optional
+    # 'ruleset', 'beamWidth', 'length' and 'key' fields
+    ruleset = form.get('ruleset', app.config['DEFAULT_RULESET'])
+    if ruleset not in RULESETS:
+        return None, f"Unknown ruleset: {ruleset}"
+
+    # Passed on by name so the options can be sent to the batch worker processes as they are
+    key = form.get('key', app.config['DEFAULT_KEY'])
+    if key != "auto":
+        song_key = get_key(key)
+        if song_key is None:
+            return None, f"Unknown key: {key}"
+        key = song_key.name
 
-        img = Image.open(photo_path).convert("L")
-        img = img.resize((10, 10))
-        pixel_values = list(img.getdata())
-        logging.info("Pixel Values: %s", pixel_values[:10])
-
-        tonic_pitch = 60  # Middle C
-        scale_degrees = [0, 2, 4, 5, 7, 9, 11]  # Major scale intervals (upward)
-        lower_scale_degrees = [-12, -10, -8, -7, -5, -3, -1]  # Descending intervals for downward motion
-
-        score = stream.Score()
-        top_line = stream.Part()
-        bottom_line = stream.Part()
-        top_line.append(meter.TimeSignature("4/4"))
-        bottom_line.append(meter.TimeSignature("4/4"))
-
-        # Generate the top line
-        previous_pitch = None
-        for i in range(10):
-            if i == 0:
-                pitch = tonic_pitch
-            elif i == 9:
-                pitch = tonic_pitch  # End with tonic
-            else:
-                valid_pitches = [tonic_pitch + degree for degree in scale_degrees]
-                pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
-
-            top_line.append(note.Note(pitch, quarterLength=4))
-            previous_pitch = pitch
-
-        logging.info("Top Line Pitches: %s", [n.pitch.midi for n in top_line.notes])
-
-        # Generate the bottom line
-        previous_cf_pitch = None
-        bottom_pitch_counts = {}  # Track how many times each note is used
-        last_bottom_notes = []    # Track the last few notes to prevent consecutive repetition
-        consecutive_repeated_notes = []  # Track notes that were repeated consecutively
-        max_consecutive_repeats = 2
-        max_note_usage = 3
-        last_leap_direction = None  # Track the direction of the last leap
-
-        for i, top_note in enumerate(top_line.notes):
-            top_pitch = top_note.pitch.midi
-
-            # Rules for the first and last note
-            if i == 0 or i == 9:
-                cf_pitch = tonic_pitch
-                if i == 9:
-                    cf_pitch = tonic_pitch - 12  # Favor ending on the lower tonic (octave below)
+    try:
+        beam_width = int(form.get('beamWidth', app.config['BEAM_WIDTH']))
+        length = int(form.get('length', SONG_LENGTH))
+    except ValueError:
+        return None, "beamWidth and length must be integers"
+    if not 0 <= beam_width <= app.config['MAX_BEAM_WIDTH']:
+        return None, f"beamWidth must be between 0 and {app.config['MAX_BEAM_WIDTH']}"
+    if not 4 <= length <= app.config['MAX_SONG_LENGTH']:
+        return None, f"length must be between 4 and {app.config['MAX_SONG_LENGTH']}"
+    if length * beam_width > app.config['MAX_BEAM_NOTES']:
+        return None, f"length * beamWidth must be at most {app.config['MAX_BEAM_NOTES']}"
+    return {"ruleset": ruleset, "beam_width": beam_width, "length": length, "key": key}, None
+
+def response_format(form):
+    # Return (noteData format, error message) from the optional 'format' field
+    note_format = form.get('format', 'rows')
+    if note_format not in NOTE_FORMATS:
+        return None, f"Unknown format: {note_format}"
+    return note_format, None
+
+def iter_batch_photos(photos):
+    # Yield (filename, image bytes, error) in upload order, expanding zip archives in archive order
+    count = 0
+    for photo in photos:
+        if not photo.filename.lower().endswith('.zip'):
+            count += 1
+            rejection = upload_rejection(photo)
+            if count > app.config['MAX_BATCH_PHOTOS']:
+                yield photo.filename, None, "Batch photo limit reached"
+            elif rejection:
+                yield photo.filename, None, rejection
             else:
-                valid_cf_pitches = []
-                for degree in scale_degrees + lower_scale_degrees:  # Include descending intervals
-                    candidate_pitch = tonic_pitch + degree
-
-                    # Prevent voice crossing
-                    if candidate_pitch >= top_pitch:
-                        continue
-
-                    # Prevent going below B1 (MIDI 35)
-                    if candidate_pitch < 35:
-                        continue
-
-                    # Prevent notes that were repeated consecutively earlier
-                    if candidate_pitch in consecutive_repeated_notes:
-                        continue
-
-                    # Enforce no more than 2 consecutive repetitions
-                    if len(last_bottom_notes) >= max_consecutive_repeats and all(
-                        note == candidate_pitch for note in last_bottom_notes[-max_consecutive_repeats:]
-                    ):
-                        # Add to repeated notes list if it's repeated consecutively
-                        consecutive_repeated_notes.append(candidate_pitch)
-                        continue
-
-                    # Enforce no more than 1 note played 3 times in the entire bottom line
-                    if bottom_pitch_counts.get(candidate_pitch, 0) >= max_note_usage:
-                        continue
-
-                    # Enforce leaps no larger than a 6th
-                    if previous_cf_pitch and abs(candidate_pitch - previous_cf_pitch) > 9:  # 9 semitones = M6
-                        continue
-
-                    # Ensure second note is stepwise or the same as the first note
-                    if i == 1 and previous_cf_pitch and abs(candidate_pitch - previous_cf_pitch) > 2:
-                        continue
-
-                    # Ensure second-to-last note is stepwise or the same as the last note
-                    if i == 8 and abs(candidate_pitch - top_line.notes[9].pitch.midi) > 2:
-                        continue
-
-                    # Calculate consonance with the top pitch
-                    interval_obj = interval.Interval(note.Note(candidate_pitch), note.Note(top_pitch))
-                    interval_name = interval_obj.name
-                    if interval_name not in ["P1", "m3", "M3", "P5", "m6", "M6", "P8"]:
-                        continue  # Skip dissonant intervals (e.g., P4)
-
-                    # Favor stepwise downward motion
-                    stepwise_bonus = -10 if previous_cf_pitch and candidate_pitch == previous_cf_pitch - 1 else 0
-
-                    # Penalize same note for second and second-to-last positions
-                    if (i == 1 or i == 8) and candidate_pitch == previous_cf_pitch:
-                        stepwise_bonus += 5  # Slight penalty for the same pitch
-
-                    # Handle leaps (interval > 2 semitones)
-                    if previous_cf_pitch and abs(candidate_pitch - previous_cf_pitch) > 2:
-                        leap_direction = "up" if candidate_pitch > previous_cf_pitch else "down"
-                        if last_leap_direction and leap_direction == last_leap_direction:
-                            continue  # Skip if the leap doesn't resolve in the opposite direction
-                        last_leap_direction = leap_direction
-                        stepwise_bonus += 5  # Penalize leaps slightly to favor stepwise motion
-
-                    # Scoring system to prioritize valid pitches
-                    valid_cf_pitches.append((candidate_pitch, stepwise_bonus))
-
-                # Choose the best candidate pitch based on scoring
-                if valid_cf_pitches:
-                    cf_pitch = min(valid_cf_pitches, key=lambda x: x[1])[0]
+                yield photo.filename, photo.read(), None
+            continue
+
+        try:
+            archive = zipfile.ZipFile(photo.stream)
+        except zipfile.BadZipFile:
+            yield photo.filename, None, "Invalid zip archive"
+            continue
+
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                count += 1
+                if count > app.config['MAX_BATCH_PHOTOS']:
+                    yield info.filename, None, "Batch photo limit reached"
+                elif info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                    REJECTED_UPLOADS.inc("body_too_large")
+                    yield info.filename, None, "Photo too large"
                 else:
-                    cf_pitch = tonic_pitch  # Fallback to tonic if no valid pitch is found
-
-            # Add the selected pitch to the bottom line
-            bottom_line.append(note.Note(cf_pitch, quarterLength=4))
-
-            # Update tracking variables
-            bottom_pitch_counts[cf_pitch] = bottom_pitch_counts.get(cf_pitch, 0) + 1
-            last_bottom_notes.append(cf_pitch)
-            if len(last_bottom_notes) > max_consecutive_repeats:
-                last_bottom_notes.pop(0)
-
-            previous_cf_pitch = cf_pitch
-
-        logging.info("Bottom Line Pitches: %s", [n.pitch.midi for n in bottom_line.notes])
-
-        # Combine the parts into the score
-        score.append(top_line)
-        score.append(bottom_line)
-
-        # Prepare note data for JSON response
-        note_data = {"topLine": [], "bottomLine": []}
-        for tn, bn in zip(top_line.notes, bottom_line.notes):
-            note_data["topLine"].append({
-                "pitch": tn.pitch.midi,
-                "note": tn.nameWithOctave,
-                "duration": tn.quarterLength
-            })
-            note_data["bottomLine"].append({
-                "pitch": bn.pitch.midi,
-                "note": bn.nameWithOctave,
-                "duration": bn.quarterLength,
-                "interval": interval.Interval(note.Note(bn.pitch.midi), note.Note(tn.pitch.midi)).name
-            })
+                    data, error = read_archive_photo(archive, info)
+                    yield info.filename, data, error
+
+def read_archive_photo(archive, info):
+    # Return (image bytes, error); only the header is inflated before the photo is checked,
+    # so junk in an archive is refused cheaply
+    with archive.open(info) as member:
+        header = member.read(HEADER_LIMIT)
+        try:
+            image = sniff_image(header, final=len(header) < HEADER_LIMIT, max_pixels=app.config['MAX_IMAGE_PIXELS'])
+            data = header + member.read()
+            if image[1] is None:
+                check_image_file(io.BytesIO(data), app.config['MAX_IMAGE_PIXELS'])
+        except UploadRejected as e:
+            return None, e.description
+        return data, None
+
+batch_executor = None
+batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    # Created lazily so each gunicorn worker forks its own pool after it has booted; the lock keeps
+    # concurrent batches (threaded servers such as asgi.py) from each starting one
+    global batch_executor
+    with batch_executor_lock:
+        if batch_executor is None:
+            batch_executor = ProcessPoolExecutor(max_workers=app.config['BATCH_WORKERS'])
+        return batch_executor
+
+def generate_batch_item(data, fast_sampling, features, options):
+    # Runs in a pool process: its stage timings and cache lookups go back with the song, so the
+    # worker that serves /metrics and /cache/stats can count them
+    before = song_cache.counts()
+    with metrics.recording() as observations:
+        note_data = generate_song(io.BytesIO(data), fast_sampling=fast_sampling, features=features, **options)
+    cache_counts = [after - start for after, start in zip(song_cache.counts(), before)]
+    return note_data, observations, cache_counts
+
+def generate_batch(items, options=None):
+    # Keep a bounded number of photos in flight so a large album is never fully held in memory
+    executor = get_batch_executor()
+    window = 2 * app.config['BATCH_WORKERS']
+    pending = deque()
+
+    def finish(filename, future, error):
+        if error:
+            return filename, None, error
+        note_data, observations, cache_counts = future.result()
+        metrics.replay(observations)
+        song_cache.add_counts(*cache_counts)
+        if not note_data:
+            return filename, None, "Error generating song"
+        return filename, note_data, None
+
+    for filename, data, error in items:
+        future = None if error else executor.submit(generate_batch_item, data, app.config['FAST_IMAGE_SAMPLING'],
+                                                app.config['FEATURE_SONGS'], options or {})
+        pending.append((filename, future, error))
+        if len(pending) >= window:
+            yield finish(*pending.popleft())
+
+    while pending:
+        yield finish(*pending.popleft())
+
+@app.route('/upload/stream', methods=['POST', 'OPTIONS'])
+def upload_stream():
+    if request.method == 'OPTIONS':
+        return '', 200  # Handle CORS pre-flight request
+
+    if 'photo' not in request.files:
+        return jsonify({"error": "No photo uploaded"}), 400
+
+    photo = request.files['photo']
+    if photo.filename == '':
+        return jsonify({"error": "No file selected"}), 400
+    check_upload(photo)
+
+    options, error = generation_options(request.form)
+    if error:
+        return jsonify({"error": error}), 400
 
+    # Decode before the response starts, so a bad photo still gets a plain error status
+    try:
+        with STAGE_SECONDS.time("decode"):
+            pixel_values, song_key = sample_song_pixels(
+                photo.stream, options['length'], options['key'], fast=app.config['FAST_IMAGE_SAMPLING'],
+                features=app.config['FEATURE_SONGS'],
+            )
+    except Exception as e:
+        logging.error("Error generating song: %s", str(e))
+        return jsonify({"error": "Error generating song"}), 500
+
+    # One JSON object per line: a header with the length, then each note pair as it is chosen.
+    # Nothing is cached or collected, so memory stays flat however long the song is.
+    def stream_notes():
+        yield app.json.dumps({"length": options['length'], "duration": NOTE_DURATION, "key": song_key.name}) + "\n"
+        try:
+            for index, (top_note, bottom_note) in enumerate(iter_song(pixel_values, **dict(options, key=song_key))):
+                yield app.json.dumps({"index": index, "top": top_note, "bottom": bottom_note}) + "\n"
+        except Exception as e:
+            logging.error("Error generating song: %s", str(e))
+            yield app.json.dumps({"error": "Error generating song"}) + "\n"
+
+    return Response(stream_notes(), mimetype='application/x-ndjson')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(song_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    stats = song_cache.stats()
+    cache_lines = (
+        metrics.sample_lines("song_cache_hits_total", "Songs served from this worker's cache", stats["hits"], "counter")
+        + metrics.sample_lines("song_cache_shared_hits_total", "Songs served from the shared cache", stats["sharedHits"], "counter")
+        + metrics.sample_lines("song_cache_misses_total", "Songs that had to be composed", stats["misses"], "counter")
+        + metrics.sample_lines("song_cache_entries", "Songs in this worker's cache", stats["entries"])
+        + metrics.sample_lines("song_cache_notes", "Notes held in this worker's cache", stats["notes"])
+    )
+    return Response(metrics.render(cache_lines), content_type=metrics.CONTENT_TYPE)
+
+def generate_song(photo, fast_sampling=True, use_cache=True, ruleset="app", beam_width=0, length=SONG_LENGTH,
+                  key=DEFAULT_KEY.name, features=True):
+    try:
+        if isinstance(photo, (str, os.PathLike)) and not os.path.exists(photo):
+            logging.error("File not found: %s", photo)
+            return None
+
+        with STAGE_SECONDS.time("decode"):
+            pixel_values, song_key = sample_song_pixels(photo, length, key, fast=fast_sampling, features=features)
+        logging.debug("Pixel Values: %s", pixel_values[:10])
+
+        # A song the index covers is one table lookup, cheaper than hashing it for the cache
+        if not use_cache or (song_index is not None and song_index.covers(ruleset, beam_width, length, song_key)):
+            return compose_song(pixel_values, ruleset, beam_width, length, song_key)
+
+        # The song depends only on the pixel grid (or note values) and the generation options, so identical
+        # inputs share one result
+        sampling = "features" if features else "pixels"
+        with STAGE_SECONDS.time("cache"):
+            entry = cache_key(pixel_values, f"{GENERATOR_VERSION}:{sampling}:{ruleset}:{beam_width}:{length}:{song_key.name}")
+            note_data = song_cache.get(entry)
+        if note_data is None:
+            note_data = compose_song(pixel_values, ruleset, beam_width, length, song_key)
+            song_cache.put(entry, note_data)
         return note_data
 
     except Exception as e:
         logging.error("Error generating song: %s", str(e))
         return None
 
+def sample_song_pixels(photo, length, key=DEFAULT_KEY.name, fast=True, features=True):
+    # Return (pixel values, Key) for a song; key "auto" picks the key from the photo's average colour.
+    # With features, the values are one per top-line note from image_features instead of the grid pixels.
+    if features:
+        image = extract_features(photo, length, fast=fast, colour=key == "auto")
+        song_key = key_for_colour(image.colour) if key == "auto" else get_key(key)
+        # Reversed, since the top line pops from the end: the first note reads the top-left of the photo
+        return image.note_values(length - 2)[::-1], song_key
+
+    size = grid_for_length(length)
+    if key == "auto":
+        pixel_values, colour = sample_pixels_and_colour(photo, size=size, fast=fast)
+        return pixel_values, key_for_colour(colour)
+    return sample_pixels(photo, size=size, fast=fast), get_key(key)
+
+def compose_song(pixel_values, ruleset="app", beam_width=0, length=SONG_LENGTH, key=DEFAULT_KEY):
+    with STAGE_SECONDS.time("top_line"):
+        top_line = compose_top_line(pixel_values, length, key)
+
+    # Prepare note data for JSON response
+    note_data = {"key": key.name, "topLine": [], "bottomLine": []}
+    with STAGE_SECONDS.time("bottom_line"):
+        for top_note, bottom_note in iter_notes(top_line, ruleset, beam_width, key):
+            note_data["topLine"].append(top_note)
+            note_data["bottomLine"].append(bottom_note)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Bottom Line Pitches: %s", [note["pitch"] for note in note_data["bottomLine"][:20]])
+    return note_data
+
+def iter_song(pixel_values, ruleset="app", beam_width=0, length=SONG_LENGTH, key=DEFAULT_KEY):
+    # Yield (top note, bottom note) pairs as the bottom line is chosen; the greedy scan never
+    # looks ahead, so the first pairs are ready before the rest of the line is worked out
+    return iter_notes(compose_top_line(pixel_values, length, key), ruleset, beam_width, key)
+
+def compose_top_line(pixel_values, length=SONG_LENGTH, key=DEFAULT_KEY):
+    pixel_values = list(pixel_values)  # The top line consumes values with pop()
+
+    tonic_pitch = key.tonic_pitch
+
+    # Lines are kept as plain MIDI numbers; names and intervals come from the key's tables
+    top_line = []
+
+    # Generate the top line
+    previous_pitch = None
+    valid_pitches = key.top_candidates  # The key's scale from the tonic up
+    for i in range(length):
+        if i == 0:
+            pitch = tonic_pitch
+        elif i == length - 1:
+            pitch = tonic_pitch  # End with tonic
+        else:
+            pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
+
+        top_line.append(pitch)
+        previous_pitch = pitch
+
+    logging.debug("Top Line Pitches: %s", top_line[:20])
+    return top_line
+
+def iter_notes(top_line, ruleset="app", beam_width=0, key=DEFAULT_KEY):
+    # Look the bottom line up in the song index when it covers these options; otherwise generate
+    # it with the compiled rules (voice leading, consonance, leap recovery)
+    bottom_line = song_index.bottom_line(top_line, ruleset, beam_width, key) if song_index else None
+    if bottom_line is None:
+        rules = compile_ruleset(ruleset, key)
+        if beam_width:
+            bottom_line = rules.search_line(top_line, beam_width=beam_width)
+        else:
+            bottom_line = rules.iter_bottom_line(top_line)
+
+    for tp, bp in zip(top_line, bottom_line):
+        yield {
+            "pitch": tp,
+            "note": key.note_name(tp),
+            "duration": NOTE_DURATION
+        }, {
+            "pitch": bp,
+            "note": key.note_name(bp),
+            "duration": NOTE_DURATION,
+            "interval": key.interval_name(bp, tp)
+        }
+
 if __name__ == '__main__':
     # Let Render handle the port binding
     port = int(os.environ.get("PORT", 5002))  # Fallback to 5002 if no port is set
@@ -1,11 +1,11 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
 import uuid
-from music21 import clef, note, stream, interval, meter
 from PIL import Image
-from music21 import environment
-environment.set('musescoreDirectPNGPath', '/Applications/MuseScore 4.app/Contents/MacOS/mscore')
+from keys import DEFAULT_KEY, get_key
+from artifact_store import ArtifactStore
+from render_jobs import RESPONSE_MODES, RenderQueue, artifact_response, lines_spec, render_score
 
 app = Flask(__name__)
 CORS(app)
@@ -26,6 +26,21 @@ SONG_FOLDER = "songs"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SONG_FOLDER, exist_ok=True)
 
+# Rendered files are stored once per distinct song and evicted by age and total size
+song_store = ArtifactStore(
+    SONG_FOLDER,
+    max_bytes=int(os.environ.get("SONG_STORE_MAX_MB", 1024)) * 1024 * 1024,
+    ttl=int(os.environ.get("SONG_STORE_TTL", 7 * 24 * 3600)),
+)
+
+# Set RENDER_JOBS=1 to return a job id from /upload and render files in the background
+app.config['RENDER_JOBS'] = os.environ.get("RENDER_JOBS", "0") == "1"
+render_queue = RenderQueue(
+    os.environ.get("RENDER_JOBS_DB", "render_jobs.db"),
+    song_store,
+    max_workers=int(os.environ.get("RENDER_WORKERS", 2)),
+)
+
 @app.route('/upload', methods=['POST'])
 def upload_photo():
     if 'photo' not in request.files:
@@ -35,169 +50,230 @@ def upload_photo():
     if photo.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
+    key = get_key(request.form.get('key', DEFAULT_KEY.name))
+    if key is None:
+        return jsonify({"error": f"Unknown key: {request.form.get('key')}"}), 400
+
+    response_mode = request.form.get('response', 'url')
+    if response_mode not in RESPONSE_MODES:
+        return jsonify({"error": f"Unknown response mode: {response_mode}"}), 400
+
+    if response_mode != 'url':
+        # Compose straight from the upload stream; the MIDI file never touches uploads/ or songs/
+        try:
+            composed = compose_score(photo.stream, key)
+            if composed is None:
+                return jsonify({"error": "Error generating song"}), 500
+            spec, note_data = composed
+            return artifact_response(spec, response_mode, note_data, sheet=request.form.get('sheet') == '1')
+        except Exception as e:
+            print(f"🔴 Error generating song: {str(e)}")
+            return jsonify({"error": "Error generating song"}), 500
+
     filename = str(uuid.uuid4()) + os.path.splitext(photo.filename)[1]
     photo_path = os.path.join(UPLOAD_FOLDER, filename)
     photo.save(photo_path)
 
-    song_path, sheet_path, note_data = generate_song(photo_path)
-    if not song_path:
+    if app.config['RENDER_JOBS']:
+        job_id, note_data = queue_song(photo_path, key)
+        if not job_id:
+            return jsonify({"error": "Error generating song"}), 500
+
+        return jsonify({
+            "jobId": job_id,
+            "statusUrl": f"http://127.0.0.1:5000/jobs/{job_id}",
+            "noteData": note_data
+        }), 202
+
+    song_filename, sheet_filename, note_data = generate_song(photo_path, key)
+    if not song_filename:
         return jsonify({"error": "Error generating song"}), 500
 
     return jsonify({
-        "songUrl": f"http://127.0.0.1:5000/songs/{os.path.basename(song_path)}",
-        "sheetMusicUrl": f"http://127.0.0.1:5000/songs/{os.path.basename(sheet_path)}",
+        "songUrl": f"http://127.0.0.1:5000/songs/{song_filename}",
+        "sheetMusicUrl": f"http://127.0.0.1:5000/songs/{sheet_filename}",
         "noteData": note_data
     })
 
-def generate_song(photo_path):
+def generate_song(photo_path, key=DEFAULT_KEY):
     try:
-        if not os.path.exists(photo_path):
-            print("🔴 File not found:", photo_path)
+        composed = compose_score(photo_path, key)
+        if composed is None:
             return None, None, None
+        spec, note_data = composed
 
-        img = Image.open(photo_path).convert("L")
-        img = img.resize((10, 10))
-        pixel_values = list(img.getdata())
-        print("✅ Pixel Values:", pixel_values[:10])
-
-        tonic_pitch = 60
-        scale_degrees = [0, 2, 4, 5, 7, 9, 11]
-        leaps_used = 0
-        highest_note = tonic_pitch + max(scale_degrees)
-        highest_note_placed = False
-
-        score = stream.Score()
-        top_line = stream.Part()
-        bottom_line = stream.Part()
-        top_line.append(meter.TimeSignature("4/4"))
-        bottom_line.append(meter.TimeSignature("4/4"))
-
-        previous_pitch = None
-        previous_cf_pitch = None
-        second_last_pitch = None
-        previous_interval = None
-        last_bottom_notes = []
-        bottom_pitch_counts = {}
-        same_interval_streak = 0
-        max_consecutive_repeats = 2
-        max_note_usage = 3
-
-        for i in range(10):
-            # Generate the top line note
-            if i == 0:
-                pitch = tonic_pitch
-                previous_interval = "P1"
-            elif i == 9:
-                valid_endings = [tonic_pitch, tonic_pitch + 7]
-                pitch = min(valid_endings, key=lambda p: abs(previous_pitch - p))
-            else:
-                valid_pitches = []
-                current_scale_step = scale_degrees.index((previous_pitch - tonic_pitch) % 12)
-
-                for step in [-1, 1, -2, 2]:
-                    next_step = current_scale_step + step
-                    if 0 <= next_step < len(scale_degrees):
-                        candidate_pitch = tonic_pitch + scale_degrees[next_step]
-                        valid_pitches.append(candidate_pitch)
-
-                pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
-            
-            top_line.append(note.Note(pitch, quarterLength=4))
-            previous_pitch = pitch
-
-            # Generate the bottom line note
-            top_pitch = pitch
-            valid_cf_pitches = []
-            for degree in scale_degrees:
-                candidate_pitch = tonic_pitch + degree
-
-                # Enforce lower bound (allow B1 and above)
-                if candidate_pitch < 35:
-                    continue
-
-                # Prevent voice crossing
-                if candidate_pitch >= top_pitch:
-                    continue
-
-                # Prevent more than 2 consecutive repetitions
-                if len(last_bottom_notes) >= max_consecutive_repeats and all(n == candidate_pitch for n in last_bottom_notes[-max_consecutive_repeats:]):
-                    continue
-
-                # Prevent more than 3 total repetitions of the same note
-                if bottom_pitch_counts.get(candidate_pitch, 0) >= max_note_usage:
-                    continue
-
-                # Skip m2 and M2 intervals
-                interval_semitones = abs(candidate_pitch - top_pitch)
-                if interval_semitones in [1, 2]:
-                    continue
-
-                # Allow only consonant intervals
-                if interval_semitones not in [0, 3, 4, 7, 8, 9]:
-                    continue
-
-                # Score valid pitches
-                motion = candidate_pitch - previous_cf_pitch if previous_cf_pitch is not None else None
-                top_motion = top_pitch - top_line.notes[i - 1].pitch.midi if i > 0 else None
-                contrary_motion_bonus = 0
-                if motion is not None and top_motion is not None:
-                    if (motion > 0 and top_motion < 0) or (motion < 0 and top_motion > 0):
-                        contrary_motion_bonus = -5  # Strong bonus for contrary motion
-                    elif motion * top_motion > 0:
-                        contrary_motion_bonus = 2  # Slight penalty for parallel motion
-
-                repetition_factor = bottom_pitch_counts.get(candidate_pitch, 0) / max(1, len(bottom_line.notes))
-                repetition_penalty = repetition_factor * 10
-                score_val = -repetition_penalty + contrary_motion_bonus
-
-                valid_cf_pitches.append((candidate_pitch, score_val))
-
-            # Log options and their scores
-            print(f"🎯 Top Note: {top_pitch}")
-            print(f"✅ Bottom Options: {[(p, s) for p, s in valid_cf_pitches]}")
-            
-            if valid_cf_pitches:
-                cf_pitch = min(valid_cf_pitches, key=lambda x: x[1])[0]
-            else:
-                cf_pitch = tonic_pitch  # Fallback to tonic if no valid pitch is found
-
-            # Add the selected pitch to the bottom line
-            bottom_line.append(note.Note(cf_pitch, quarterLength=4))
-            print(f"🎵 Selected Bottom Note: {cf_pitch}\n")
-
-            # Update tracking variables
-            bottom_pitch_counts[cf_pitch] = bottom_pitch_counts.get(cf_pitch, 0) + 1
-            last_bottom_notes.append(cf_pitch)
-            if len(last_bottom_notes) > max_consecutive_repeats:
-                last_bottom_notes.pop(0)
-            previous_cf_pitch = cf_pitch
-
-        # Combine the parts into the score
-        score.append(top_line)
-        score.append(bottom_line)
-
-        # Save the generated song and sheet music
-        song_filename = str(uuid.uuid4()) + ".mid"
-        sheet_filename = str(uuid.uuid4()) + ".png"
-        song_path = os.path.join("songs", song_filename)
-        sheet_path = os.path.join("songs", sheet_filename)
-        score.write("midi", fp=song_path)
-        score.write("musicxml.png", fp=sheet_path)
-
-        return song_path, sheet_path, {
-            "topLine": [{"pitch": n.pitch.midi, "note": n.nameWithOctave} for n in top_line.notes],
-            "bottomLine": [{"pitch": n.pitch.midi, "note": n.nameWithOctave} for n in bottom_line.notes],
-        }
+        # Save the generated song and sheet music (once per distinct song)
+        song_filename, sheet_filename = render_score(spec, song_store)
+
+        return song_filename, sheet_filename, note_data
 
     except Exception as e:
         print(f"🔴 Error generating first species counterpoint: {str(e)}")
         return None, None, None
 
+def queue_song(photo_path, key=DEFAULT_KEY):
+    # Compose now, render the MIDI and sheet music on the background pool
+    try:
+        composed = compose_score(photo_path, key)
+        if composed is None:
+            return None, None
+        spec, note_data = composed
+        return render_queue.submit(spec), note_data
+
+    except Exception as e:
+        print(f"🔴 Error generating first species counterpoint: {str(e)}")
+        return None, None
+
+def compose_score(photo_path, key=DEFAULT_KEY):
+    # A path, or the upload stream itself in the in-memory response modes
+    if isinstance(photo_path, (str, os.PathLike)) and not os.path.exists(photo_path):
+        print("🔴 File not found:", photo_path)
+        return None
+
+    img = Image.open(photo_path).convert("L")
+    img = img.resize((10, 10))
+    pixel_values = list(img.getdata())
+    print("✅ Pixel Values:", pixel_values[:10])
+
+    tonic_pitch = key.tonic_pitch
+    scale_degrees = key.scale
+    leaps_used = 0
+    highest_note = tonic_pitch + max(scale_degrees)
+    highest_note_placed = False
+
+    # Lines are kept as plain MIDI numbers; music21 is only needed to render the sheet music
+    top_line = []
+    bottom_line = []
+
+    previous_pitch = None
+    previous_cf_pitch = None
+    second_last_pitch = None
+    previous_interval = None
+    last_bottom_notes = []
+    bottom_pitch_counts = {}
+    same_interval_streak = 0
+    max_consecutive_repeats = 2
+    max_note_usage = 3
+
+    for i in range(10):
+        # Generate the top line note
+        if i == 0:
+            pitch = tonic_pitch
+            previous_interval = "P1"
+        elif i == 9:
+            # The tonic or the fifth above it, when the mode has one (locrian does not)
+            valid_endings = [p for p in (tonic_pitch, tonic_pitch + 7) if p - tonic_pitch in scale_degrees]
+            pitch = min(valid_endings, key=lambda p: abs(previous_pitch - p))
+        else:
+            valid_pitches = []
+            current_scale_step = scale_degrees.index((previous_pitch - tonic_pitch) % 12)
+
+            for step in [-1, 1, -2, 2]:
+                next_step = current_scale_step + step
+                if 0 <= next_step < len(scale_degrees):
+                    candidate_pitch = tonic_pitch + scale_degrees[next_step]
+                    valid_pitches.append(candidate_pitch)
+
+            pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
+            
+        top_line.append(pitch)
+        previous_pitch = pitch
+
+        # Generate the bottom line note
+        top_pitch = pitch
+        valid_cf_pitches = []
+        for degree in scale_degrees:
+            candidate_pitch = tonic_pitch + degree
+
+            # Enforce lower bound (allow B1 and above)
+            if candidate_pitch < 35:
+                continue
+
+            # Prevent voice crossing
+            if candidate_pitch >= top_pitch:
+                continue
+
+            # Prevent more than 2 consecutive repetitions
+            if len(last_bottom_notes) >= max_consecutive_repeats and all(n == candidate_pitch for n in last_bottom_notes[-max_consecutive_repeats:]):
+                continue
+
+            # Prevent more than 3 total repetitions of the same note
+            if bottom_pitch_counts.get(candidate_pitch, 0) >= max_note_usage:
+                continue
+
+            # Skip m2 and M2 intervals
+            interval_semitones = abs(candidate_pitch - top_pitch)
+            if interval_semitones in [1, 2]:
+                continue
+
+            # Allow only consonant intervals
+            if interval_semitones not in [0, 3, 4, 7, 8, 9]:
+                continue
+
+            # Score valid pitches
+            motion = candidate_pitch - previous_cf_pitch if previous_cf_pitch is not None else None
+            top_motion = top_pitch - top_line[i - 1] if i > 0 else None
+            contrary_motion_bonus = 0
+            if motion is not None and top_motion is not None:
+                if (motion > 0 and top_motion < 0) or (motion < 0 and top_motion > 0):
+                    contrary_motion_bonus = -5  # Strong bonus for contrary motion
+                elif motion * top_motion > 0:
+                    contrary_motion_bonus = 2  # Slight penalty for parallel motion
+
+            repetition_factor = bottom_pitch_counts.get(candidate_pitch, 0) / max(1, len(bottom_line))
+            repetition_penalty = repetition_factor * 10
+            score_val = -repetition_penalty + contrary_motion_bonus
+
+            valid_cf_pitches.append((candidate_pitch, score_val))
+
+        # Log options and their scores
+        print(f"🎯 Top Note: {top_pitch}")
+        print(f"✅ Bottom Options: {[(p, s) for p, s in valid_cf_pitches]}")
+            
+        if valid_cf_pitches:
+            cf_pitch = min(valid_cf_pitches, key=lambda x: x[1])[0]
+        else:
+            cf_pitch = tonic_pitch  # Fallback to tonic if no valid pitch is found
+
+        # Add the selected pitch to the bottom line
+        bottom_line.append(cf_pitch)
+        print(f"🎵 Selected Bottom Note: {cf_pitch}\n")
+
+        # Update tracking variables
+        bottom_pitch_counts[cf_pitch] = bottom_pitch_counts.get(cf_pitch, 0) + 1
+        last_bottom_notes.append(cf_pitch)
+        if len(last_bottom_notes) > max_consecutive_repeats:
+            last_bottom_notes.pop(0)
+        previous_cf_pitch = cf_pitch
+
+    # Combine the parts into the score
+    spec = lines_spec([top_line, bottom_line], quarter_length=4, time_signature="4/4", key_name=key.name)
+
+    return spec, {
+        "topLine": [{"pitch": p, "note": key.note_name(p)} for p in top_line],
+        "bottomLine": [{"pitch": p, "note": key.note_name(p)} for p in bottom_line],
+    }
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = render_queue.status(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify({
+        "jobId": job_id,
+        "status": job["status"],
+        "songUrl": f"http://127.0.0.1:5000/songs/{job['songFilename']}" if job["songFilename"] else None,
+        "sheetMusicUrl": f"http://127.0.0.1:5000/songs/{job['sheetFilename']}" if job["sheetFilename"] else None,
+        "error": job["error"]
+    })
+
 @app.route('/songs/<filename>', methods=['GET'])
 def get_song(filename):
-    song_path = os.path.join(SONG_FOLDER, filename)
-    if os.path.exists(song_path):
-        return send_file(song_path, as_attachment=True)
+    # Conditional GET: a matching If-None-Match / If-Modified-Since gets a 304
+    response = song_store.send(filename)
+    if response is not None:
+        return response
     return jsonify({"error": "Song not found"}), 404
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+"""
+Content-addressed storage for rendered songs (MIDI files and sheet music PNGs).
+
+Files are named by the SHA-256 of what they were made from, so an identical
+song is written once however many times it is requested, and they are sharded
+into 256 subdirectories by the first two hex digits so no directory grows
+without bound. MIDI files are named by their own bytes. Sheet music is named by
+the score spec it is rendered from, which lets a repeat song skip MuseScore.
+
+A background thread per process deletes files not written for longer than the
+TTL and then the least recently written ones until the store fits its size
+budget. Writing a file that already exists only moves its access time, which
+is what the sweeper goes by; the modification time stays that of the first
+write. Downloads go through send_file with a content-hash ETag and that
+Last-Modified, so a repeat download with If-None-Match / If-Modified-Since
+costs a 304.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from flask import send_file
+
+_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+# Content never changes under a given name, so clients may keep it as long as they like
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def spec_hash(spec):
+    """Hash a score spec independently of dict ordering."""
+    return content_hash(json.dumps(spec, sort_keys=True, separators=(",", ":")).encode())
+
+
+class ArtifactStore:
+    def __init__(self, root, max_bytes=None, ttl=None, sweep_interval=60):
+        # Absolute, because Flask's send_file resolves relative paths against the app, not the working directory
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes  # None = no size budget
+        self.ttl = ttl              # Seconds since last written (or rewritten); None = keep forever
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def path(self, name):
+        """Return the file path for `name`, or None if it is not a stored artifact."""
+        if not _NAME.match(name):
+            return None
+        path = self._path(name)
+        return path if os.path.exists(path) else None
+
+    def _claim(self, name):
+        # An existing artifact only gets its access time refreshed, which keeps it from being evicted;
+        # its mtime is the Last-Modified clients revalidate against, so it is left alone
+        path = self._path(name)
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+            return True
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return False
+
+    def put_bytes(self, data, extension):
+        """Store `data` under its content hash and return the artifact name."""
+        name = f"{content_hash(data)}.{extension}"
+        if not self._claim(name):
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self._path(name)), prefix=".", suffix="." + extension)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(name))
+        self._start_sweeper()
+        return name
+
+    def put_rendered(self, key, extension, render):
+        """
+        Store the output of `render(path)` under the hash `key` and return the artifact name.
+
+        `render` is only called if nothing is stored under `key` yet. It may return the path it
+        actually wrote to (music21 does when it renames its output); otherwise `path` is used.
+        """
+        name = f"{key}.{extension}"
+        if not self._claim(name):
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self._path(name)), prefix=".", suffix="." + extension)
+            os.close(fd)
+            try:
+                written = render(temp_path) or temp_path
+                os.replace(str(written), self._path(name))
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        self._start_sweeper()
+        return name
+
+    def send(self, name, as_attachment=True):
+        """Return a conditional send_file response for `name`, or None if it is not stored."""
+        path = self.path(name)
+        if path is None:
+            return None
+        return send_file(
+            path,
+            as_attachment=as_attachment,
+            etag=name.split(".")[0],
+            last_modified=os.path.getmtime(path),
+            max_age=IMMUTABLE_MAX_AGE,
+            conditional=True,
+        )
+
+    def _start_sweeper(self):
+        # Threads do not survive a fork, so every gunicorn worker starts its own on first write
+        if self.ttl is None and self.max_bytes is None:
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name="artifact-sweeper", daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error("Error sweeping %s: %s", self.root, str(e))
+            time.sleep(self.sweep_interval)
+
+    def sweep(self, now=None):
+        """Delete expired artifacts, then the oldest ones until the store fits its budget; return the count."""
+        now = time.time() if now is None else now
+        entries = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed by another worker's sweep
+                # Last written or rewritten; reads may move atime too on some mounts, which only keeps a file longer
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path, entry.name))
+
+        removed = 0
+        total = sum(size for _, size, _, _ in entries)
+        entries.sort()
+        for used, size, path, name in entries:
+            if name.startswith("."):
+                # A write in progress, or one a crashed worker left behind
+                if now - used < 3600:
+                    continue
+            elif not ((self.ttl is not None and now - used > self.ttl)
+                      or (self.max_bytes is not None and total > self.max_bytes)):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+        return removed
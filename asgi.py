@@ -0,0 +1,279 @@
+"""
+ASGI entry point: the Flask app behind a front that receives request bodies asynchronously.
+
+Under sync gunicorn workers a slow client uploading a 10MB photo holds a whole
+worker until its last byte arrives. Here the event loop reads each body as it
+trickles in, which costs one coroutine per connection, and only a fully
+received request is handed to the Flask app on a thread pool, where
+generate_song runs (/upload/batch still fans out to its process pool).
+Response bodies are pulled from the app on the same pool, so /upload/stream
+still streams.
+
+The Flask app is not changed, so every route answers exactly as it does under
+gunicorn: /upload and friends for app.py, /upload and /songs/<filename> for
+app2.py and the other variants.
+
+    uvicorn asgi:app --port 5002 --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker   (keeps gunicorn.conf.py's preload)
+
+ASGI_APP picks the Flask app ("module:attribute", app:app by default) and
+ASGI_THREADS the size of each worker's thread pool.
+
+Bodies are limited per path with the Flask app's own limits: /upload/batch
+gets MAX_BATCH_CONTENT_LENGTH and everything else MAX_CONTENT_LENGTH. A
+request is answered 413 as soon as its Content-Length or, for chunked or
+misreported bodies, the bytes received so far pass its limit.
+
+For the Flask app in app.py, /upload and /upload/stream photos are sniffed as
+their first chunks arrive (upload_validation.MultipartSniffer), so a
+non-image or a decompression bomb gets its 415/413 before the rest of the
+body is received, just as under gunicorn. Batch uploads are passed through
+whole, since the batch reports a bad photo as that item's error.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.http import parse_options_header
+
+from upload_validation import MultipartSniffer, UploadRejected
+
+# Request bodies beyond this are spooled to a temporary file instead of memory
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+_END = object()
+
+
+def load_app(target):
+    module, _, attribute = target.partition(":")
+    return getattr(importlib.import_module(module), attribute or "app")
+
+
+class AsyncUploadServer:
+    def __init__(self, wsgi_app, threads=None, max_body=None, path_max_body=None, sniff_paths=(), max_pixels=None):
+        self.wsgi_app = wsgi_app
+        self.threads = threads or min(32, (os.cpu_count() or 1) * 4)
+        # Bodies larger than this (or than path_max_body's limit for their path) are refused before
+        # they are spooled; the Flask app still applies its own limits to what it is given
+        self.max_body = max_body
+        self.path_max_body = path_max_body or {}
+        # Paths whose uploaded photos are checked from their first bytes, with this pixel limit
+        self.sniff_paths = frozenset(sniff_paths)
+        self.max_pixels = max_pixels
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def executor(self):
+        # Threads do not survive a fork, so every worker process starts its own pool
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="asgi")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._executor is not None and self._executor_pid == os.getpid():
+                    self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        headers = [(name.decode("latin-1").lower(), value.decode("latin-1")) for name, value in scope["headers"]]
+        max_body = self.path_max_body.get(scope["path"], self.max_body)
+        length = next((value for name, value in headers if name == "content-length"), None)
+        if max_body is not None and length is not None and length.isdigit() and int(length) > max_body:
+            await _plain_response(send, 413, b"Request Entity Too Large")
+            return
+
+        sniffer = None
+        content_type, options = parse_options_header(
+            next((value for name, value in headers if name == "content-type"), ""))
+        if scope["path"] in self.sniff_paths and content_type == "multipart/form-data" and options.get("boundary"):
+            sniffer = MultipartSniffer(options["boundary"], self.max_pixels)
+
+        try:
+            body = await self._receive_body(receive, max_body, sniffer)
+        except UploadRejected as e:
+            await _json_response(send, e.code, {"error": e.description})
+            return
+        if body is None:
+            return  # The client went away mid-upload; nothing reached the app
+        if body is False:
+            await _plain_response(send, 413, b"Request Entity Too Large")
+            return
+
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, headers, body)
+        try:
+            status, response_headers, chunks, result = await loop.run_in_executor(self.executor, self._call, environ)
+        except Exception as e:
+            logging.error("Error handling %s %s: %s", scope["method"], scope["path"], str(e))
+            body.close()
+            await _plain_response(send, 500, b"Internal Server Error")
+            return
+
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response_headers],
+            })
+            for chunk in chunks:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            while result is not None:
+                chunk = await loop.run_in_executor(self.executor, next, result, _END)
+                if chunk is _END:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self.executor, result.close)
+            body.close()
+
+    async def _receive_body(self, receive, max_body, sniffer=None):
+        # Return the body spooled to a file object, None if the client disconnected or False once it passes
+        # max_body; raises UploadRejected as soon as the sniffer refuses an uploaded photo
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if max_body is not None and size > max_body:
+                body.close()
+                return False
+            if sniffer is not None:
+                try:
+                    sniffer.feed(chunk)
+                    if not message.get("more_body", False):
+                        sniffer.feed(b"")
+                except UploadRejected:
+                    body.close()
+                    raise
+            body.write(chunk)
+            if not message.get("more_body", False):
+                body.seek(0)
+                return body
+
+    def _call(self, environ):
+        # Run the WSGI app up to its first body chunk, since start_response may wait until then
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return written.append
+
+        result = self.wsgi_app(environ, start_response)
+        iterator = iter(result)
+        first = next(iterator, _END)
+        chunks = written + ([] if first is _END else [first])
+        if first is _END:
+            if hasattr(result, "close"):
+                result.close()
+            iterator = None
+        elif hasattr(result, "close") and iterator is not result:
+            iterator = _Closing(iterator, result)
+        return response["status"], response["headers"], chunks, iterator
+
+
+class _Closing:
+    # An iterator that closes the WSGI result it came from
+    def __init__(self, iterator, result):
+        self.iterator, self.result = iterator, result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        self.result.close()
+
+
+def _environ(scope, headers, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    body.seek(0, os.SEEK_END)
+    length = body.tell()
+    body.seek(0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(length),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers:
+        if name == "content-length":
+            continue
+        key = "CONTENT_TYPE" if name == "content-type" else "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _json_response(send, status, data):
+    # The same body Flask's jsonify gives the app's own error responses
+    text = (json.dumps(data, separators=(",", ":")) + "\n").encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(text)).encode())]})
+    await send({"type": "http.response.body", "body": text})
+
+
+async def _plain_response(send, status, text):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(text)).encode())]})
+    await send({"type": "http.response.body", "body": text})
+
+
+def create_app(target=None, threads=None):
+    """Wrap a Flask app ("module:attribute") for ASGI servers, refusing bodies over its upload limits."""
+    wsgi_app = load_app(target or os.environ.get("ASGI_APP", "app:app"))
+    config = getattr(wsgi_app, "config", {})
+    path_max_body = {}
+    if config.get('MAX_BATCH_CONTENT_LENGTH'):
+        path_max_body["/upload/batch"] = config['MAX_BATCH_CONTENT_LENGTH']
+    # Only app.py checks uploads from their header (it sets MAX_IMAGE_PIXELS); the other variants take any body
+    sniff_paths = ("/upload", "/upload/stream") if config.get('MAX_IMAGE_PIXELS') else ()
+    return AsyncUploadServer(wsgi_app, threads=threads or int(os.environ.get("ASGI_THREADS", 0)) or None,
+                             max_body=config.get('MAX_CONTENT_LENGTH'), path_max_body=path_max_body,
+                             sniff_paths=sniff_paths, max_pixels=config.get('MAX_IMAGE_PIXELS'))
+
+
+app = create_app()
@@ -0,0 +1,117 @@
+"""
+Vectorized version of app.py's compose_song for offline backfills.
+
+generate_lines takes an (N, 10, 10) uint8 array of sampled greyscale grids and
+returns (N, 10) top-line and bottom-line MIDI pitch arrays. The per-image
+generator's state (pitch usage counts, the last two bottom notes, notes banned
+after repeating, the last leap direction) is kept as arrays over N, and every
+rule in the bottom-line candidate scan is a mask over all N images at once.
+The candidate scan runs in the same order as app.py, including its side
+effects on skipped candidates, so the output is identical to compose_song.
+"""
+import numpy as np
+
+from pitch_math import CONSONANCE_TABLE
+
+LENGTH = 10
+TONIC_PITCH = 60  # Middle C
+SCALE_DEGREES = (0, 2, 4, 5, 7, 9, 11)
+LOWER_SCALE_DEGREES = (-12, -10, -8, -7, -5, -3, -1)
+CANDIDATES = tuple(TONIC_PITCH + degree for degree in SCALE_DEGREES + LOWER_SCALE_DEGREES)
+
+LOWEST_PITCH = 35  # B1
+MAX_CONSECUTIVE_REPEATS = 2
+MAX_NOTE_USAGE = 3
+MAX_LEAP = 9  # M6
+
+_CONSONANCE = np.frombuffer(CONSONANCE_TABLE, dtype=np.uint8).astype(bool)
+
+# Column of each candidate pitch in the per-image usage counts
+_CANDIDATE_COLUMN = np.zeros(128, dtype=np.intp)
+_CANDIDATE_COLUMN[list(CANDIDATES)] = np.arange(len(CANDIDATES))
+
+
+def top_lines(pixels):
+    """Return the (N, 10) top lines for (N, 100) flattened pixel grids."""
+    scale = np.array([TONIC_PITCH + degree for degree in SCALE_DEGREES], dtype=np.int16)
+    top = np.full((pixels.shape[0], LENGTH), TONIC_PITCH, dtype=np.int16)
+    # compose_song pops pixel values from the end of the grid for notes 1..8
+    popped = pixels[:, -1:-(LENGTH - 1):-1].astype(np.int16)
+    top[:, 1:LENGTH - 1] = scale[popped % len(scale)]
+    return top
+
+
+def bottom_lines(top):
+    """Return the (N, 10) bottom lines for (N, 10) top lines, mirroring compose_song's greedy scan."""
+    count = top.shape[0]
+    bottom = np.empty_like(top)
+
+    usage = np.zeros((count, len(CANDIDATES)), dtype=np.int16)
+    banned = np.zeros((count, len(CANDIDATES)), dtype=bool)
+    last = np.zeros(count, dtype=np.int16)         # Last bottom note
+    second_last = np.zeros(count, dtype=np.int16)  # The one before it
+    last_leap = np.zeros(count, dtype=np.int8)     # 0 = none yet, 1 = up, -1 = down
+    rows = np.arange(count)
+
+    for i in range(LENGTH):
+        if i == 0:
+            chosen = np.full(count, TONIC_PITCH, dtype=np.int16)
+        elif i == LENGTH - 1:
+            chosen = np.full(count, TONIC_PITCH - 12, dtype=np.int16)  # End on the lower tonic
+        else:
+            top_pitch = top[:, i]
+            best_score = np.full(count, np.iinfo(np.int16).max, dtype=np.int16)
+            chosen = np.full(count, TONIC_PITCH, dtype=np.int16)  # Fallback to tonic
+
+            for k, candidate in enumerate(CANDIDATES):
+                # Voice crossing, range floor and notes banned for repeating earlier
+                ok = (candidate < top_pitch) & (candidate >= LOWEST_PITCH) & ~banned[:, k]
+
+                # A third consecutive repetition bans the note for the rest of the line
+                if i >= MAX_CONSECUTIVE_REPEATS:
+                    repeated = ok & (last == candidate) & (second_last == candidate)
+                    banned[:, k] |= repeated
+                    ok &= ~repeated
+
+                motion = candidate - last
+                ok &= usage[:, k] < MAX_NOTE_USAGE
+                ok &= np.abs(motion) <= MAX_LEAP
+                if i == 1:
+                    ok &= np.abs(motion) <= 2
+                if i == LENGTH - 2:
+                    ok &= np.abs(candidate - top[:, LENGTH - 1]) <= 2
+                ok &= _CONSONANCE[(candidate << 7) | top_pitch]
+
+                score = np.where(motion == -1, -10, 0).astype(np.int16)
+                if i == 1 or i == LENGTH - 2:
+                    score += np.where(motion == 0, 5, 0).astype(np.int16)
+
+                # Leaps must turn back; an accepted leap is remembered even if another note wins
+                leap = ok & (np.abs(motion) > 2)
+                direction = np.where(motion > 0, 1, -1).astype(np.int8)
+                same_direction = leap & (last_leap != 0) & (direction == last_leap)
+                ok &= ~same_direction
+                taken_leap = leap & ~same_direction
+                last_leap = np.where(taken_leap, direction, last_leap)
+                score += np.where(taken_leap, 5, 0).astype(np.int16)
+
+                better = ok & (score < best_score)
+                best_score = np.where(better, score, best_score)
+                chosen = np.where(better, candidate, chosen).astype(np.int16)
+
+        bottom[:, i] = chosen
+        usage[rows, _CANDIDATE_COLUMN[chosen]] += 1
+        second_last, last = last, chosen
+
+    return bottom
+
+
+def generate_lines(grids):
+    """
+    Return (top, bottom) pitch arrays of shape (N, 10) for an (N, 10, 10) uint8 array of grids.
+
+    Row n matches compose_song(list(grids[n].ravel())) from app.py.
+    """
+    pixels = np.asarray(grids, dtype=np.uint8).reshape(len(grids), -1)
+    top = top_lines(pixels)
+    return top, bottom_lines(top)
@@ -0,0 +1,64 @@
+"""
+Time the vectorized batch generator against app.py's per-image compose_song.
+
+Usage:
+    python benchmarks/bench_batch_generator.py [--grids 100000] [--check 5000]
+
+Random 10x10 grids are generated once; the batch generator runs over all of
+them, compose_song over the first --check of them, and every checked row is
+compared note for note. Exits non-zero on any mismatch.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from batch_generator import generate_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grids", type=int, default=100000)
+    parser.add_argument("--check", type=int, default=5000, help="grids to also run through compose_song")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # app.py creates its uploads/songs folders in the working directory
+        import app
+
+    grids = np.random.default_rng(args.seed).integers(0, 256, (args.grids, 10, 10), dtype=np.uint8)
+
+    start = time.perf_counter()
+    top, bottom = generate_lines(grids)
+    batch_seconds = time.perf_counter() - start
+
+    checked = min(args.check, args.grids)
+    mismatches = 0
+    start = time.perf_counter()
+    for n in range(checked):
+        note_data = app.compose_song(grids[n].ravel().tolist())
+        expected_top = [note["pitch"] for note in note_data["topLine"]]
+        expected_bottom = [note["pitch"] for note in note_data["bottomLine"]]
+        if expected_top != top[n].tolist() or expected_bottom != bottom[n].tolist():
+            mismatches += 1
+    loop_seconds = time.perf_counter() - start
+
+    print(f"batch generator  {args.grids} grids in {batch_seconds:.3f} s "
+          f"({batch_seconds / args.grids * 1e6:.2f} us per grid)")
+    print(f"compose_song     {checked} grids in {loop_seconds:.3f} s "
+          f"({loop_seconds / checked * 1e6:.2f} us per grid)")
+    print(f"identical rows   {checked - mismatches}/{checked}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
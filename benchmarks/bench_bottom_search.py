@@ -0,0 +1,62 @@
+"""
+Compare the greedy bottom line with the beam/DP search in rules.py.
+
+Usage:
+    python benchmarks/bench_bottom_search.py [--lines 2000] [--ruleset app] [--beams 1,4,16,64,0]
+
+Top lines are built from random grids exactly as app.py builds them. For the
+greedy scan and each beam width (0 = keep every state) the script reports the
+time per line, the mean path score (lower is better), how many lines break at
+least one rule (the greedy scan falls back to the tonic when nothing fits) and
+the total number of broken rules.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from batch_generator import top_lines
+from rules import RULESETS, compile_ruleset
+
+
+def report(label, ruleset, top, solve):
+    start = time.perf_counter()
+    bottoms = [solve(line) for line in top]
+    seconds = time.perf_counter() - start
+
+    evaluated = [ruleset.evaluate(line, bottom) for line, bottom in zip(top, bottoms)]
+    scores = [score for score, _ in evaluated]
+    broken = sum(1 for _, violations in evaluated if violations)
+    violations = sum(violations for _, violations in evaluated)
+    print(f"{label:<10} {seconds / len(top) * 1e6:10.1f} {statistics.mean(scores):11.2f} "
+          f"{broken:>13} {violations:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--ruleset", default="app", choices=sorted(RULESETS))
+    parser.add_argument("--beams", default="1,4,16,64,0", help="comma-separated beam widths, 0 = unbounded")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    grids = np.random.default_rng(args.seed).integers(0, 256, (args.lines, 100), dtype=np.uint8)
+    top = top_lines(grids).tolist()
+    ruleset = compile_ruleset(args.ruleset)
+
+    print(f"{args.lines} lines, ruleset {args.ruleset!r}")
+    print(f"{'mode':<10} {'us/line':>10} {'mean score':>11} {'broken lines':>13} {'violations':>11}")
+    report("greedy", ruleset, top, ruleset.bottom_line)
+    for width in (int(w) for w in args.beams.split(",")):
+        report(f"beam {width or 'all'}", ruleset, top,
+               lambda line, width=width: ruleset.search_line(line, beam_width=width or None))
+
+
+if __name__ == "__main__":
+    main()
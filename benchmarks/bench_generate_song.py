@@ -0,0 +1,100 @@
+"""
+Time generate_song per request, and the interval lookup it relies on.
+
+Usage:
+    python benchmarks/bench_generate_song.py [--requests 200] [--app PATH]
+
+Pass --app to time another copy of app.py, e.g. the previous revision:
+    git show HEAD~1:app.py > /tmp/app_before.py
+    python benchmarks/bench_generate_song.py --app /tmp/app_before.py
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from pitch_math import interval_name
+
+
+def load_app(path):
+    spec = importlib.util.spec_from_file_location("bench_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_images(folder, count, seed):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"{i}.png")
+        Image.frombytes("L", (64, 64), bytes(rng.randrange(256) for _ in range(64 * 64))).save(path)
+        paths.append(path)
+    return paths
+
+
+def time_generate_song(app, paths):
+    timings = []
+    for path in paths:
+        start = time.perf_counter()
+        app.generate_song(path)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def time_intervals(pairs):
+    from music21 import interval, note
+
+    start = time.perf_counter()
+    for low, high in pairs:
+        interval.Interval(note.Note(low), note.Note(high)).name
+    music21_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for low, high in pairs:
+        interval_name(low, high)
+    table_ms = (time.perf_counter() - start) * 1000
+    return music21_ms, table_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="number of synthetic photos to generate songs for")
+    parser.add_argument("--app", default=os.path.join(ROOT, "app.py"), help="path of the app.py to benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # app.py creates its uploads/songs folders in the working directory
+        app = load_app(os.path.abspath(os.path.join(ROOT, args.app)))
+        paths = make_images(folder, args.requests, args.seed)
+        app.generate_song(paths[0])  # Warm up imports and caches
+        timings = time_generate_song(app, paths)
+
+    timings.sort()
+    print(f"generate_song ({args.app}), {len(timings)} requests")
+    print(f"  mean   {statistics.mean(timings):8.3f} ms")
+    print(f"  median {statistics.median(timings):8.3f} ms")
+    print(f"  p99    {timings[int(len(timings) * 0.99) - 1]:8.3f} ms")
+
+    # Every (candidate, top) pair the bottom-line loop can ask about
+    pairs = [(low, high) for low in range(48, 72) for high in range(60, 72)]
+    music21_ms, table_ms = time_intervals(pairs)
+    print(f"interval names for {len(pairs)} pairs")
+    print(f"  music21.interval.Interval {music21_ms:8.3f} ms")
+    print(f"  pitch_math table          {table_ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
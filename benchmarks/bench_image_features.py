@@ -0,0 +1,127 @@
+"""
+Time whole-photo feature extraction against the grid sampling it replaces, and count song collisions.
+
+Usage:
+    python benchmarks/bench_image_features.py [--corpus DIR] [--count 5] [--size 6000x4000] [--variants 200]
+                                              [--budget 2]
+
+For every photo (synthetic JPEGs and PNGs of --size without --corpus) this
+reports the time of sample_pixels (decode + resize, what a request paid before)
+and of extract_features + note_values, each the best of --repeat runs.
+
+Both paths decode and reduce the photo the same way, and the decode of a
+6000x4000 PNG alone varies by tens of milliseconds between runs, so the
+difference of those two times says little. The cost the features add is
+measured instead on the reduced image (what reduce_for_grid returns), as
+extract_features minus sample_pixels' resize. It must stay within a fixed
+--budget of milliseconds per request; the script exits with status 1 if any
+photo goes over.
+
+The collision check paints --variants small rectangles at random places on one
+photo and counts how many distinct top lines each sampling gives: the pixel
+grid only reads the bottom rows, so most variants collapse onto one song.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import ImageDraw
+
+from bench_image_sampling import PHOTO_EXTENSIONS, make_corpus, synthetic_photo
+from image_features import extract_features
+from image_sampling import GRID_SIZE, open_image, reduce_for_grid, sample_pixels
+
+SONG_LENGTH = 10
+
+
+def best_times(functions, repeat):
+    # Runs are interleaved, so drift in the machine's speed hits every function alike
+    timings = [[] for _ in functions]
+    for _ in range(repeat):
+        for function, runs in zip(functions, timings):
+            start = time.perf_counter()
+            function()
+            runs.append((time.perf_counter() - start) * 1000)
+    return [min(runs) for runs in timings]
+
+
+def added_cost(path, repeat):
+    # Milliseconds extract_features + note_values spends after the shared decode and reduce, beyond sample_pixels
+    reduced = reduce_for_grid(open_image(path), GRID_SIZE)
+    reduced.load()
+    sampling, features = best_times(
+        [lambda: sample_pixels(reduced.copy(), fast=False),
+         lambda: extract_features(reduced.copy(), SONG_LENGTH).note_values(SONG_LENGTH - 2)],
+        repeat * 20,
+    )
+    return features - sampling
+
+
+def top_line_values(photo, features):
+    # The values compose_top_line reads, in order
+    if features:
+        return tuple(extract_features(photo, SONG_LENGTH).note_values(SONG_LENGTH - 2))
+    return tuple(sample_pixels(photo)[-(SONG_LENGTH - 2):])
+
+
+def count_collisions(variants, seed):
+    rng = random.Random(seed)
+    base = synthetic_photo((640, 480), seed)
+    songs = {"pixels": set(), "features": set()}
+    for _ in range(variants):
+        img = base.copy()
+        x, y = rng.randrange(0, 600), rng.randrange(0, 440)
+        ImageDraw.Draw(img).rectangle((x, y, x + 40, y + 40), fill=tuple(rng.randrange(256) for _ in range(3)))
+        for sampling in songs:
+            songs[sampling].add(tuple(value % 7 for value in top_line_values(img, sampling == "features")))
+    return {sampling: len(lines) for sampling, lines in songs.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of photos to use instead of synthetic ones")
+    parser.add_argument("--count", type=int, default=5, help="number of synthetic photos")
+    parser.add_argument("--size", default="6000x4000", help="synthetic photo size, WxH")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=2, help="milliseconds features may add to a request")
+    parser.add_argument("--variants", type=int, default=200, help="painted variants for the collision check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.corpus:
+            paths = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                           if name.lower().endswith(PHOTO_EXTENSIONS))
+        else:
+            width, height = (int(part) for part in args.size.split("x"))
+            paths = make_corpus(folder, args.count, (width, height))
+
+        print(f"{'photo':<16} {'decode+resize':>14} {'features':>10} {'added':>8}")
+        within_budget = True
+        for path in paths:
+            sampling, features = best_times(
+                [lambda: sample_pixels(path), lambda: extract_features(path, SONG_LENGTH).note_values(SONG_LENGTH - 2)],
+                args.repeat,
+            )
+            added = added_cost(path, args.repeat)
+            within_budget &= added <= args.budget
+            print(f"{os.path.basename(path):<16} {sampling:11.2f} ms {features:7.2f} ms {added:5.2f} ms"
+                  + ("" if added <= args.budget else "  OVER BUDGET"))
+
+    distinct = count_collisions(args.variants, args.seed)
+    print(f"distinct top lines over {args.variants} painted variants: "
+          f"pixels {distinct['pixels']}, features {distinct['features']}")
+    if not within_budget:
+        print(f"features add more than {args.budget:g} ms to a request")
+        sys.exit(1)
+    print(f"added cost within the {args.budget:g} ms budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare the full-decode and draft/reduce image sampling paths on large photos.
+
+Usage:
+    python benchmarks/bench_image_sampling.py [--corpus DIR] [--count 5] [--size 6000x4000]
+
+Without --corpus a handful of synthetic JPEGs and PNGs of --size are generated.
+For every photo this reports the decode time of both paths, whether the sampled
+grids are pixel-equal, the largest per-pixel difference and whether the
+generated song is the same.
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from image_sampling import compare_sampling, sample_pixels
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def synthetic_photo(size, seed=0):
+    # Smooth noise over gradients: grid cells differ, but it compresses like a real photo
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise((max(1, size[0] // 16), max(1, size[1] // 16)), 40 + 10 * seed).resize(size, Image.BICUBIC)
+    return Image.merge("RGB", (gradient, noise, gradient.rotate(90 * seed, expand=False)))
+
+
+def make_corpus(folder, count, size):
+    paths = []
+    for i in range(count):
+        img = synthetic_photo(size, i)
+        extension = ".png" if i % 4 == 3 else ".jpg"
+        path = os.path.join(folder, f"photo_{i}{extension}")
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def time_sampling(path, fast, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sample_pixels(path, fast=fast)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of photos to sample instead of synthetic ones")
+    parser.add_argument("--count", type=int, default=5, help="number of synthetic photos")
+    parser.add_argument("--size", default="6000x4000", help="synthetic photo size, WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repeats per photo (best is kept)")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # app.py creates its uploads/songs folders in the working directory
+        import app
+
+        if args.corpus:
+            paths = sorted(
+                os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                if name.lower().endswith(PHOTO_EXTENSIONS)
+            )
+        else:
+            width, height = (int(v) for v in args.size.lower().split("x"))
+            paths = make_corpus(folder, args.count, (width, height))
+
+        exact_times, fast_times = [], []
+        equal_grids = equal_songs = 0
+        print(f"{'photo':<24} {'exact ms':>9} {'fast ms':>9} {'equal':>6} {'max diff':>9} {'same song':>10}")
+        for path in paths:
+            exact_ms = time_sampling(path, False, args.repeat)
+            fast_ms = time_sampling(path, True, args.repeat)
+            exact, fast = compare_sampling(path)
+            max_diff = max(abs(a - b) for a, b in zip(exact, fast))
+            same_song = app.generate_song(path, fast_sampling=False) == app.generate_song(path, fast_sampling=True)
+
+            exact_times.append(exact_ms)
+            fast_times.append(fast_ms)
+            equal_grids += exact == fast
+            equal_songs += same_song
+            print(f"{os.path.basename(path):<24} {exact_ms:9.1f} {fast_ms:9.1f} {str(exact == fast):>6} "
+                  f"{max_diff:9d} {str(same_song):>10}")
+
+    print(f"median exact {statistics.median(exact_times):.1f} ms, fast {statistics.median(fast_times):.1f} ms")
+    print(f"pixel-equal grids {equal_grids}/{len(paths)}, identical songs {equal_songs}/{len(paths)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Check the native MIDI writer against music21 and time both.
+
+Usage:
+    python benchmarks/bench_midi_writer.py [--songs 200]
+
+Songs are random two-line first species shapes in the layouts the generators
+use (4/4 whole notes as in app2.py, untimed quarter notes as in notes-v1.py).
+Every file is compared byte for byte, and the note events of the two files
+are listed for the first mismatch if there is one.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from music21 import midi
+from music21.midi import translate
+
+from midi_writer import midi_bytes
+from render_jobs import build_score
+
+LAYOUTS = (("4/4", 4.0), (None, 1.0))
+
+
+def random_lines(rng, length, quarter_length):
+    top = [rng.choice((60, 62, 64, 65, 67, 69, 71)) for _ in range(length)]
+    bottom = [pitch - rng.choice((0, 3, 4, 7, 8, 9, 12)) for pitch in top]
+    return [[(p, quarter_length) for p in top], [(p, quarter_length) for p in bottom]]
+
+
+def music21_bytes(lines, time_signature):
+    spec = {"parts": [
+        {"clef": None, "timeSignature": time_signature, "notes": [list(n) for n in line]} for line in lines
+    ]}
+    # The same translation score.write("midi") runs, kept in memory
+    return translate.streamToMidiFile(build_score(spec)).writestr()
+
+
+def note_events(data):
+    midi_file = midi.MidiFile()
+    midi_file.readstr(data)
+    return [
+        [(event.type.name, event.pitch, event.velocity) for event in track.events if event.isNoteOn() or event.isNoteOff()]
+        for track in midi_file.tracks
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--songs", type=int, default=200)
+    parser.add_argument("--length", type=int, default=10, help="notes per line")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    songs = []
+    for i in range(args.songs):
+        time_signature, quarter_length = LAYOUTS[i % len(LAYOUTS)]
+        songs.append((random_lines(rng, args.length, quarter_length), time_signature))
+
+    music21_times, native_times = [], []
+    mismatches = 0
+    for lines, time_signature in songs:
+        start = time.perf_counter()
+        expected = music21_bytes(lines, time_signature)
+        music21_times.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        actual = midi_bytes(lines, time_signature)
+        native_times.append((time.perf_counter() - start) * 1000)
+
+        if actual != expected:
+            mismatches += 1
+            if mismatches == 1:
+                print("first mismatch:", lines, time_signature)
+                print("  music21:", note_events(expected))
+                print("  native: ", note_events(actual))
+
+    print(f"byte-identical files {len(songs) - mismatches}/{len(songs)}")
+    print(f"music21 score.write  median {statistics.median(music21_times):8.3f} ms")
+    print(f"midi_writer          median {statistics.median(native_times):8.3f} ms")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
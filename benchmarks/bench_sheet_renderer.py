@@ -0,0 +1,81 @@
+"""
+Compare sheet music rendering: one MuseScore process per score, the batching pool, and the SVG fallback.
+
+Usage:
+    python benchmarks/bench_sheet_renderer.py [--scores 32] [--workers 2] [--batch 8] [--musescore PATH]
+
+Scores are composed from random grids by app2.py's rules and submitted from
+--scores threads at once, as concurrent uploads would. "per score" runs the
+pool with one worker and batches of one, which is what score.write("musicxml.png")
+amounts to; "pool" uses --workers and --batch. Without MuseScore (see
+MUSESCORE_PATH) only the SVG fallback is timed.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from batch_generator import top_lines
+from render_jobs import MUSESCORE_PATH, lines_spec, spec_musicxml
+from rules import compile_ruleset
+from sheet_renderer import SheetRenderer, score_svg
+
+
+def concurrent_renders(renderer, specs):
+    failures = []
+
+    def render(spec):
+        try:
+            renderer.render_png(spec)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=render, args=(spec,)) for spec in specs]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scores", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--musescore", default=MUSESCORE_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ruleset = compile_ruleset("app2")
+    grids = np.random.default_rng(args.seed).integers(0, 256, (args.scores, 100), dtype=np.uint8)
+    specs = [lines_spec([top, ruleset.bottom_line(top)], 4, "4/4") for top in top_lines(grids).tolist()]
+    spec_musicxml(specs[0])  # Import music21 before timing anything
+
+    start = time.perf_counter()
+    for spec in specs:
+        score_svg(spec)
+    print(f"{'svg fallback':<14} {(time.perf_counter() - start) / len(specs) * 1000:10.2f} ms/score")
+
+    modes = (("per score", 1, 1), ("pool", args.workers, args.batch))
+    for label, workers, batch in modes:
+        renderer = SheetRenderer(args.musescore, spec_musicxml, workers=workers, batch_size=batch,
+                                 timeout=args.timeout, max_pending=len(specs))
+        if not renderer.available:
+            print(f"MuseScore not found at {args.musescore}; skipping the PNG modes")
+            return
+        seconds, failures = concurrent_renders(renderer, specs)
+        print(f"{label:<14} {seconds / len(specs) * 1000:10.2f} ms/score "
+              f"({workers} workers, batches of {batch}, {len(failures)} failed)")
+
+
+if __name__ == "__main__":
+    main()
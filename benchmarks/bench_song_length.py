@@ -0,0 +1,58 @@
+"""
+Time compose_song at different song lengths to check the per-note cost stays flat.
+
+Usage:
+    python benchmarks/bench_song_length.py [--lengths 10,1000,100000] [--beam 0]
+
+For each length a random pixel grid of grid_for_length(length) is generated and
+compose_song is run over it; the script prints the total time, the time per
+note and how many bottom-line notes break a rule (see CompiledRuleset.evaluate).
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from image_sampling import grid_for_length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", default="10,1000,100000")
+    parser.add_argument("--beam", type=int, default=0, help="beam width, 0 = greedy")
+    parser.add_argument("--ruleset", default="app")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # app.py creates its uploads/songs folders in the working directory
+        import app
+
+    rng = random.Random(args.seed)
+    print(f"{'notes':>8} {'grid':>9} {'runs':>5} {'ms/song':>10} {'us/note':>9} {'broken rules':>13}")
+    for length in (int(n) for n in args.lengths.split(",")):
+        width, height = grid_for_length(length)
+        pixels = [rng.randrange(256) for _ in range(width * height)]
+        runs = max(1, 100000 // length)
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            note_data = app.compose_song(pixels, args.ruleset, args.beam, length)
+        seconds = (time.perf_counter() - start) / runs
+
+        bottom = [note["pitch"] for note in note_data["bottomLine"]]
+        top = [note["pitch"] for note in note_data["topLine"]]
+        broken = app.compile_ruleset(args.ruleset).evaluate(top, bottom)[1]
+        print(f"{length:>8} {f'{width}x{height}':>9} {runs:>5} {seconds * 1e3:10.3f} "
+              f"{seconds / length * 1e6:9.2f} {broken:>13}")
+
+
+if __name__ == "__main__":
+    main()
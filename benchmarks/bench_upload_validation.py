@@ -0,0 +1,112 @@
+"""
+Check which uploads upload_validation lets through, and how much of a refused one is read.
+
+Usage:
+    python benchmarks/bench_upload_validation.py [--size 2000x1500]
+
+Posts a set of photos to app.py's /upload through the Flask test client and
+compares each status with the expected one. The set covers every accepted
+format, including files whose dimensions lie past HEADER_LIMIT (an LZW or
+Deflate TIFF with its IFD after the image data, a JPEG with a large ICC
+profile), plus junk, an unsupported format and a decompression bomb. For
+refused uploads it reports how many bytes of the file reached the stream
+before parsing stopped. Exits with status 1 if any status is unexpected.
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from bench_image_sampling import synthetic_photo
+
+
+def encode(img, image_format, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def large_icc_profile(size=300 * 1024):
+    # A valid sRGB profile padded past HEADER_LIMIT; PIL splits it over several APP2 segments
+    from PIL import ImageCms
+
+    profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    padded = bytearray(profile + bytes(size - len(profile)))
+    padded[:4] = len(padded).to_bytes(4, "big")
+    return bytes(padded)
+
+
+def cases(size):
+    photo = synthetic_photo(size)
+    bomb = encode(Image.new("L", (1, 1)), "PNG")
+    # Rewrite the IHDR dimensions to 40000x40000 (and its CRC); the header is all the sniffer reads
+    ihdr = (40000).to_bytes(4, "big") * 2 + bomb[24:29]
+    bomb = bomb[:16] + ihdr + zlib.crc32(b"IHDR" + ihdr).to_bytes(4, "big") + bomb[33:]
+    return [
+        ("jpeg", encode(photo, "JPEG", quality=90), 200),
+        ("jpeg, 300 KB ICC profile", encode(photo, "JPEG", quality=90, icc_profile=large_icc_profile()), 200),
+        ("png", encode(photo, "PNG"), 200),
+        ("webp", encode(photo, "WEBP"), 200),
+        ("gif", encode(photo.convert("P"), "GIF"), 200),
+        ("bmp", encode(photo, "BMP"), 200),
+        ("tiff", encode(photo, "TIFF"), 200),
+        ("tiff_lzw", encode(photo, "TIFF", compression="tiff_lzw"), 200),
+        ("tiff_adobe_deflate", encode(photo, "TIFF", compression="tiff_adobe_deflate"), 200),
+        ("junk", os.urandom(2 * 1024 * 1024), 415),
+        ("ico", encode(photo.resize((64, 64)), "ICO"), 415),
+        ("png bomb", bomb, 413),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="2000x1500", help="synthetic photo size, WxH")
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+
+    logging.disable(logging.ERROR)
+    os.chdir(tempfile.mkdtemp())  # app.py creates its upload and song folders in the working directory
+    import app
+    from upload_validation import SniffedUpload
+
+    written = {}
+    original_write = SniffedUpload.write
+
+    def counting_write(self, data):
+        written[id(self)] = written.get(id(self), 0) + len(data)
+        return original_write(self, data)
+
+    SniffedUpload.write = counting_write
+    client = app.app.test_client()
+
+    failures = 0
+    for name, data, expected in cases(size):
+        written.clear()
+        start = time.perf_counter()
+        response = client.post("/upload", data={"photo": (io.BytesIO(data), f"photo.{name.split()[0]}")},
+                               content_type="multipart/form-data")
+        elapsed = (time.perf_counter() - start) * 1000
+        read = sum(written.values())
+        ok = response.status_code == expected
+        failures += not ok
+        line = f"{name:<26} {len(data) / 1024:9.0f} KB  {response.status_code} (expected {expected})  {elapsed:7.1f} ms"
+        if response.status_code != 200:
+            line += f"  {read / 1024:.0f} KB read before refusing"
+        print(line + ("" if ok else "  MISMATCH"))
+
+    if failures:
+        print(f"{failures} unexpected statuses")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Load test /upload while slow clients trickle their uploads in, against Flask+gunicorn and the ASGI front.
+
+Usage:
+    python benchmarks/load_slow_clients.py [--serve both|flask|asgi] [--workers 2] [--slow 8]
+                                           [--rate 65536] [--fast 4] [--duration 30]
+    python benchmarks/load_slow_clients.py --url http://127.0.0.1:5002   (a server that is already running)
+
+--slow clients each upload a --photo-kb JPEG at --rate bytes per second, over
+and over, like phones on a poor connection. At the same time --fast clients
+upload the same photo at full speed, back to back. After --duration seconds this
+reports the uploads completed per second by each group and the fast clients'
+median and 95th percentile latency.
+
+With sync gunicorn workers, every slow upload in flight holds a worker, so
+once there are as many slow clients as workers the fast clients queue behind
+them. The ASGI front (asgi.py, served by uvicorn) only spends a coroutine on a
+trickling body, so fast uploads keep their latency.
+
+--serve starts each server on --port with --workers processes:
+    flask   gunicorn app:app (gunicorn.conf.py, sync workers)
+    asgi    uvicorn asgi:app
+"""
+import argparse
+import http.client
+import io
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_image_sampling import synthetic_photo
+
+SERVERS = {
+    "flask": lambda port, workers: ["gunicorn", "app:app", "-b", f"127.0.0.1:{port}", "-w", str(workers)],
+    "asgi": lambda port, workers: [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port),
+                                   "--workers", str(workers), "--log-level", "warning"],
+}
+
+
+def photo_bytes(kilobytes):
+    # A synthetic JPEG of roughly the requested size
+    side = 256
+    while True:
+        buffer = io.BytesIO()
+        synthetic_photo((side * 4 // 3, side)).save(buffer, "JPEG", quality=95)
+        if buffer.tell() >= kilobytes * 1024 or side >= 8192:
+            return buffer.getvalue()
+        side = side * 3 // 2
+
+
+def multipart_body(photo):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"photo\"; filename=\"photo.jpg\"\r\n"
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + photo + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def upload(url, body, content_type, rate=None, timeout=120):
+    # POST the body (trickled at `rate` bytes/s if given) and return the status code
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        connection.putrequest("POST", "/upload")
+        connection.putheader("Content-Type", content_type)
+        connection.putheader("Content-Length", str(len(body)))
+        connection.endheaders()
+        if rate:
+            chunk = max(1, rate // 10)
+            for start in range(0, len(body), chunk):
+                connection.send(body[start:start + chunk])
+                time.sleep(0.1)
+        else:
+            connection.send(body)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_load(url, body, content_type, slow, rate, fast, duration):
+    stop = time.monotonic() + duration
+    results = {"slow": [], "fast": [], "errors": 0}
+    lock = threading.Lock()
+
+    def client(group, client_rate):
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                status = upload(url, body, content_type, rate=client_rate)
+            except OSError:
+                status = None
+            finished = time.monotonic()
+            with lock:
+                if status == 200 and finished <= stop:
+                    results[group].append(time.perf_counter() - start)
+                elif status != 200:
+                    results["errors"] += 1
+
+    threads = ([threading.Thread(target=client, args=("slow", rate)) for _ in range(slow)]
+               + [threading.Thread(target=client, args=("fast", None)) for _ in range(fast)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def wait_for_server(url, timeout=60):
+    parts = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            connection.request("GET", "/cache/stats")
+            connection.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def report(label, results, duration):
+    fast = sorted(results["fast"])
+    line = (f"{label:<8} slow {len(results['slow']) / duration:6.2f}/s  fast {len(fast) / duration:6.2f}/s  "
+            f"errors {results['errors']}")
+    if fast:
+        p95 = fast[min(len(fast) - 1, int(len(fast) * 0.95))]
+        line += f"  fast latency p50 {statistics.median(fast) * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="test a running server instead of starting them")
+    parser.add_argument("--serve", choices=("both", "flask", "asgi"), default="both")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--slow", type=int, default=8, help="clients trickling their uploads")
+    parser.add_argument("--rate", type=int, default=64 * 1024, help="bytes per second per slow client")
+    parser.add_argument("--fast", type=int, default=4, help="clients uploading at full speed")
+    parser.add_argument("--photo-kb", type=int, default=1024)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    body, content_type = multipart_body(photo_bytes(args.photo_kb))
+    print(f"{len(body) // 1024} KB uploads; {args.slow} slow clients at {args.rate // 1024} KB/s, "
+          f"{args.fast} fast clients, {args.duration:g} s")
+
+    if args.url:
+        report("server", run_load(args.url, body, content_type, args.slow, args.rate, args.fast, args.duration),
+               args.duration)
+        return
+
+    url = f"http://127.0.0.1:{args.port}"
+    for name in (("flask", "asgi") if args.serve == "both" else (args.serve,)):
+        server = subprocess.Popen(SERVERS[name](args.port, args.workers), cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for_server(url):
+                print(f"{name:<8} did not start (is {'gunicorn' if name == 'flask' else 'uvicorn'} installed?)")
+                continue
+            results = run_load(url, body, content_type, args.slow, args.rate, args.fast, args.duration)
+            report(name, results, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Measure import time and memory of each entry point, and per-worker memory under gunicorn.
+
+Usage:
+    python benchmarks/startup.py [--runs 3]
+    python benchmarks/startup.py --gunicorn [--workers 4] [--module app:app]
+    python benchmarks/startup.py --report PID
+
+The first form imports every entry point in a fresh interpreter and reports the
+import wall time, the resident set size afterwards and whether music21 was loaded.
+The second starts gunicorn with and without --preload and reports RSS, PSS and
+shared memory for the master and every worker (from /proc/<pid>/smaps_rollup).
+The third reports the same for a server that is already running (gunicorn or
+uvicorn), given its master's PID.
+
+Every memory report also shows how much of each process is memory-mapped table
+files (shared_tables.py and the song index, *.bin) and how much of that is
+shared with other processes.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ("app.py", "app2.py", "first-species-v2.py", "notes-v1.py", "first-species-final-music21.py")
+
+IMPORT_PROBE = """
+import importlib.util, json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("entry_point", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - start
+rss_kb = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS:"))
+print(json.dumps({{"seconds": elapsed, "rss_kb": rss_kb, "music21": "music21" in sys.modules}}))
+"""
+
+
+def memory_report(pid):
+    """Return RSS, PSS and shared memory of a process in kB, from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss_kb": fields.get("Rss", 0),
+        "pss_kb": fields.get("Pss", 0),
+        "shared_kb": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private_kb": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def mapped_tables_report(pid, suffix=".bin"):
+    """Return RSS and shared memory in kB of the table files (*.bin) a process has memory-mapped."""
+    report = {"rss_kb": 0, "shared_kb": 0}
+    mapped = False
+    with open(f"/proc/{pid}/smaps") as f:
+        for line in f:
+            parts = line.split()
+            if not parts[0].endswith(":"):
+                # A mapping's first line: address range, permissions, offset, device, inode and path
+                mapped = len(parts) >= 6 and parts[5].endswith(suffix)
+            elif mapped and parts[0] == "Rss:":
+                report["rss_kb"] += int(parts[1])
+            elif mapped and parts[0] in ("Shared_Clean:", "Shared_Dirty:"):
+                report["shared_kb"] += int(parts[1])
+    return report
+
+
+def print_memory(processes):
+    """Print the memory of each (label, pid) and return the total PSS in kB."""
+    print(f"  {'process':<10} {'RSS MB':>8} {'PSS MB':>8} {'shared MB':>10} {'private MB':>11} "
+          f"{'tables MB':>10} {'shared':>7}")
+    total_pss = 0
+    for label, pid in processes:
+        report = memory_report(pid)
+        tables = mapped_tables_report(pid)
+        total_pss += report["pss_kb"]
+        print(f"  {label:<10} {report['rss_kb'] / 1024:8.1f} {report['pss_kb'] / 1024:8.1f} "
+              f"{report['shared_kb'] / 1024:10.1f} {report['private_kb'] / 1024:11.1f} "
+              f"{tables['rss_kb'] / 1024:10.1f} {tables['shared_kb'] / 1024:7.1f}")
+    print(f"  total PSS {total_pss / 1024:.1f} MB")
+    return total_pss
+
+
+def child_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def measure_imports(runs):
+    print(f"{'entry point':<34} {'import s':>9} {'RSS MB':>8} {'music21':>8}")
+    for name in ENTRY_POINTS:
+        results = []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as folder:
+                probe = IMPORT_PROBE.format(root=ROOT, path=os.path.join(ROOT, name))
+                output = subprocess.run(
+                    [sys.executable, "-c", probe], cwd=folder, capture_output=True, text=True, check=True
+                ).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+        seconds = statistics.median(r["seconds"] for r in results)
+        rss_mb = statistics.median(r["rss_kb"] for r in results) / 1024
+        print(f"{name:<34} {seconds:9.3f} {rss_mb:8.1f} {str(results[0]['music21']):>8}")
+
+
+def measure_gunicorn(module, workers, preload):
+    port = 5900 + os.getpid() % 1000
+    command = [sys.executable, "-m", "gunicorn", module, "--workers", str(workers), "--bind", f"127.0.0.1:{port}"]
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as folder:
+        # Run from a temp folder (the app creates its upload folders there) with the repo's
+        # config, overriding only preload_app
+        config = os.path.join(folder, "gunicorn.conf.py")
+        with open(os.path.join(ROOT, "gunicorn.conf.py")) as f:
+            settings = f.read()
+        with open(config, "w") as f:
+            f.write(settings + f"\npreload_app = {preload}\n")
+        command += ["--config", config]
+        server = subprocess.Popen(command, cwd=folder, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            start = time.perf_counter()
+            while len(child_pids(server.pid)) < workers and time.perf_counter() - start < 60:
+                time.sleep(0.1)
+            time.sleep(1)  # Let the workers finish booting
+            boot_seconds = time.perf_counter() - start
+
+            print(f"gunicorn {module}, {workers} workers, preload_app={preload}, ready in {boot_seconds:.1f}s")
+            print_memory(server_processes(server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def server_processes(pid):
+    return [("master", pid)] + [(f"worker {i}", child) for i, child in enumerate(child_pids(pid))]
+
+
+def report_server(pid):
+    with open(f"/proc/{pid}/cmdline") as f:
+        command = f.read().replace("\0", " ").strip()
+    print(f"{pid}: {command}")
+    print_memory(server_processes(pid))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per entry point")
+    parser.add_argument("--gunicorn", action="store_true", help="measure per-worker memory under gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--module", default="app:app")
+    parser.add_argument("--report", type=int, metavar="PID", help="report a running server's master and workers")
+    args = parser.parse_args()
+
+    if args.report:
+        report_server(args.report)
+    elif args.gunicorn:
+        for preload in (False, True):
+            measure_gunicorn(args.module, args.workers, preload)
+    else:
+        measure_imports(args.runs)
+
+
+if __name__ == "__main__":
+    main()
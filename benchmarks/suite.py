@@ -0,0 +1,234 @@
+"""
+Reproducible benchmark suite for the whole /upload pipeline and every generator variant.
+
+Usage:
+    python benchmarks/suite.py [--runs 30] [--sizes small,medium,large] [--formats jpeg,png,webp]
+                               [--output results.json] [--compare baseline.json] [--tolerance 0.2]
+
+Synthetic photos (smooth noise, so they compress like real ones) are generated
+for every size and format. Each case is then timed --runs times after --warmup
+untimed runs:
+
+    app.generate_song        decode + compose from the upload stream (song cache off)
+    app.upload               Flask test client POST /upload round trip (song cache off)
+    <variant>.generate_song  app2.py, first-species-v2.py, notes-v1.py and
+                             first-species-final-music21.py: decode, compose, MIDI file
+
+The variants also render sheet music through MuseScore, which is skipped (their
+render_score is called with sheet=False) unless --sheets is given. --cache leaves
+app.py's song cache on, which measures repeat uploads of the same photo instead.
+
+Every case reports mean, median, p95, p99 (nearest rank) and max latency in ms
+plus throughput. --output writes them with the run's settings, Python version
+and git revision as JSON. --compare reads such a file and exits non-zero if any
+case's p99 grew, or its throughput fell, by more than --tolerance.
+"""
+import argparse
+import importlib.util
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import render_jobs
+from bench_image_sampling import synthetic_photo
+from song_cache import SongCache
+
+SIZES = {"small": (640, 480), "medium": (1920, 1080), "large": (4000, 3000)}
+FORMATS = {"jpeg": ("JPEG", ".jpg"), "png": ("PNG", ".png"), "webp": ("WEBP", ".webp")}
+VARIANTS = ("app2.py", "first-species-v2.py", "notes-v1.py", "first-species-final-music21.py")
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(name, timings_ms):
+    ordered = sorted(timings_ms)
+    mean = statistics.mean(ordered)
+    return {
+        "name": name,
+        "runs": len(ordered),
+        "mean_ms": mean,
+        "median_ms": statistics.median(ordered),
+        "p95_ms": percentile(ordered, 95),
+        "p99_ms": percentile(ordered, 99),
+        "max_ms": ordered[-1],
+        "ops_per_s": 1000 / mean if mean else float("inf"),
+    }
+
+
+def time_case(run, runs, warmup):
+    for _ in range(warmup):
+        run()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def make_photos(folder, sizes, formats, seed):
+    photos = []
+    for size_name in sizes:
+        for format_name in formats:
+            pil_format, extension = FORMATS[format_name]
+            path = os.path.join(folder, f"{size_name}{extension}")
+            synthetic_photo(SIZES[size_name], seed).save(path, pil_format, quality=90)
+            with open(path, "rb") as f:
+                photos.append((f"{format_name}-{size_name}", path, f.read()))
+    return photos
+
+
+def build_cases(photos, args):
+    import app
+
+    if not args.cache:
+        app.song_cache = SongCache(max_entries=0)
+    client = app.app.test_client()
+    cases = []
+
+    for label, path, data in photos:
+        def generate(data=data):
+            if app.generate_song(io.BytesIO(data), fast_sampling=app.app.config['FAST_IMAGE_SAMPLING'],
+                                 features=app.app.config['FEATURE_SONGS']) is None:
+                raise RuntimeError("generate_song failed")
+
+        def upload(data=data, filename=os.path.basename(path)):
+            response = client.post("/upload", data={"photo": (io.BytesIO(data), filename)},
+                                   content_type="multipart/form-data")
+            if response.status_code != 200:
+                raise RuntimeError(f"/upload returned {response.status_code}")
+
+        cases.append((f"app.generate_song[{label}]", generate))
+        cases.append((f"app.upload[{label}]", upload))
+
+    for variant in VARIANTS:
+        module = load_module(variant.replace("-", "_")[:-3], os.path.join(ROOT, variant))
+        if not args.sheets:
+            module.render_score = lambda spec, store: render_jobs.render_score(spec, store, sheet=False)
+        name = variant[:-3]
+        for label, path, _ in photos:
+            def generate(module=module, path=path):
+                result = module.generate_song(path)
+                if not (result[0] if isinstance(result, tuple) else result):
+                    raise RuntimeError("generate_song failed")
+            cases.append((f"{name}.generate_song[{label}]", generate))
+
+    return [(name, run) for name, run in cases if args.filter in name]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {case["name"]: case for case in json.load(f)["results"]}
+    regressions = []
+    for case in results:
+        before = baseline.get(case["name"])
+        if before is None:
+            continue
+        if case["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{case['name']}: p99 {before['p99_ms']:.2f} -> {case['p99_ms']:.2f} ms")
+        if case["ops_per_s"] < before["ops_per_s"] / (1 + tolerance):
+            regressions.append(f"{case['name']}: throughput {before['ops_per_s']:.1f} -> {case['ops_per_s']:.1f}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=30, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed runs per case")
+    parser.add_argument("--sizes", default="small,medium,large", help=f"comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument("--formats", default="jpeg,png,webp", help=f"comma-separated, from {', '.join(FORMATS)}")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--cache", action="store_true", help="leave app.py's song cache on")
+    parser.add_argument("--sheets", action="store_true", help="render the variants' sheet music (needs MuseScore)")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown for --compare")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    formats = args.formats.split(",")
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    logging.disable(logging.CRITICAL)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)  # The apps create their uploads/songs folders in the working directory
+        photos = make_photos(folder, sizes, formats, args.seed)
+        # The variants print progress on every song; keep the report readable
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cases = build_cases(photos, args)
+            finally:
+                sys.stdout = stdout
+
+            print(f"{'case':<58} {'mean':>8} {'median':>8} {'p95':>8} {'p99':>8} {'max':>8} {'ops/s':>8}")
+            for name, run in cases:
+                sys.stdout = devnull
+                try:
+                    timings = time_case(run, args.runs, args.warmup)
+                finally:
+                    sys.stdout = stdout
+                case = summarize(name, timings)
+                results.append(case)
+                print(f"{name:<58} {case['mean_ms']:8.2f} {case['median_ms']:8.2f} {case['p95_ms']:8.2f} "
+                      f"{case['p99_ms']:8.2f} {case['max_ms']:8.2f} {case['ops_per_s']:8.1f}")
+
+    if output:
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {"runs": args.runs, "warmup": args.warmup, "sizes": sizes, "formats": formats,
+                         "cache": args.cache, "sheets": args.sheets, "seed": args.seed},
+            "results": results,
+        }
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {output}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"no regressions beyond {args.tolerance:.0%} against {baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,11 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
 import uuid
-from music21 import clef, note, stream, interval, meter
 from PIL import Image
-from music21 import environment
-environment.set('musescoreDirectPNGPath', '/Applications/MuseScore 4.app/Contents/MacOS/mscore')
+from keys import DEFAULT_KEY, get_key
+from artifact_store import ArtifactStore
+from render_jobs import RESPONSE_MODES, artifact_response, lines_spec, render_score
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://127.0.0.1:3001"}}, supports_credentials=True)
@@ -27,6 +27,13 @@ SONG_FOLDER = "songs"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SONG_FOLDER, exist_ok=True)
 
+# Rendered files are stored once per distinct song and evicted by age and total size
+song_store = ArtifactStore(
+    SONG_FOLDER,
+    max_bytes=int(os.environ.get("SONG_STORE_MAX_MB", 1024)) * 1024 * 1024,
+    ttl=int(os.environ.get("SONG_STORE_TTL", 7 * 24 * 3600)),
+)
+
 @app.route('/upload', methods=['POST'])
 def upload_photo():
     if 'photo' not in request.files:
@@ -36,181 +43,195 @@ def upload_photo():
     if photo.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
+    key = get_key(request.form.get('key', DEFAULT_KEY.name))
+    if key is None:
+        return jsonify({"error": f"Unknown key: {request.form.get('key')}"}), 400
+
+    response_mode = request.form.get('response', 'url')
+    if response_mode not in RESPONSE_MODES:
+        return jsonify({"error": f"Unknown response mode: {response_mode}"}), 400
+
+    if response_mode != 'url':
+        # Compose straight from the upload stream; the MIDI file never touches uploads/ or songs/
+        try:
+            spec = compose_score(photo.stream, key)
+            if spec is None:
+                return jsonify({"error": "Error generating song"}), 500
+            return artifact_response(spec, response_mode, None, sheet=request.form.get('sheet') == '1')
+        except Exception as e:
+            print(f"🔴 Error generating song: {str(e)}")
+            return jsonify({"error": "Error generating song"}), 500
+
     filename = str(uuid.uuid4()) + os.path.splitext(photo.filename)[1]
     photo_path = os.path.join(UPLOAD_FOLDER, filename)
     photo.save(photo_path)
 
-    song_path, sheet_path = generate_song(photo_path)
-    if not song_path:
+    song_filename, sheet_filename = generate_song(photo_path, key)
+    if not song_filename:
         return jsonify({"error": "Error generating song"}), 500
 
     return jsonify({
-        "songUrl": f"http://127.0.0.1:5000/songs/{os.path.basename(song_path)}",
-        "sheetMusicUrl": f"http://127.0.0.1:5000/songs/{os.path.basename(sheet_path)}"
+        "songUrl": f"http://127.0.0.1:5000/songs/{song_filename}",
+        "sheetMusicUrl": f"http://127.0.0.1:5000/songs/{sheet_filename}"
     })
 
-def generate_song(photo_path):
+def generate_song(photo_path, key=DEFAULT_KEY):
     try:
-        if not os.path.exists(photo_path):
-            print("🔴 File not found:", photo_path)
+        spec = compose_score(photo_path, key)
+        if spec is None:
             return None, None
+        return render_score(spec, song_store)  # music21 is only imported for the sheet music
+    except Exception as e:
+        print(f"🔴 Error generating first species counterpoint: {str(e)}")
+        return None, None
 
-        img = Image.open(photo_path).convert("L")
-        img = img.resize((10, 10))
-        pixel_values = list(img.getdata())
-        print("✅ Pixel Values:", pixel_values[:10])
-
-        tonic_pitch = 60
-        scale_degrees = [0, 2, 4, 5, 7, 9, 11]
-        leaps_used = 0
-        highest_note = tonic_pitch + max(scale_degrees)
-        highest_note_placed = False
-
-        score = stream.Score()
-        top_line = stream.Part()
-        bottom_line = stream.Part()
-        top_line.append(meter.TimeSignature("4/4"))
-        bottom_line.append(meter.TimeSignature("4/4"))
-
-        previous_pitch = None
-        second_last_pitch = None
-        previous_interval = None
-
-        for i in range(10):
-            if i == 0:
-                pitch = tonic_pitch
-                previous_interval = "P1"
-            elif i == 9:
-                valid_endings = [tonic_pitch, tonic_pitch + 7]
-                pitch = min(valid_endings, key=lambda p: abs(previous_pitch - p))
-            else:
-                valid_pitches = []
-                current_scale_step = scale_degrees.index((previous_pitch - tonic_pitch) % 12)
-                for step in [-1, 1, -2, 2]:
+def compose_score(photo_path, key=DEFAULT_KEY):
+    if isinstance(photo_path, (str, os.PathLike)) and not os.path.exists(photo_path):
+        print("🔴 File not found:", photo_path)
+        return None
+
+    img = Image.open(photo_path).convert("L")
+    img = img.resize((10, 10))
+    pixel_values = list(img.getdata())
+    print("✅ Pixel Values:", pixel_values[:10])
+
+    tonic_pitch = key.tonic_pitch
+    scale_degrees = key.scale
+    leaps_used = 0
+    highest_note = tonic_pitch + max(scale_degrees)
+    highest_note_placed = False
+
+    # Lines are kept as plain MIDI numbers until the score is written
+    top_line = []
+    bottom_line = []
+
+    previous_pitch = None
+    second_last_pitch = None
+    previous_interval = None
+
+    for i in range(10):
+        if i == 0:
+            pitch = tonic_pitch
+            previous_interval = "P1"
+        elif i == 9:
+            # The tonic or the fifth above it, when the mode has one (locrian does not)
+            valid_endings = [p for p in (tonic_pitch, tonic_pitch + 7) if p - tonic_pitch in scale_degrees]
+            pitch = min(valid_endings, key=lambda p: abs(previous_pitch - p))
+        else:
+            valid_pitches = []
+            current_scale_step = scale_degrees.index((previous_pitch - tonic_pitch) % 12)
+            for step in [-1, 1, -2, 2]:
+                next_step = current_scale_step + step
+                if 0 <= next_step < len(scale_degrees):
+                    candidate_pitch = tonic_pitch + scale_degrees[next_step]
+                    if candidate_pitch == previous_pitch == second_last_pitch:
+                        continue
+                    if abs(candidate_pitch - previous_pitch) > 2 and leaps_used >= 1:
+                        continue
+                    if candidate_pitch == highest_note and (highest_note_placed or abs(candidate_pitch - previous_pitch) > 2):
+                        continue
+                    if key.is_perfect(previous_pitch, candidate_pitch) and previous_interval in ["P1", "P5", "P8"]:
+                        continue
+                    valid_pitches.append(candidate_pitch)
+            if not valid_pitches:
+                for step in [-1, 1]:
                     next_step = current_scale_step + step
                     if 0 <= next_step < len(scale_degrees):
-                        candidate_pitch = tonic_pitch + scale_degrees[next_step]
-                        if candidate_pitch == previous_pitch == second_last_pitch:
-                            continue
-                        if abs(candidate_pitch - previous_pitch) > 2 and leaps_used >= 1:
-                            continue
-                        if candidate_pitch == highest_note and (highest_note_placed or abs(candidate_pitch - previous_pitch) > 2):
-                            continue
-                        interval_obj = interval.Interval(note.Note(previous_pitch), note.Note(candidate_pitch))
-                        if interval_obj.name in ["P1", "P5", "P8"] and previous_interval in ["P1", "P5", "P8"]:
-                            continue
-                        valid_pitches.append(candidate_pitch)
-                if not valid_pitches:
-                    for step in [-1, 1]:
-                        next_step = current_scale_step + step
-                        if 0 <= next_step < len(scale_degrees):
-                            valid_pitches.append(tonic_pitch + scale_degrees[next_step])
-                pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
-                interval_obj = interval.Interval(note.Note(previous_pitch), note.Note(pitch))
-                previous_interval = interval_obj.name
-                if abs(pitch - previous_pitch) > 2:
-                    leaps_used += 1
-            if pitch == highest_note:
-                highest_note_placed = True
-            second_last_pitch = previous_pitch
-            previous_pitch = pitch
-            top_line.append(note.Note(pitch, quarterLength=4))
-
-        print("✅ Top Line Pitches:", [n.pitch.midi for n in top_line.notes])
-
-        previous_cf_pitch = None
-        repeated_static_count = 0
-        static_pitch_memory = {}
-
-        # In your generate_song function, inside the loop where bottom line notes are generated
-        # In your generate_song function, inside the loop where bottom line notes are generated
-
-        # Track the frequency of pitches in the bottom line
-        bottom_pitch_counts = {}
-
-        for i, top_note in enumerate(top_line.notes):
-            top_pitch = top_note.pitch.midi
-            if i == 0 or i == 9:
-                cf_pitch = tonic_pitch
+                        valid_pitches.append(tonic_pitch + scale_degrees[next_step])
+            pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
+            previous_interval = key.interval_name(previous_pitch, pitch)
+            if abs(pitch - previous_pitch) > 2:
+                leaps_used += 1
+        if pitch == highest_note:
+            highest_note_placed = True
+        second_last_pitch = previous_pitch
+        previous_pitch = pitch
+        top_line.append(pitch)
+
+    print("✅ Top Line Pitches:", top_line)
+
+    previous_cf_pitch = None
+    repeated_static_count = 0
+    static_pitch_memory = {}
+
+    # In your generate_song function, inside the loop where bottom line notes are generated
+    # In your generate_song function, inside the loop where bottom line notes are generated
+
+    # Track the frequency of pitches in the bottom line
+    bottom_pitch_counts = {}
+
+    for i, top_pitch in enumerate(top_line):
+        if i == 0 or i == 9:
+            cf_pitch = tonic_pitch
+        else:
+            valid_cf_pitches = []
+            for degree in scale_degrees:
+                pitch = tonic_pitch + degree
+                if not (tonic_pitch - 12 <= pitch <= tonic_pitch + 12):
+                    continue
+                interval_semitones = abs(pitch - top_pitch)
+                if interval_semitones not in [0, 3, 4, 7, 8, 9]:
+                    continue
+
+                # Prevent unison, perfect 5th, or octave
+                if key.is_perfect(top_pitch, pitch):  # Unison, perfect 5th, or octave
+                    continue
+
+                # Avoid the tonic in the middle of the melody
+                if tonic_pitch == pitch and 1 <= i <= 8:  # Prevent tonic from being used between notes 1 and 8
+                    continue
+
+                # Apply repetition penalty
+                repetition_factor = bottom_pitch_counts.get(pitch, 0) / max(1, len(bottom_line))
+                repetition_penalty = repetition_factor * 10  # You can adjust this penalty value
+                score_val = -repetition_penalty
+
+                if previous_cf_pitch is not None:
+                    motion = pitch - previous_cf_pitch
+                    top_motion = top_pitch - top_line[i - 1]
+                    if (motion > 0 and top_motion < 0) or (motion < 0 and top_motion > 0):
+                        score_val -= 3
+                    if abs(motion) <= 2:
+                        score_val -= 2
+                    if abs(motion) > 7:
+                        score_val += 5
+                    if motion == 0:
+                        score_val -= 1
+                        if repeated_static_count >= 2:
+                            score_val += 10  # heavy penalty for too many repeats
+                        if static_pitch_memory.get(pitch, 0) >= 2:
+                            score_val += 5  # penalize if pitch already repeated twice
+
+                valid_cf_pitches.append((pitch, score_val))
+            
+            if valid_cf_pitches:
+                cf_pitch = min(valid_cf_pitches, key=lambda x: x[1])[0]
             else:
-                valid_cf_pitches = []
-                for degree in scale_degrees:
-                    pitch = tonic_pitch + degree
-                    if not (48 <= pitch <= 72):
-                        continue
-                    interval_semitones = abs(pitch - top_pitch)
-                    if interval_semitones not in [0, 3, 4, 7, 8, 9]:
-                        continue
+                cf_pitch = tonic_pitch
 
-                    # Prevent unison, perfect 5th, or octave
-                    interval_obj = interval.Interval(note.Note(top_pitch), note.Note(pitch))
-                    if interval_obj.name in ["P1", "P5", "P8"]:  # Unison, perfect 5th, or octave
-                        continue
+        # Update the bottom_pitch_counts and check for repeated notes
+        bottom_pitch_counts[cf_pitch] = bottom_pitch_counts.get(cf_pitch, 0) + 1
 
-                    # Avoid the tonic in the middle of the melody
-                    if tonic_pitch == pitch and 1 <= i <= 8:  # Prevent tonic from being used between notes 1 and 8
-                        continue
+        if previous_cf_pitch is not None and cf_pitch == previous_cf_pitch:
+            repeated_static_count += 1
+            static_pitch_memory[cf_pitch] = static_pitch_memory.get(cf_pitch, 0) + 1
+        else:
+            repeated_static_count = 0
 
-                    # Apply repetition penalty
-                    repetition_factor = bottom_pitch_counts.get(pitch, 0) / max(1, len(bottom_line.notes))
-                    repetition_penalty = repetition_factor * 10  # You can adjust this penalty value
-                    score_val = -repetition_penalty
-
-                    if previous_cf_pitch is not None:
-                        motion = pitch - previous_cf_pitch
-                        top_motion = top_pitch - top_line.notes[i - 1].pitch.midi
-                        if (motion > 0 and top_motion < 0) or (motion < 0 and top_motion > 0):
-                            score_val -= 3
-                        if abs(motion) <= 2:
-                            score_val -= 2
-                        if abs(motion) > 7:
-                            score_val += 5
-                        if motion == 0:
-                            score_val -= 1
-                            if repeated_static_count >= 2:
-                                score_val += 10  # heavy penalty for too many repeats
-                            if static_pitch_memory.get(pitch, 0) >= 2:
-                                score_val += 5  # penalize if pitch already repeated twice
-
-                    valid_cf_pitches.append((pitch, score_val))
-                
-                if valid_cf_pitches:
-                    cf_pitch = min(valid_cf_pitches, key=lambda x: x[1])[0]
-                else:
-                    cf_pitch = tonic_pitch
-
-            # Update the bottom_pitch_counts and check for repeated notes
-            bottom_pitch_counts[cf_pitch] = bottom_pitch_counts.get(cf_pitch, 0) + 1
-
-            if previous_cf_pitch is not None and cf_pitch == previous_cf_pitch:
-                repeated_static_count += 1
-                static_pitch_memory[cf_pitch] = static_pitch_memory.get(cf_pitch, 0) + 1
-            else:
-                repeated_static_count = 0
-
-            bottom_line.append(note.Note(cf_pitch, quarterLength=4))
-            previous_cf_pitch = cf_pitch
-
-
-        print("✅ Bottom Line Pitches:", [n.pitch.midi for n in bottom_line.notes])
-        score.append(top_line)
-        score.append(bottom_line)
-        song_filename = str(uuid.uuid4()) + ".mid"
-        sheet_filename = str(uuid.uuid4()) + ".png"
-        song_path = os.path.join("songs", song_filename)
-        sheet_path = os.path.join("songs", sheet_filename)
-        score.write("midi", fp=song_path)
-        score.write("musicxml.png", fp=sheet_path)
-        return song_path, sheet_path
-    except Exception as e:
-        print(f"🔴 Error generating first species counterpoint: {str(e)}")
-        return None, None
+        bottom_line.append(cf_pitch)
+        previous_cf_pitch = cf_pitch
+
+
+    print("✅ Bottom Line Pitches:", bottom_line)
+
+    return lines_spec([top_line, bottom_line], quarter_length=4, time_signature="4/4", key_name=key.name)
 
 @app.route('/songs/<filename>', methods=['GET'])
 def get_song(filename):
-    song_path = os.path.join(SONG_FOLDER, filename)
-    if os.path.exists(song_path):
-        return send_file(song_path, as_attachment=True)
+    # Conditional GET: a matching If-None-Match / If-Modified-Since gets a 304
+    response = song_store.send(filename)
+    if response is not None:
+        return response
     return jsonify({"error": "Song not found"}), 404
 
 if __name__ == '__main__':
@@ -0,0 +1,16 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app` run from this folder
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5002)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# Import the app once in the master so workers share its modules and lookup tables copy-on-write.
+# Nothing opens sockets, pools or database connections at import, so forking after it is safe.
+preload_app = True
+
+
+def when_ready(server):
+    # Keep the preloaded objects out of the garbage collector's way, so collections in the
+    # workers do not write to (and un-share) those pages
+    gc.freeze()
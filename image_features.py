@@ -0,0 +1,95 @@
+"""
+Whole-photo features for the top line.
+
+sample_pixels shrinks the photo to a grid of at least 10x10, and the top line
+then pops one value per note from the end of it: a 10-note song reads 8 of
+100 pixels, so photos that only differ elsewhere get the same song.
+
+extract_features decodes and reduces the photo exactly like the fast sampling
+path and computes everything with NumPy block reductions over the reduced
+image as it is, without resizing it again: the grid cells are the nearest
+whole-pixel blocks, at least OVERSAMPLE pixels a side. Only the full-decode
+path (fast=False), and photos smaller than that, are resized first.
+
+    cells        mean luminance of every grid cell
+    spread       standard deviation inside every cell
+    edges        mean absolute luminance gradient inside every cell
+    rows/columns mean luminance of every row and column of cells
+    histogram    share of pixels in each of HISTOGRAM_BINS luminance bands
+    edge_energy  mean absolute gradient over the whole photo
+
+note_values turns them into one value per note. The cells are split, in
+reading order, into as many contiguous runs as there are notes, and each
+note's value mixes its run's luminance, spread and edges with a global offset
+from the histogram, edge energy and the row/column profiles. Every pixel of
+the reduced photo therefore reaches the song.
+"""
+import numpy as np
+from PIL import ImageStat
+
+from image_sampling import OVERSAMPLE, grid_for_length, open_image, reduce_for_grid
+
+HISTOGRAM_BINS = 16
+
+
+class ImageFeatures:
+    def __init__(self, luminance, side, levels, colour=None):
+        # levels is the 256-level histogram of `luminance`, as PIL's Image.histogram() counts it
+        self.side = side
+        self.colour = colour  # Average (r, g, b), when asked for
+        height, width = luminance.shape
+        row_starts = np.arange(side) * height // side
+        column_starts = np.arange(side) * width // side
+        counts = np.outer(np.diff(np.append(row_starts, height)), np.diff(np.append(column_starts, width)))
+
+        def block_means(values):
+            sums = np.add.reduceat(np.add.reduceat(values, row_starts, axis=0), column_starts, axis=1)
+            return sums / counts
+
+        self.cells = block_means(luminance)
+        self.spread = np.sqrt(np.maximum(block_means(luminance * luminance) - self.cells * self.cells, 0))
+
+        # Horizontal and vertical gradients, padded back to full size so they block up like the pixels
+        gradient = np.zeros_like(luminance)
+        gradient[:, 1:] += np.abs(np.diff(luminance, axis=1))
+        gradient[1:, :] += np.abs(np.diff(luminance, axis=0))
+        self.edges = block_means(gradient)
+        self.edge_energy = float(gradient.mean())
+
+        self.rows = self.cells.mean(axis=1)
+        self.columns = self.cells.mean(axis=0)
+        self.histogram = np.add.reduceat(np.asarray(levels), np.arange(0, 256, 256 // HISTOGRAM_BINS)) / luminance.size
+
+    def note_values(self, count):
+        """Return `count` values (0-255) for the top line to choose pitches from, covering every cell."""
+        per_cell = (self.cells + self.spread + self.edges).ravel()
+        starts = np.arange(count) * per_cell.size // count
+        runs = np.add.reduceat(per_cell, starts) / np.diff(np.append(starts, per_cell.size))
+
+        offset = (int(np.argmax(self.histogram)) + int(self.edge_energy)
+                  + int(np.argmax(self.rows)) + int(np.argmax(self.columns)))
+        # Four steps per luminance level, so small differences anywhere still move a note
+        return [int(value) & 0xFF for value in (runs * 4).astype(np.int64) + offset]
+
+
+def extract_features(photo, length, fast=True, colour=False):
+    """
+    Return the ImageFeatures of a photo for a song of `length` notes.
+
+    fast=False decodes the whole photo first, as sample_pixels(fast=False) does. colour=True also
+    records the photo's average colour (for key=auto), at the cost of decoding in RGB.
+    """
+    side = grid_for_length(length)[0]
+    img = open_image(photo)
+    mode = "RGB" if colour else "L"
+    if fast:
+        img = reduce_for_grid(img, (side, side), mode=mode)
+    img = img.convert(mode)
+    if not fast or min(img.size) < side * OVERSAMPLE:
+        img = img.resize((side * OVERSAMPLE, side * OVERSAMPLE))
+
+    average = None
+    if colour:
+        average = tuple(ImageStat.Stat(img).mean)
+        img = img.convert("L")
+    return ImageFeatures(np.asarray(img, dtype=np.float64), side, img.histogram(), average)
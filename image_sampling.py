@@ -0,0 +1,97 @@
+"""
+Turn an uploaded photo into the small greyscale pixel grid the generators read.
+
+The original path decodes the whole photo, converts every pixel to greyscale
+and only then shrinks it to the grid. The fast path asks libjpeg for a DCT
+scaled greyscale decode (Image.draft), box-reduces what is left by an integer
+factor (Image.reduce) and runs the final resize on an image only a few times
+larger than the grid, so the cost follows the grid size rather than the photo's
+megapixels. Non-JPEG formats skip the draft step but still get the reduce.
+
+sample_pixels_and_colour does the same in colour and also returns the average
+colour of the photo, which picks the key when a request asks for key=auto.
+"""
+import math
+
+from PIL import Image, ImageStat
+
+GRID_SIZE = (10, 10)
+
+# Keep the reduced image at least this many times larger than the grid so the
+# final resize still averages over the whole photo
+OVERSAMPLE = 4
+
+# Modes Image.reduce can work on directly; anything else is converted first
+_REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "RGBa", "CMYK", "YCbCr", "I", "F")
+
+
+def grid_for_length(notes):
+    """Return the smallest square grid, no smaller than GRID_SIZE, with a pixel for every note."""
+    side = max(GRID_SIZE[0], math.isqrt(max(notes, 1) - 1) + 1)
+    return (side, side)
+
+
+def open_image(photo):
+    # Accept a path, a file-like object (e.g. an upload stream) or an already opened image
+    if isinstance(photo, Image.Image):
+        return photo
+    return Image.open(photo)
+
+
+def reduce_for_grid(img, size=GRID_SIZE, mode="L"):
+    """Cheaply shrink an opened (not yet loaded) image to a few times the grid size."""
+    target = (size[0] * OVERSAMPLE, size[1] * OVERSAMPLE)
+
+    # JPEG only: decode at 1/2, 1/4 or 1/8 scale, straight into greyscale (or RGB)
+    img.draft(mode, target)
+
+    if img.mode not in _REDUCIBLE_MODES:
+        img = img.convert(mode)
+
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
+
+
+def sample_pixels(photo, size=GRID_SIZE, fast=True):
+    """
+    Return the greyscale values of the photo resized to `size`, row by row.
+
+    fast=False follows the original full decode -> convert("L") -> resize path.
+    """
+    img = open_image(photo)
+    if fast:
+        img = reduce_for_grid(img, size)
+    img = img.convert("L").resize(size)
+    return list(img.getdata())
+
+
+def sample_pixels_and_colour(photo, size=GRID_SIZE, fast=True):
+    """
+    Return the greyscale values of the photo resized to `size` and its average (r, g, b) colour.
+
+    The grid is converted to greyscale from the colour grid, so it can differ by a level or so
+    from sample_pixels, which (for JPEGs) decodes the greyscale channel directly.
+    """
+    img = open_image(photo)
+    if fast:
+        img = reduce_for_grid(img, size, mode="RGB")
+    img = img.convert("RGB").resize(size)
+    colour = tuple(ImageStat.Stat(img).mean)
+    return list(img.convert("L").getdata()), colour
+
+
+def compare_sampling(photo, size=GRID_SIZE):
+    """
+    Sample the photo through both paths and return (exact_pixels, fast_pixels).
+
+    `photo` must be a path or a seekable file-like object, since it is decoded twice.
+    """
+    if hasattr(photo, "seek"):
+        photo.seek(0)
+    exact = sample_pixels(photo, size, fast=False)
+    if hasattr(photo, "seek"):
+        photo.seek(0)
+    fast = sample_pixels(photo, size, fast=True)
+    return exact, fast
@@ -0,0 +1,222 @@
+"""
+Keys and modes for the generators: all 12 tonics in the seven church modes.
+
+Every key is built at import. Each one holds its scale, its top-line
+candidates, and the name and diatonic (letter) index of every MIDI pitch as
+spelled in that key. The spelling uses whichever of the enharmonic tonics
+needs fewer accidentals, e.g. Db major rather than C# major. Spellings are
+worked out once per version of this file and memory-mapped from then on
+(shared_tables.py).
+
+Spelling the key properly is what makes its intervals right: in Ab major,
+Eb-Ab is a fourth, where the default MIDI spelling (E-, G#) would call it an
+augmented third. Once two pitches are spelled, their interval, and so whether
+it is consonant, depends only on its size in letter steps and in semitones.
+That gives one small table shared by every key, so adding keys adds no work
+per request. Pitches outside the key fall back to pitch_math's default
+spelling.
+
+key_for_colour picks a key from a photo's average colour: bright photos are
+major and dark ones minor, and the hue chooses the tonic around the circle of
+fifths (red is C, orange G, ..., so neighbouring hues give related keys).
+"""
+import colorsys
+from array import array
+
+import pitch_math
+from pitch_math import CONSONANT_INTERVALS, MIDI_RANGE, NOTE_NAMES, PERFECT_INTERVALS, PITCH_CLASS_NAMES, spell_interval
+from shared_tables import load_tables, source_fingerprint
+
+# Semitones above the tonic of each scale degree
+MODES = {
+    "major": (0, 2, 4, 5, 7, 9, 11),
+    "dorian": (0, 2, 3, 5, 7, 9, 10),
+    "phrygian": (0, 1, 3, 5, 7, 8, 10),
+    "lydian": (0, 2, 4, 6, 7, 9, 11),
+    "mixolydian": (0, 2, 4, 5, 7, 9, 10),
+    "minor": (0, 2, 3, 5, 7, 8, 10),
+    "locrian": (0, 1, 3, 5, 6, 8, 10),
+}
+MODE_ALIASES = {"ionian": "major", "aeolian": "minor"}
+
+TONIC_OCTAVE = 60  # Tonics sit between middle C and the B above it
+
+_LETTERS = "CDEFGAB"
+_NATURALS = (0, 2, 4, 5, 7, 9, 11)
+_ACCIDENTALS = {-2: "--", -1: "-", 0: "", 1: "#", 2: "##"}  # music21's spelling, as in note names
+_TONIC_ACCIDENTALS = {-1: "b", 0: "", 1: "#"}  # Key names read the usual way
+
+
+def _build_intervals():
+    # Interval names by (letter steps, semitones), for every size two spelled pitches can be apart
+    intervals = {}
+    for steps in range(MIDI_RANGE * 7 // 12 + 1):
+        major = _NATURALS[steps % 7] + 12 * (steps // 7)
+        for offset in (-2, -1, 0, 1, 2):
+            try:
+                intervals[(steps, major + offset)] = spell_interval(steps, major + offset)
+            except KeyError:
+                pass  # No quality name that far from the major/perfect size
+    return intervals
+
+
+_INTERVALS = _build_intervals()
+_CONSONANT_SIZES = frozenset(size for size, name in _INTERVALS.items() if name in CONSONANT_INTERVALS)
+_PERFECT_SIZES = frozenset(size for size, name in _INTERVALS.items() if name in PERFECT_INTERVALS)
+
+
+def _alter(pitch_class, letter):
+    # Accidental (-2..2) that turns `letter` into `pitch_class`, or None if it would need more
+    alter = (pitch_class - _NATURALS[letter] + 6) % 12 - 6
+    return alter if -2 <= alter <= 2 else None
+
+
+def _spell_scale(pitch_class, scale):
+    # Choose the tonic letter whose scale needs the fewest accidentals; ties keep the default name
+    best = None
+    for letter in range(7):
+        alters = [_alter((pitch_class + degree) % 12, (letter + step) % 7) for step, degree in enumerate(scale)]
+        if None in alters or abs(alters[0]) > 1:
+            continue
+        cost = (sum(abs(alter) for alter in alters),
+                _LETTERS[letter] + _ACCIDENTALS[alters[0]] != PITCH_CLASS_NAMES[pitch_class])
+        if best is None or cost < best[0]:
+            best = (cost, letter, alters)
+    return best[1], best[2]
+
+
+def _spell_key(pitch_class, mode):
+    # Tonic name, then the name and diatonic (letter) index of every MIDI pitch (-1 outside the key)
+    scale = MODES[mode]
+    letter, alters = _spell_scale(pitch_class, scale)
+    names = list(NOTE_NAMES)
+    diatonic = array("h", [-1] * MIDI_RANGE)
+    for step, degree in enumerate(scale):
+        step_letter = (letter + step) % 7
+        for pitch in range((pitch_class + degree) % 12, MIDI_RANGE, 12):
+            natural = pitch - alters[step]
+            diatonic[pitch] = (natural // 12) * 7 + step_letter
+            names[pitch] = (_LETTERS[step_letter] + _ACCIDENTALS[alters[step]]
+                            + (str(natural // 12 - 1) if pitch >= 12 else ""))
+    return _LETTERS[letter] + _TONIC_ACCIDENTALS[alters[0]], names, diatonic
+
+
+class Key:
+    def __init__(self, pitch_class, mode, tonic_name, note_names, diatonic):
+        self.mode = mode
+        self.scale = MODES[mode]
+        self.pitch_class = pitch_class
+        self.tonic_pitch = TONIC_OCTAVE + pitch_class
+        self.tonic_name = tonic_name
+        self.name = f"{self.tonic_name} {mode}"
+
+        # Pitches the top line picks from
+        self.top_candidates = tuple(self.tonic_pitch + degree for degree in self.scale)
+
+        self.note_names = tuple(note_names)
+        self._diatonic = diatonic
+
+    def __repr__(self):
+        return f"Key({self.name!r})"
+
+    def _size(self, start, end):
+        # (letter steps, semitones) of the ascending interval, or None if either pitch is outside the key
+        low, high = self._diatonic[start], self._diatonic[end]
+        if low < 0 or high < 0 or start < 12 or end < 12:
+            return None
+        steps, semitones = high - low, end - start
+        if steps < 0:
+            steps, semitones = -steps, -semitones
+        return steps, semitones
+
+    def note_name(self, midi):
+        """Return the name with octave of a MIDI pitch as spelled in this key, e.g. 63 -> "E-4" in Bb major."""
+        return self.note_names[midi]
+
+    def interval_name(self, start, end):
+        """Return the name of the interval between two MIDI pitches as spelled in this key."""
+        size = self._size(start, end)
+        name = _INTERVALS.get(size) if size else None
+        return name if name else pitch_math.interval_name(start, end)
+
+    def is_consonant(self, start, end):
+        """Return True if the interval between two MIDI pitches is a first species consonance in this key."""
+        size = self._size(start, end)
+        if size is None:
+            return pitch_math.is_consonant(start, end)
+        return size in _CONSONANT_SIZES
+
+    def is_perfect(self, start, end):
+        """Return True if the interval between two MIDI pitches is a unison, fifth or octave in this key."""
+        size = self._size(start, end)
+        if size is None:
+            return pitch_math.is_perfect(start, end)
+        return size in _PERFECT_SIZES
+
+    def __reduce__(self):
+        # Keys are shared singletons; pickling (e.g. into batch worker processes) sends the name
+        return get_key, (self.name,)
+
+
+_KEY_ORDER = tuple((pitch_class, mode) for mode in MODES for pitch_class in range(12))
+
+
+def _build_key_tables():
+    spelled = [_spell_key(pitch_class, mode) for pitch_class, mode in _KEY_ORDER]
+    diatonic = array("h")
+    for _, _, key_diatonic in spelled:
+        diatonic.extend(key_diatonic)
+    # One space-separated string of note names per key decodes far faster than 10,000 JSON strings
+    return {"diatonic": diatonic}, {"tonic_names": [s[0] for s in spelled], "note_names": [" ".join(s[1]) for s in spelled]}
+
+
+# Spellings are built once per version of this file and pitch_math.py, then memory-mapped (shared_tables)
+_tables, _values = load_tables("keys", source_fingerprint(__file__, pitch_math.__file__), _build_key_tables)
+KEYS = {
+    key.name: key for key in (
+        Key(pitch_class, mode, _values["tonic_names"][i], _values["note_names"][i].split(" "),
+            _tables["diatonic"][i * MIDI_RANGE:(i + 1) * MIDI_RANGE])
+        for i, (pitch_class, mode) in enumerate(_KEY_ORDER)
+    )
+}
+_KEYS_BY_PITCH_CLASS = {(key.pitch_class, key.mode): key for key in KEYS.values()}
+DEFAULT_KEY = KEYS["C major"]
+
+# Tonic spellings get_key accepts, lower-cased: "c", "c#", "db", "d-", ...
+_TONICS = {
+    (letter + suffix).lower(): (natural + alter) % 12
+    for letter, natural in zip(_LETTERS, _NATURALS)
+    for suffix, alter in (("", 0), ("#", 1), ("b", -1), ("-", -1))
+}
+
+
+def get_key(name):
+    """
+    Return the Key for a name such as "D dorian", "Bb minor", "B- aeolian" or "f# major",
+    or None if the name is not a key. A tonic on its own means major.
+    """
+    parts = name.strip().split()
+    if not 1 <= len(parts) <= 2:
+        return None
+    pitch_class = _TONICS.get(parts[0].lower())
+    mode = parts[1].lower() if len(parts) == 2 else "major"
+    mode = MODE_ALIASES.get(mode, mode)
+    if pitch_class is None or mode not in MODES:
+        return None
+    return _KEYS_BY_PITCH_CLASS[(pitch_class, mode)]
+
+
+# Below this average saturation a photo is treated as black and white and stays in C
+MIN_SATURATION = 0.08
+
+
+def key_for_colour(rgb):
+    """Pick a key from a photo's average (r, g, b) colour: brightness sets the mode, hue the tonic."""
+    r, g, b = (channel / 255 for channel in rgb)
+    brightness = 0.299 * r + 0.587 * g + 0.114 * b
+    mode = "major" if brightness >= 0.5 else "minor"
+    hue, _, saturation = colorsys.rgb_to_hls(r, g, b)
+    if saturation < MIN_SATURATION:
+        return _KEYS_BY_PITCH_CLASS[(0, mode)]
+    sector = int(hue * 12 + 0.5) % 12
+    return _KEYS_BY_PITCH_CLASS[(sector * 7 % 12, mode)]
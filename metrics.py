@@ -0,0 +1,144 @@
+"""
+In-process latency histograms and counters, rendered in the Prometheus text format.
+
+Each metric keeps one row of counts per label combination behind a lock, so
+observing is a bisect and a few additions. Every gunicorn worker keeps its own
+numbers, and a scrape through the load balancer sees whichever worker answered.
+Sum the series per instance (or scrape workers directly) when that matters.
+
+Work done in another process (the /upload/batch pool) is measured there with
+recording() and sent back with its result, and replay() adds it here.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; tuned for stages that take from tens of microseconds to a few seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+_recording = threading.local()
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, seconds, *labelvalues):
+        _record(self.name, labelvalues, seconds)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(counts) for labels, counts in self._series.items()}
+        for labelvalues, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == "+Inf" else _number(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        _record(self.name, labelvalues, amount)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}")
+        return lines
+
+
+def _record(name, labelvalues, value):
+    log = getattr(_recording, "log", None)
+    if log is not None:
+        log.append((name, labelvalues, value))
+
+
+@contextmanager
+def recording():
+    """Collect the observations and increments this thread makes, as (name, label values, value) tuples."""
+    _recording.log = log = []
+    try:
+        yield log
+    finally:
+        _recording.log = None
+
+
+def replay(records):
+    """Apply observations collected by recording() (in any process) to this process's metrics."""
+    by_name = {metric.name: metric for metric in REGISTRY}
+    for name, labelvalues, value in records:
+        metric = by_name.get(name)
+        if isinstance(metric, Histogram):
+            metric.observe(value, *labelvalues)
+        elif isinstance(metric, Counter):
+            metric.inc(*labelvalues, amount=value)
+
+
+def sample_lines(name, documentation, value, kind="gauge"):
+    """Render a single unlabelled value kept elsewhere (e.g. cache statistics) at scrape time."""
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {_number(value)}"]
+
+
+def render(extra_lines=()):
+    """Return every registered metric (plus `extra_lines`) as a Prometheus text exposition."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
+
@@ -0,0 +1,85 @@
+"""
+Minimal Standard MIDI File writer for the generated songs.
+
+Building a music21 Score only to call score.write("midi") runs the whole
+stream-to-MIDI translation for a couple of dozen notes. The songs here are
+single-note lines on one channel, so the file can be written directly. The
+layout matches what music21 writes for the same parts: format 1, a conductor
+track with tempo and time signature, then one track per line.
+"""
+import struct
+
+TICKS_PER_QUARTER = 10080  # Same resolution music21 writes
+MICROSECONDS_PER_QUARTER = 500000  # 120 bpm, music21's default tempo
+DEFAULT_VELOCITY = 90
+DEFAULT_TIME_SIGNATURE = "4/4"
+
+_END_OF_TRACK = b"\xff\x2f\x00"
+
+
+def _var_length(value):
+    # MIDI variable-length quantity: 7 bits per byte, high bit set on all but the last
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(encoded)
+
+
+def _ticks(quarter_length):
+    return int(round(quarter_length * TICKS_PER_QUARTER))
+
+
+def _chunk(events):
+    return b"MTrk" + struct.pack(">I", len(events)) + events
+
+
+def _time_signature_event(time_signature):
+    numerator, denominator = (int(v) for v in time_signature.split("/"))
+    return b"\xff\x58\x04" + bytes([numerator, denominator.bit_length() - 1, 24, 8])
+
+
+def _conductor_track(total_ticks, time_signature):
+    events = bytearray(b"\x00\xff\x51\x03" + MICROSECONDS_PER_QUARTER.to_bytes(3, "big"))
+    events += b"\x00" + _time_signature_event(time_signature or DEFAULT_TIME_SIGNATURE)
+    if time_signature:
+        # music21 repeats an explicit time signature at the end of the piece
+        events += _var_length(total_ticks) + _time_signature_event(time_signature)
+    events += _var_length(TICKS_PER_QUARTER) + _END_OF_TRACK
+    return _chunk(bytes(events))
+
+
+def _line_track(notes, channel, velocity):
+    # Empty track name, pitch bend centred, then one note-on/note-off pair per note
+    events = bytearray(b"\x00\xff\x03\x00")
+    events += bytes([0x00, 0xE0 | channel, 0x00, 0x40])
+    for pitch, quarter_length in notes:
+        events += bytes([0x00, 0x90 | channel, pitch, velocity])
+        events += _var_length(_ticks(quarter_length)) + bytes([0x80 | channel, pitch, 0x00])
+    events += _var_length(TICKS_PER_QUARTER) + _END_OF_TRACK
+    return _chunk(bytes(events))
+
+
+def midi_bytes(lines, time_signature=None, velocity=DEFAULT_VELOCITY, channel=0):
+    """
+    Return a Standard MIDI File for the given lines.
+
+    Each line is a sequence of (midi_pitch, quarter_length) pairs played one after another.
+    """
+    total_ticks = max((sum(_ticks(ql) for _, ql in line) for line in lines), default=0)
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(lines) + 1, TICKS_PER_QUARTER)
+    tracks = [_conductor_track(total_ticks, time_signature)]
+    tracks.extend(_line_track(line, channel, velocity) for line in lines)
+    return header + b"".join(tracks)
+
+
+def write_midi(fp, lines, time_signature=None, velocity=DEFAULT_VELOCITY, channel=0):
+    """Write the MIDI file for `lines` to a path or a binary file-like object."""
+    data = midi_bytes(lines, time_signature, velocity, channel)
+    if hasattr(fp, "write"):
+        fp.write(data)
+    else:
+        with open(fp, "wb") as f:
+            f.write(data)
+    return data
@@ -0,0 +1,87 @@
+"""
+Serialization of generated songs for the /upload responses.
+
+noteData is built from the song's keys.Key, whose spellings and interval names
+are precomputed tables, so no note name or interval is ever worked out while
+responding. It comes in two shapes:
+
+    rows      {"key": "C major",
+               "topLine": [{"pitch", "note", "duration"}, ...],
+               "bottomLine": [{"pitch", "note", "duration", "interval"}, ...]}
+    columnar  {"format": "columnar", "key": "C major", "duration": 4.0,
+               "top": {"pitch": [...], "note": [...]},
+               "bottom": {"pitch": [...], "note": [...], "interval": [...]}}
+
+Rows are what existing clients read. Columnar repeats no keys and sends the
+duration every note shares once, which cuts the payload to a third or less.
+
+FastJSONProvider serializes responses with orjson when it is installed and
+falls back to Flask's own encoder otherwise (or for anything orjson rejects).
+It keeps Flask's sorted keys and compact/debug layout, so the bytes match
+what jsonify wrote before except that non-ASCII text is sent as UTF-8.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NOTE_FORMATS = ("rows", "columnar")
+
+
+def columnar_note_data(note_data, duration):
+    """Turn row-shaped noteData into parallel arrays."""
+    top, bottom = note_data["topLine"], note_data["bottomLine"]
+    return {
+        "format": "columnar",
+        "key": note_data["key"],
+        "duration": duration,
+        "top": {
+            "pitch": [note["pitch"] for note in top],
+            "note": [note["note"] for note in top],
+        },
+        "bottom": {
+            "pitch": [note["pitch"] for note in bottom],
+            "note": [note["note"] for note in bottom],
+            "interval": [note["interval"] for note in bottom],
+        },
+    }
+
+
+def format_note_data(note_data, note_format, duration):
+    """Return noteData in the requested format ('rows' is the stored shape)."""
+    if note_format == "columnar":
+        return columnar_note_data(note_data, duration)
+    return note_data
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def _orjson_options(self, indent=False):
+        # Dates and dataclasses go through Flask's default() so they serialize as they always have
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            try:
+                return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode()
+            except TypeError:
+                pass  # e.g. non-string dict keys or integers beyond 64 bits
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            data = orjson.dumps(obj, default=self.default, option=self._orjson_options(indent))
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
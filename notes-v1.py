@@ -1,13 +1,13 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
 import uuid
-from music21 import clef, note, stream, interval
 
 from PIL import Image
 from PIL import Image
-from music21 import environment
-environment.set('musescoreDirectPNGPath', '/Applications/MuseScore 4.app/Contents/MacOS/mscore')
+from artifact_store import ArtifactStore
+from keys import DEFAULT_KEY, get_key
+from render_jobs import RESPONSE_MODES, RenderQueue, artifact_response, lines_spec, render_score
 
 app = Flask(__name__)
 
@@ -33,6 +33,21 @@ SONG_FOLDER = "songs"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SONG_FOLDER, exist_ok=True)
 
+# Rendered files are stored once per distinct song and evicted by age and total size
+song_store = ArtifactStore(
+    SONG_FOLDER,
+    max_bytes=int(os.environ.get("SONG_STORE_MAX_MB", 1024)) * 1024 * 1024,
+    ttl=int(os.environ.get("SONG_STORE_TTL", 7 * 24 * 3600)),
+)
+
+# Set RENDER_JOBS=1 to return a job id from /upload and render files in the background
+app.config['RENDER_JOBS'] = os.environ.get("RENDER_JOBS", "0") == "1"
+render_queue = RenderQueue(
+    os.environ.get("RENDER_JOBS_DB", "render_jobs.db"),
+    song_store,
+    max_workers=int(os.environ.get("RENDER_WORKERS", 2)),
+)
+
 @app.route('/upload', methods=['POST'])
 def upload_photo():
     if 'photo' not in request.files:
@@ -42,19 +57,48 @@ def upload_photo():
     if photo.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
+    key = get_key(request.form.get('key', DEFAULT_KEY.name))
+    if key is None:
+        return jsonify({"error": f"Unknown key: {request.form.get('key')}"}), 400
+
+    response_mode = request.form.get('response', 'url')
+    if response_mode not in RESPONSE_MODES:
+        return jsonify({"error": f"Unknown response mode: {response_mode}"}), 400
+
+    if response_mode != 'url':
+        # Compose straight from the upload stream; the MIDI file never touches uploads/ or songs/
+        try:
+            spec = compose_score(photo.stream, key)
+            if spec is None:
+                return jsonify({"error": "Error generating song"}), 500
+            return artifact_response(spec, response_mode, None, sheet=request.form.get('sheet') == '1')
+        except Exception as e:
+            print(f"🔴 Error generating song: {str(e)}")
+            return jsonify({"error": "Error generating song"}), 500
+
     filename = str(uuid.uuid4()) + os.path.splitext(photo.filename)[1]
     photo_path = os.path.join(UPLOAD_FOLDER, filename)
     photo.save(photo_path)
 
-    song_path, sheet_path = generate_song(photo_path)
-    if not song_path:
+    if app.config['RENDER_JOBS']:
+        job_id = queue_song(photo_path, key)
+        if not job_id:
+            return jsonify({"error": "Error generating song"}), 500
+
+        return jsonify({
+            "jobId": job_id,
+            "statusUrl": f"http://127.0.0.1:5002/jobs/{job_id}"
+        }), 202
+
+    song_filename, sheet_filename = generate_song(photo_path, key)
+    if not song_filename:
         return jsonify({"error": "Error generating song"}), 500
 
     return jsonify({
-        "songUrl": f"http://127.0.0.1:5002/songs/{os.path.basename(song_path)}",
-        "sheetMusicUrl": f"http://127.0.0.1:5002/songs/{os.path.basename(sheet_path)}"
+        "songUrl": f"http://127.0.0.1:5002/songs/{song_filename}",
+        "sheetMusicUrl": f"http://127.0.0.1:5002/songs/{sheet_filename}"
     })
-def generate_song(photo_path):
+def generate_song(photo_path, key=DEFAULT_KEY):
     """
     Generate a tonal first species counterpoint with the top line composed note by note.
     Rules:
@@ -63,148 +107,170 @@ def generate_song(photo_path):
         - Prefer stepwise motion to the last note in the top line.
     """
     try:
-        # Step 1: Load and process the image
-        if not os.path.exists(photo_path):
-            print("🔴 File not found:", photo_path)
+        spec = compose_score(photo_path, key)
+        if spec is None:
             return None, None
 
-        img = Image.open(photo_path).convert("L")
-        img = img.resize((10, 10))  # Resize to 10x10 for simplicity
-        pixel_values = list(img.getdata())
-        print("✅ Pixel Values:", pixel_values[:10])  # Debug pixel values
-
-        # Step 2: Define the key and intervals
-        tonic_pitch = 60  # C4 MIDI pitch
-        scale_degrees = [0, 2, 4, 5, 7, 9, 11]  # C major scale degrees
-        leaps_used = 0
-        current_direction = None  # Tracks direction of motion (up or down)
-
-        # Top line rules
-        top_line = stream.Part()
-        top_line.clef = clef.TrebleClef()  # Set treble clef
-        previous_pitch = None
-        second_last_pitch = None
-
-        for i in range(10):
-            if i == 0:
-                # Rule: NEVER BREAK - Start with the tonic
-                pitch = tonic_pitch
-            elif i == 9:
-                # Rule: LAST NOTE OPTIONS
-                # The last note can be tonic (C4) or dominant (G4).
-                valid_endings = [tonic_pitch, tonic_pitch + 7]  # Scale degree 0 or 5
-                if abs(previous_pitch - valid_endings[0]) <= 2:
-                    # Prefer stepwise motion to the last note
-                    pitch = valid_endings[0]
-                else:
-                    # Default to the dominant if stepwise motion is not possible
-                    pitch = valid_endings[1]
-            else:
-                # Select the next pitch dynamically
-                valid_pitches = []
-                current_scale_step = scale_degrees.index((top_line[-1].pitch.midi - tonic_pitch) % 12)
+        # Step 5: Save the score (once per distinct song)
+        song_filename, sheet_filename = render_score(spec, song_store)
 
-                # Generate candidate pitches based on stepwise motion and leap handling
-                for step in [-1, 1, -2, 2]:  # Step sizes (up or down by 1 or 2 degrees)
-                    next_scale_step = current_scale_step + step
-                    if 0 <= next_scale_step < len(scale_degrees):
-                        candidate_pitch = tonic_pitch + scale_degrees[next_scale_step]
-
-                        # RULE: NEVER BREAK - Avoid triple repetition
-                        if candidate_pitch == previous_pitch == second_last_pitch:
-                            continue
-
-                        # RULE: AVOID BREAK - Consecutive repeated notes in the middle
-                        if candidate_pitch == previous_pitch and i > 1:
-                            continue
-
-                        # RULE: DON'T BREAK TOO OFTEN - Avoid consecutive leaps in opposite directions
-                        if current_direction == "up" and step < 0:
-                            continue
-                        if current_direction == "down" and step > 0:
-                            continue
-
-                        # RULE: DON'T BREAK TOO OFTEN - Limit leaps to a maximum of two
-                        if abs(step) > 1 and leaps_used >= 2:
-                            continue
-
-                        # Add the valid candidate pitch
-                        valid_pitches.append(candidate_pitch)
-
-                # Fallback to stepwise motion if no valid pitches are found
-                if not valid_pitches:
-                    for step in [-1, 1]:  # Step sizes (up or down by 1 degree)
-                        next_scale_step = current_scale_step + step
-                        if 0 <= next_scale_step < len(scale_degrees):
-                            valid_pitches.append(tonic_pitch + scale_degrees[next_scale_step])
-
-                # Select the next pitch based on pixel values
-                pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
-
-                # Update direction and leap tracking
-                if abs(pitch - previous_pitch) > 2:
-                    leaps_used += 1
-                    current_direction = "up" if pitch > previous_pitch else "down"
-                else:
-                    current_direction = None
-
-            # Append the pitch to the top line
-            second_last_pitch = previous_pitch
-            previous_pitch = pitch
-            top_line.append(note.Note(pitch))
-
-        print("✅ Top Line Pitches:", [n.pitch.midi for n in top_line.notes])
-
-        # Step 3: Compose the bottom line (cantus firmus)
-        cantus_firmus = stream.Part()
-        cantus_firmus.clef = clef.TrebleClef()  # Set treble clef
-        for i, top_note in enumerate(top_line.notes):
-            top_pitch = top_note.pitch.midi
-
-            if i == 0:
-                cf_pitch = tonic_pitch  # Start with the tonic in the bottom line
-            elif i == 9:
-                # Rule: ENDING INTERVALS
-                # If the top line ends on scale degree 0, the bottom line must also end on 0.
-                # If the top line ends on scale degree 5, the bottom line must form a P5 or P4.
-                if top_pitch == tonic_pitch:
-                    cf_pitch = tonic_pitch  # Bottom line ends on tonic
-                elif top_pitch == tonic_pitch + 7:
-                    cf_pitch = tonic_pitch if pixel_values.pop() % 2 == 0 else tonic_pitch + 12  # P5 or P4
-            else:
-                # Generate harmonic consonances (P1, m3, M3, P5, M6, P8)
-                valid_intervals = [0, 3, 4, 7, 9, 12]
-                cf_pitch = top_pitch - valid_intervals[pixel_values.pop() % len(valid_intervals)]
+        print("✅ Song generated successfully:", song_filename, sheet_filename)
+        return song_filename, sheet_filename
 
-            cantus_firmus.append(note.Note(cf_pitch))
+    except Exception as e:
+        print(f"🔴 Error generating tonal first species counterpoint: {str(e)}")
+        return None, None
 
-        # Step 4: Create the music21 score
-        score = stream.Score([top_line, cantus_firmus])
+def queue_song(photo_path, key=DEFAULT_KEY):
+    # Compose now, render the MIDI and sheet music on the background pool
+    try:
+        spec = compose_score(photo_path, key)
+        if spec is None:
+            return None
+        return render_queue.submit(spec)
 
-        # Step 5: Save the score
-        if not os.path.exists(SONG_FOLDER):
-            os.makedirs(SONG_FOLDER)
+    except Exception as e:
+        print(f"🔴 Error generating tonal first species counterpoint: {str(e)}")
+        return None
+
+def compose_score(photo_path, key=DEFAULT_KEY):
+    # Step 1: Load and process the image
+    # A path, or the upload stream itself in the in-memory response modes
+    if isinstance(photo_path, (str, os.PathLike)) and not os.path.exists(photo_path):
+        print("🔴 File not found:", photo_path)
+        return None
+
+    img = Image.open(photo_path).convert("L")
+    img = img.resize((10, 10))  # Resize to 10x10 for simplicity
+    pixel_values = list(img.getdata())
+    print("✅ Pixel Values:", pixel_values[:10])  # Debug pixel values
+
+    # Step 2: Define the key and intervals
+    tonic_pitch = key.tonic_pitch  # C4 in the default key
+    scale_degrees = key.scale  # Semitones above the tonic (C major by default)
+    leaps_used = 0
+    current_direction = None  # Tracks direction of motion (up or down)
+
+    # Top line rules
+    top_line = []  # MIDI pitches; written with a treble clef
+    previous_pitch = None
+    second_last_pitch = None
+
+    for i in range(10):
+        if i == 0:
+            # Rule: NEVER BREAK - Start with the tonic
+            pitch = tonic_pitch
+        elif i == 9:
+            # Rule: LAST NOTE OPTIONS
+            # The last note can be tonic (C4) or dominant (G4).
+            # Scale degree 0 or 5, when the mode has a perfect fifth (locrian does not)
+            valid_endings = [p for p in (tonic_pitch, tonic_pitch + 7) if p - tonic_pitch in scale_degrees]
+            if abs(previous_pitch - valid_endings[0]) <= 2 or len(valid_endings) == 1:
+                # Prefer stepwise motion to the last note
+                pitch = valid_endings[0]
+            else:
+                # Default to the dominant if stepwise motion is not possible
+                pitch = valid_endings[1]
+        else:
+            # Select the next pitch dynamically
+            valid_pitches = []
+            current_scale_step = scale_degrees.index((top_line[-1] - tonic_pitch) % 12)
+
+            # Generate candidate pitches based on stepwise motion and leap handling
+            for step in [-1, 1, -2, 2]:  # Step sizes (up or down by 1 or 2 degrees)
+                next_scale_step = current_scale_step + step
+                if 0 <= next_scale_step < len(scale_degrees):
+                    candidate_pitch = tonic_pitch + scale_degrees[next_scale_step]
+
+                    # RULE: NEVER BREAK - Avoid triple repetition
+                    if candidate_pitch == previous_pitch == second_last_pitch:
+                        continue
+
+                    # RULE: AVOID BREAK - Consecutive repeated notes in the middle
+                    if candidate_pitch == previous_pitch and i > 1:
+                        continue
+
+                    # RULE: DON'T BREAK TOO OFTEN - Avoid consecutive leaps in opposite directions
+                    if current_direction == "up" and step < 0:
+                        continue
+                    if current_direction == "down" and step > 0:
+                        continue
+
+                    # RULE: DON'T BREAK TOO OFTEN - Limit leaps to a maximum of two
+                    if abs(step) > 1 and leaps_used >= 2:
+                        continue
+
+                    # Add the valid candidate pitch
+                    valid_pitches.append(candidate_pitch)
+
+            # Fallback to stepwise motion if no valid pitches are found
+            if not valid_pitches:
+                for step in [-1, 1]:  # Step sizes (up or down by 1 degree)
+                    next_scale_step = current_scale_step + step
+                    if 0 <= next_scale_step < len(scale_degrees):
+                        valid_pitches.append(tonic_pitch + scale_degrees[next_scale_step])
 
-        song_filename = str(uuid.uuid4()) + ".mid"
-        song_path = os.path.join(SONG_FOLDER, song_filename)
-        score.write("midi", fp=song_path)
+            # Select the next pitch based on pixel values
+            pitch = valid_pitches[pixel_values.pop() % len(valid_pitches)]
 
-        sheet_filename = str(uuid.uuid4()) + ".png"
-        sheet_path = os.path.join(SONG_FOLDER, sheet_filename)
-        score.write("musicxml.png", fp=sheet_path)
+            # Update direction and leap tracking
+            if abs(pitch - previous_pitch) > 2:
+                leaps_used += 1
+                current_direction = "up" if pitch > previous_pitch else "down"
+            else:
+                current_direction = None
+
+        # Append the pitch to the top line
+        second_last_pitch = previous_pitch
+        previous_pitch = pitch
+        top_line.append(pitch)
+
+    print("✅ Top Line Pitches:", top_line)
+
+    # Step 3: Compose the bottom line (cantus firmus)
+    cantus_firmus = []  # MIDI pitches; written with a treble clef
+    for i, top_pitch in enumerate(top_line):
+
+        if i == 0:
+            cf_pitch = tonic_pitch  # Start with the tonic in the bottom line
+        elif i == 9:
+            # Rule: ENDING INTERVALS
+            # If the top line ends on scale degree 0, the bottom line must also end on 0.
+            # If the top line ends on scale degree 5, the bottom line must form a P5 or P4.
+            if top_pitch == tonic_pitch:
+                cf_pitch = tonic_pitch  # Bottom line ends on tonic
+            elif top_pitch == tonic_pitch + 7:
+                cf_pitch = tonic_pitch if pixel_values.pop() % 2 == 0 else tonic_pitch + 12  # P5 or P4
+        else:
+            # Generate harmonic consonances (P1, m3, M3, P5, M6, P8)
+            valid_intervals = [0, 3, 4, 7, 9, 12]
+            cf_pitch = top_pitch - valid_intervals[pixel_values.pop() % len(valid_intervals)]
+
+        cantus_firmus.append(cf_pitch)
+
+    # Step 4: Describe the score (quarter notes, treble clef) for the MIDI and sheet music writers
+    return lines_spec([top_line, cantus_firmus], quarter_length=1, clef_name="G2", key_name=key.name)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = render_queue.status(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
 
-        print("✅ Song generated successfully:", song_path, sheet_path)
-        return song_path, sheet_path
+    return jsonify({
+        "jobId": job_id,
+        "status": job["status"],
+        "songUrl": f"http://127.0.0.1:5002/songs/{job['songFilename']}" if job["songFilename"] else None,
+        "sheetMusicUrl": f"http://127.0.0.1:5002/songs/{job['sheetFilename']}" if job["sheetFilename"] else None,
+        "error": job["error"]
+    })
 
-    except Exception as e:
-        print(f"🔴 Error generating tonal first species counterpoint: {str(e)}")
-        return None, None
-    
 @app.route('/songs/<filename>', methods=['GET'])
 def get_song(filename):
-    song_path = os.path.join(SONG_FOLDER, filename)
-    if os.path.exists(song_path):
-        return send_file(song_path, as_attachment=True)
+    # Conditional GET: a matching If-None-Match / If-Modified-Since gets a 304
+    response = song_store.send(filename)
+    if response is not None:
+        return response
     return jsonify({"error": "Song not found"}), 404
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+"""
+Pitch arithmetic shared by the song generators.
+
+The generators only ever need two things from music21 while composing: the
+spelled name of a MIDI pitch (e.g. "C#4") and the name of the interval between
+two MIDI pitches (e.g. "m3"). Both are pure functions of the MIDI numbers, so
+they are precomputed into flat array-backed tables indexed by (low << 7) | high.
+The spellings and interval names match music21's defaults for pitches built
+from MIDI numbers (sharps except E- and B-).
+
+The tables are built once per version of this file and then memory-mapped
+from shared_tables, so worker processes share them and skip the build.
+"""
+from array import array
+
+from shared_tables import load_tables, source_fingerprint
+
+MIDI_RANGE = 128
+
+# music21 spells MIDI pitch classes with these names by default
+PITCH_CLASS_NAMES = ("C", "C#", "D", "E-", "E", "F", "F#", "G", "G#", "A", "B-", "B")
+_PITCH_CLASS_STEPS = (0, 0, 1, 2, 2, 3, 3, 4, 4, 5, 6, 6)  # Letter index (C=0 ... B=6)
+
+# Semitones of the perfect/major interval for each simple generic interval (unison..7th)
+_MAJOR_SEMITONES = (0, 2, 4, 5, 7, 9, 11)
+_PERFECT_GENERICS = (0, 3, 4)  # Unison, 4th and 5th (zero-based)
+_PERFECT_QUALITIES = {-2: "dd", -1: "d", 0: "P", 1: "A", 2: "AA"}
+_MAJOR_QUALITIES = {-3: "dd", -2: "d", -1: "m", 0: "M", 1: "A", 2: "AA"}
+
+# Harmonic intervals allowed between the two voices in first species
+CONSONANT_INTERVALS = ("P1", "m3", "M3", "P5", "m6", "M6", "P8")
+PERFECT_INTERVALS = ("P1", "P5", "P8")
+
+
+def _diatonic_index(midi):
+    return (midi // 12) * 7 + _PITCH_CLASS_STEPS[midi % 12]
+
+
+def _spell_interval(start, end):
+    # music21 places octave-less pitches (below C0) in its default octave 4
+    if start < 12:
+        start += 60
+    if end < 12:
+        end += 60
+
+    # Work on the ascending form of the interval, as music21's .name does.
+    # A falling chromatic unison (C#4 -> C4) stays a diminished unison.
+    steps = _diatonic_index(end) - _diatonic_index(start)
+    semitones = end - start
+    if steps < 0:
+        steps, semitones = -steps, -semitones
+    return spell_interval(steps, semitones)
+
+
+def spell_interval(steps, semitones):
+    """Name an ascending interval from its size in letter steps and in semitones, e.g. (2, 3) -> "m3"."""
+    simple = steps % 7
+    offset = semitones - (_MAJOR_SEMITONES[simple] + 12 * (steps // 7))
+    if simple in _PERFECT_GENERICS:
+        quality = _PERFECT_QUALITIES[offset]
+    else:
+        quality = _MAJOR_QUALITIES[offset]
+    return quality + str(steps + 1)
+
+
+def _build_tables():
+    names = []
+    codes = {}
+    interval_codes = array("H", bytes(2 * MIDI_RANGE * MIDI_RANGE))
+    consonance = bytearray(MIDI_RANGE * MIDI_RANGE)
+    perfect = bytearray(MIDI_RANGE * MIDI_RANGE)
+
+    for start in range(MIDI_RANGE):
+        for end in range(MIDI_RANGE):
+            name = _spell_interval(start, end)
+            if name not in codes:
+                codes[name] = len(names)
+                names.append(name)
+            index = (start << 7) | end
+            interval_codes[index] = codes[name]
+            consonance[index] = name in CONSONANT_INTERVALS
+            perfect[index] = name in PERFECT_INTERVALS
+
+    return {"interval_codes": interval_codes, "consonance": consonance, "perfect": perfect}, {"interval_names": names}
+
+
+# music21 leaves the octave off for pitches below C0
+NOTE_NAMES = tuple(
+    PITCH_CLASS_NAMES[midi % 12] + (str(midi // 12 - 1) if midi >= 12 else "")
+    for midi in range(MIDI_RANGE)
+)
+_tables, _values = load_tables("pitch_math", source_fingerprint(__file__), _build_tables)
+INTERVAL_NAMES = tuple(_values["interval_names"])
+INTERVAL_CODES = _tables["interval_codes"]
+CONSONANCE_TABLE = _tables["consonance"]
+PERFECT_TABLE = _tables["perfect"]
+
+
+def note_name(midi):
+    """Return the name with octave of a MIDI pitch, e.g. 61 -> "C#4"."""
+    return NOTE_NAMES[midi]
+
+
+def interval_name(start, end):
+    """Return the name of the interval between two MIDI pitches, e.g. (60, 64) -> "M3"."""
+    return INTERVAL_NAMES[INTERVAL_CODES[(start << 7) | end]]
+
+
+def is_consonant(start, end):
+    """Return True if the interval between two MIDI pitches is a first species consonance."""
+    return CONSONANCE_TABLE[(start << 7) | end] == 1
+
+
+def is_perfect(start, end):
+    """Return True if the interval between two MIDI pitches is a unison, fifth or octave."""
+    return PERFECT_TABLE[(start << 7) | end] == 1
@@ -0,0 +1,326 @@
+"""
+Background rendering of generated songs to MIDI and sheet music.
+
+Sheet music goes through MuseScore (see sheet_renderer) and takes seconds, so in job mode
+the upload handlers only compose the score and queue it here. Jobs are rows in a
+SQLite file, which makes the queue survive restarts and lets any gunicorn
+worker report on (or pick up) any job. Each process renders with a small,
+bounded thread pool that claims queued rows one at a time.
+
+music21 is only imported the first time a score has to be exported to
+MusicXML for MuseScore, so processes that never render PNGs never pay for it.
+
+artifact_response covers the other direction: clients that want the files back
+in the /upload response itself, built in memory and never stored.
+"""
+import base64
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify, send_file
+
+from artifact_store import spec_hash
+from keys import get_key
+from midi_writer import midi_bytes, write_midi
+from sheet_renderer import SheetRenderer
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+MUSESCORE_PATH = os.environ.get("MUSESCORE_PATH", "/Applications/MuseScore 4.app/Contents/MacOS/mscore")
+
+_music21 = None
+_musicxml_lock = threading.Lock()
+
+
+def load_music21():
+    """Import music21 on first use and return its modules."""
+    global _music21
+    if _music21 is None:
+        from music21 import clef, defaults, meter, note, stream
+        from music21.musicxml import m21ToXml
+
+        _music21 = {"clef": clef, "defaults": defaults, "meter": meter, "note": note, "stream": stream,
+                    "m21ToXml": m21ToXml}
+    return _music21
+
+
+def lines_spec(lines, quarter_length, time_signature=None, clef_name=None, key_name=None):
+    """Describe lines of MIDI pitches with one shared note length as a score spec, spelled in `key_name` if given."""
+    spec = {"parts": [
+        {
+            "clef": clef_name,
+            "timeSignature": time_signature,
+            "notes": [[pitch, float(quarter_length)] for pitch in line],
+        }
+        for line in lines
+    ]}
+    if key_name:
+        spec["key"] = key_name
+    return spec
+
+
+def score_spec(score):
+    """Describe a two-part score as plain JSON data that can be queued and rebuilt later."""
+    meter = load_music21()["meter"]
+    parts = []
+    for part in score.parts:
+        time_signature = part.getElementsByClass(meter.TimeSignature).first()
+        parts.append({
+            "clef": f"{part.clef.sign}{part.clef.line}" if part.clef else None,
+            "timeSignature": time_signature.ratioString if time_signature else None,
+            "notes": [[n.pitch.midi, float(n.quarterLength)] for n in part.notes],
+        })
+    return {"parts": parts}
+
+
+def build_score(spec):
+    m21 = load_music21()
+    clef, meter, note, stream = m21["clef"], m21["meter"], m21["note"], m21["stream"]
+    key = get_key(spec["key"]) if spec.get("key") else None
+    score = stream.Score()
+    for part_spec in spec["parts"]:
+        part = stream.Part()
+        if part_spec.get("clef"):
+            part.clef = clef.clefFromString(part_spec["clef"])
+        if part_spec.get("timeSignature"):
+            part.append(meter.TimeSignature(part_spec["timeSignature"]))
+        for pitch, quarter_length in part_spec["notes"]:
+            # Spelled as in the key (Ab, not G#) when the spec names one
+            name = key.note_name(pitch) if key is not None and pitch >= 12 else pitch
+            part.append(note.Note(name, quarterLength=quarter_length))
+        score.append(part)
+    return score
+
+
+def spec_musicxml(spec):
+    """Export a score spec as MusicXML bytes, without a title or composer (as music21 does for PNGs)."""
+    m21 = load_music21()
+    defaults = m21["defaults"]
+    # The exporter reads the default title from module state, so blanking it is serialized
+    with _musicxml_lock:
+        saved = defaults.title, defaults.author
+        defaults.title = defaults.author = ""
+        try:
+            return m21["m21ToXml"].GeneralObjectExporter(build_score(spec)).parse()
+        finally:
+            defaults.title, defaults.author = saved
+
+
+SHEET_RENDERER = SheetRenderer(
+    MUSESCORE_PATH,
+    spec_musicxml,
+    workers=int(os.environ.get("SHEET_RENDER_WORKERS", 2)),
+    batch_size=int(os.environ.get("SHEET_RENDER_BATCH", 8)),
+    timeout=float(os.environ.get("SHEET_RENDER_TIMEOUT", 30)),
+)
+
+
+def _spec_lines(spec):
+    return [[(pitch, quarter_length) for pitch, quarter_length in part["notes"]] for part in spec["parts"]]
+
+
+def write_spec_midi(spec, fp):
+    """Write a score spec as MIDI with the native writer (same bytes as score.write("midi"))."""
+    return write_midi(fp, _spec_lines(spec), time_signature=spec["parts"][0].get("timeSignature"))
+
+
+def spec_midi_bytes(spec):
+    return midi_bytes(_spec_lines(spec), time_signature=spec["parts"][0].get("timeSignature"))
+
+
+def render_score(spec, store, sheet=True):
+    """Store the MIDI file (and the sheet music PNG) for a score spec; return their artifact names."""
+    song_filename = store.put_bytes(spec_midi_bytes(spec), "mid")
+
+    # The sheet music goes through the MuseScore pool (or the SVG fallback), unless this score was rendered before
+    sheet_filename = None
+    if sheet:
+        sheet_filename = SHEET_RENDERER.store(spec, store, spec_hash(spec))
+    return song_filename, sheet_filename
+
+
+SHEET_MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+# 'url' stores the files and returns links; the others answer with the files themselves
+RESPONSE_MODES = ("url", "midi", "sheet", "inline")
+
+
+def artifact_response(spec, mode, note_data=None, sheet=False):
+    """
+    Build an /upload response that carries the rendered files instead of links to them.
+
+    'midi' and 'sheet' return the MIDI file or the sheet music (PNG, or SVG without MuseScore)
+    as the body; 'inline' returns JSON with the MIDI (and the sheet music if `sheet`)
+    base64-encoded next to `note_data`. The MIDI file is built in memory, so only sheet
+    rendering touches the disk.
+    """
+    if mode == "midi":
+        return send_file(io.BytesIO(spec_midi_bytes(spec)), mimetype="audio/midi",
+                         as_attachment=True, download_name="song.mid")
+    if mode == "sheet":
+        data, extension = SHEET_RENDERER.render(spec)
+        return send_file(io.BytesIO(data), mimetype=SHEET_MIMETYPES[extension],
+                         as_attachment=True, download_name=f"sheet.{extension}")
+
+    body = {"midi": base64.b64encode(spec_midi_bytes(spec)).decode("ascii")}
+    if sheet:
+        data, extension = SHEET_RENDERER.render(spec)
+        body["sheetMusic"] = base64.b64encode(data).decode("ascii")
+        body["sheetMusicType"] = SHEET_MIMETYPES[extension]
+    if note_data is not None:
+        body["noteData"] = note_data
+    return jsonify(body)
+
+
+# Finished jobs are kept this long when the store has no TTL of its own
+JOB_RETENTION = 7 * 24 * 3600
+
+
+class RenderQueue:
+    def __init__(self, db_path, store, max_workers=2, sheet=True, stale_after=600, max_attempts=3,
+                 retention=None, sweep_interval=60):
+        self.db_path = db_path
+        self.store = store  # ArtifactStore the rendered files go into
+        self.sheet = sheet
+        self.max_workers = max_workers
+        self.stale_after = stale_after  # Seconds before a "running" job from a dead worker is retried
+        self.max_attempts = max_attempts  # Claims before a job that keeps killing its worker is failed
+        # Seconds finished jobs are kept: as long as their files, since a job is no use without them
+        self.retention = retention or store.ttl or JOB_RETENTION
+        self.sweep_interval = sweep_interval
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._created = False
+        self._last_sweep = 0
+
+    def _connect(self):
+        # A short-lived connection per call keeps the queue safe across threads and forks. The file is
+        # created on first use, so importing an app with RENDER_JOBS off leaves no database behind.
+        db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        if not self._created:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, spec TEXT NOT NULL, "
+                "song_filename TEXT, sheet_filename TEXT, error TEXT, "
+                "created REAL NOT NULL, updated REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            if "attempts" not in [column[1] for column in db.execute("PRAGMA table_info(jobs)")]:
+                db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")  # Older queues
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (status, updated)")
+            self._created = True
+        return db
+
+    def _pool(self):
+        # Pools do not survive a fork, so every gunicorn worker starts its own on first use
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+                self._executor_pid = os.getpid()
+                # Pick up anything left queued by a previous run
+                self._executor.submit(self._drain)
+            return self._executor
+
+    def submit(self, spec):
+        """Queue a score spec for rendering and return the new job id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute(
+                "INSERT INTO jobs (id, status, spec, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(spec), now, now),
+            )
+        finally:
+            db.close()
+        self._pool().submit(self._drain)
+        return job_id
+
+    def status(self, job_id):
+        """Return the job as a dict, or None if there is no such job."""
+        if not self._created and not os.path.exists(self.db_path):
+            return None  # Nothing was ever queued
+        db = self._connect()
+        try:
+            row = db.execute(
+                "SELECT status, song_filename, sheet_filename, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        status, song_filename, sheet_filename, error = row
+        return {"status": status, "songFilename": song_filename, "sheetFilename": sheet_filename, "error": error}
+
+    def _claim(self, db):
+        # BEGIN IMMEDIATE takes the write lock, so only one worker can claim a given row
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            # A job still "running" long after its claim took its worker down with it; stop retrying it
+            # once it has done that max_attempts times
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status = ? AND updated < ? AND attempts >= ?",
+                (FAILED, f"Gave up after {self.max_attempts} attempts", now, RUNNING, now - self.stale_after,
+                 self.max_attempts),
+            )
+            row = db.execute(
+                "SELECT id, spec FROM jobs WHERE status = ? OR (status = ? AND updated < ?) "
+                "ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now - self.stale_after),
+            ).fetchone()
+            if row:
+                db.execute("UPDATE jobs SET status = ?, updated = ?, attempts = attempts + 1 WHERE id = ?",
+                           (RUNNING, now, row[0]))
+            db.execute("COMMIT")
+            return row
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def _sweep(self, db, now=None):
+        # Delete finished jobs older than the retention, at most once per sweep_interval per process
+        now = time.time() if now is None else now
+        if now - self._last_sweep < self.sweep_interval:
+            return 0
+        self._last_sweep = now
+        return db.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (DONE, FAILED, now - self.retention)
+        ).rowcount
+
+    def _drain(self):
+        db = self._connect()
+        try:
+            while True:
+                row = self._claim(db)
+                if row is None:
+                    self._sweep(db)
+                    return
+                job_id, spec = row
+                try:
+                    song_filename, sheet_filename = render_score(json.loads(spec), self.store, self.sheet)
+                    db.execute(
+                        "UPDATE jobs SET status = ?, song_filename = ?, sheet_filename = ?, updated = ? WHERE id = ?",
+                        (DONE, song_filename, sheet_filename, time.time(), job_id),
+                    )
+                except Exception as e:
+                    logging.error("Error rendering job %s: %s", job_id, str(e))
+                    db.execute(
+                        "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                        (FAILED, str(e), time.time(), job_id),
+                    )
+        finally:
+            db.close()
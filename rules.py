@@ -0,0 +1,475 @@
+"""
+Declarative first species rules for choosing the bottom line.
+
+A ruleset is data: the octaves of the key's scale to pick from, optional fixed
+first/last notes and an ordered list of (rule name, parameters). compile_ruleset
+turns it into a CompiledRuleset once per key; rules that only look at the candidate, the top note and
+the position are folded into a per-(position, top note) candidate table, and
+the remaining rules become a flat list of closures run for each candidate.
+
+Every rule returns None to reject a candidate or a number to add to its score;
+the lowest total wins and ties go to the earlier candidate, as in app.py. Some
+rules (banning repeated notes, remembering the last leap) change the line's
+state even for candidates that are not chosen, so the order of the list is part
+of the ruleset and static rules are only hoisted ahead of the first such rule.
+
+bottom_line is that greedy scan; search_line runs the same rules as a beam
+search over whole lines and evaluate replays them along a finished line.
+"""
+from collections import deque
+
+from keys import DEFAULT_KEY
+from pitch_math import CONSONANT_INTERVALS
+
+RULES = {}
+
+# Note counts and bans look back this many notes, so long lines keep the same rules
+# as the original 10-note phrase instead of running out of notes
+PHRASE_LENGTH = 10
+
+
+def rule(name, static=False, side_effects=False, keyed=False):
+    """
+    Register a rule factory. Static rules take (candidate, top_pitch, position, length).
+    Keyed factories are also passed the Key the ruleset is compiled for.
+    """
+    def register(factory):
+        RULES[name] = (factory, static, side_effects, keyed)
+        return factory
+    return register
+
+
+class LineState:
+    """What the rules can see while the bottom line is being chosen."""
+
+    def __init__(self, top_line, tonic_pitch, window=PHRASE_LENGTH):
+        self.top_line = top_line
+        self.length = len(top_line)
+        self.tonic_pitch = tonic_pitch
+        self.window = window
+        self.position = 0
+        self.top_pitch = None
+        self.previous = None   # Last bottom note
+        self.repeats = 0       # How many times in a row `previous` has been played
+        self.recent = deque()  # The last `window` bottom notes, oldest first
+        self.counts = {}       # Uses of each pitch in `recent`
+        self.banned = {}       # Note -> position its ban runs out at
+        self.last_leap = None  # "up" or "down"
+
+    def add(self, pitch):
+        self.repeats = self.repeats + 1 if pitch == self.previous else 1
+        self.previous = pitch
+        if len(self.recent) == self.window:
+            self.counts[self.recent.popleft()] -= 1
+        self.recent.append(pitch)
+        self.counts[pitch] = self.counts.get(pitch, 0) + 1
+
+    def copy(self):
+        state = LineState.__new__(LineState)
+        state.__dict__.update(self.__dict__)
+        state.recent = deque(self.recent)
+        state.counts = dict(self.counts)
+        state.banned = dict(self.banned)
+        return state
+
+    def signature(self):
+        # Two partial lines with the same signature are judged identically from here on
+        if self.length <= self.window:
+            # Nothing leaves the window, so the counts stand in for the notes themselves
+            return (self.previous, self.repeats, self.last_leap, frozenset(self.banned),
+                    frozenset(self.counts.items()))
+        return (self.previous, self.repeats, self.last_leap, frozenset(self.banned.items()),
+                tuple(self.recent))
+
+
+# Static rules
+
+@rule("no_voice_crossing", static=True)
+def no_voice_crossing():
+    return lambda candidate, top_pitch, position, length: candidate < top_pitch
+
+
+@rule("lowest_pitch", static=True)
+def lowest_pitch(pitch=35):
+    return lambda candidate, top_pitch, position, length: candidate >= pitch
+
+
+@rule("consonance", static=True, keyed=True)
+def consonance(key, intervals=CONSONANT_INTERVALS):
+    # Intervals are named as spelled in the key, so Eb-Ab in Ab major is a fourth, not an augmented third
+    if tuple(intervals) == CONSONANT_INTERVALS:
+        return lambda candidate, top_pitch, position, length: key.is_consonant(candidate, top_pitch)
+    allowed = frozenset(intervals)
+    return lambda candidate, top_pitch, position, length: key.interval_name(candidate, top_pitch) in allowed
+
+
+@rule("consonant_semitones", static=True)
+def consonant_semitones(semitones=(0, 3, 4, 7, 8, 9)):
+    allowed = frozenset(semitones)
+    return lambda candidate, top_pitch, position, length: abs(candidate - top_pitch) in allowed
+
+
+@rule("no_seconds", static=True)
+def no_seconds():
+    return lambda candidate, top_pitch, position, length: abs(candidate - top_pitch) not in (1, 2)
+
+
+# Filters on the line so far
+
+@rule("not_banned")
+def not_banned():
+    def check(candidate, state):
+        return None if state.banned.get(candidate, -1) > state.position else 0
+    return check
+
+
+@rule("max_consecutive_repeats", side_effects=True)
+def max_consecutive_repeats(limit=2, ban=False):
+    def check(candidate, state):
+        if candidate == state.previous and state.repeats >= limit:
+            if ban:
+                # Do not use the note again for a phrase once it has repeated
+                state.banned[candidate] = state.position + state.window
+            return None
+        return 0
+    return check
+
+
+@rule("max_note_usage")
+def max_note_usage(limit=3):
+    def check(candidate, state):
+        return None if state.counts.get(candidate, 0) >= limit else 0
+    return check
+
+
+@rule("max_leap")
+def max_leap(semitones=9):
+    def check(candidate, state):
+        previous = state.previous
+        return None if previous and abs(candidate - previous) > semitones else 0
+    return check
+
+
+@rule("stepwise_second_note")
+def stepwise_second_note(semitones=2):
+    def check(candidate, state):
+        previous = state.previous
+        return None if state.position == 1 and previous and abs(candidate - previous) > semitones else 0
+    return check
+
+
+@rule("stepwise_penultimate_note")
+def stepwise_penultimate_note(semitones=2):
+    # Measured against the final note of the top line, as app.py does
+    def check(candidate, state):
+        if state.position == state.length - 2 and abs(candidate - state.top_line[-1]) > semitones:
+            return None
+        return 0
+    return check
+
+
+# Scoring
+
+@rule("favor_step_down")
+def favor_step_down(bonus=-10):
+    def score(candidate, state):
+        previous = state.previous
+        return bonus if previous and candidate == previous - 1 else 0
+    return score
+
+
+@rule("penalize_repeat_at_ends")
+def penalize_repeat_at_ends(penalty=5):
+    # Second and second-to-last notes should move away from their neighbours
+    def score(candidate, state):
+        if state.position in (1, state.length - 2) and candidate == state.previous:
+            return penalty
+        return 0
+    return score
+
+
+@rule("leap_recovery", side_effects=True)
+def leap_recovery(step=2, penalty=5):
+    # A leap must turn back from the previous one; every leap that passes is remembered
+    def check(candidate, state):
+        previous = state.previous
+        if previous and abs(candidate - previous) > step:
+            direction = "up" if candidate > previous else "down"
+            if state.last_leap and direction == state.last_leap:
+                return None
+            state.last_leap = direction
+            return penalty
+        return 0
+    return check
+
+
+@rule("contrary_motion")
+def contrary_motion(bonus=-5, parallel_penalty=2):
+    def score(candidate, state):
+        previous = state.previous
+        if previous is None or state.position == 0:
+            return 0
+        motion = candidate - previous
+        top_motion = state.top_pitch - state.top_line[state.position - 1]
+        if (motion > 0 and top_motion < 0) or (motion < 0 and top_motion > 0):
+            return bonus
+        if motion * top_motion > 0:
+            return parallel_penalty
+        return 0
+    return score
+
+
+@rule("repetition_preference")
+def repetition_preference(weight=10):
+    # app2.py's weighting: notes used more often so far score lower
+    def score(candidate, state):
+        return -(state.counts.get(candidate, 0) / max(1, len(state.recent))) * weight
+    return score
+
+
+RULESETS = {
+    # app.py's bottom line
+    "app": {
+        "octaves": (0, -1),  # The key's scale from the tonic up, then the octave below
+        "first": 0,
+        "last": -12,
+        "phrase": PHRASE_LENGTH,
+        "rules": [
+            ("no_voice_crossing", {}),
+            ("lowest_pitch", {"pitch": 35}),
+            ("not_banned", {}),
+            ("max_consecutive_repeats", {"limit": 2, "ban": True}),
+            ("max_note_usage", {"limit": 3}),
+            ("max_leap", {"semitones": 9}),
+            ("stepwise_second_note", {}),
+            ("stepwise_penultimate_note", {}),
+            ("consonance", {}),
+            ("favor_step_down", {}),
+            ("penalize_repeat_at_ends", {}),
+            ("leap_recovery", {}),
+        ],
+    },
+    # app2.py's bottom line: upper scale only, contrary motion preferred
+    "app2": {
+        "octaves": (0,),
+        "first": None,
+        "last": None,
+        "phrase": PHRASE_LENGTH,
+        "rules": [
+            ("lowest_pitch", {"pitch": 35}),
+            ("no_voice_crossing", {}),
+            ("max_consecutive_repeats", {"limit": 2}),
+            ("max_note_usage", {"limit": 3}),
+            ("no_seconds", {}),
+            ("consonant_semitones", {}),
+            ("contrary_motion", {}),
+            ("repetition_preference", {}),
+        ],
+    },
+}
+
+
+class CompiledRuleset:
+    def __init__(self, name, definition, key=DEFAULT_KEY):
+        self.name = name
+        self.key = key
+        self.tonic_pitch = key.tonic_pitch
+        self.candidates = tuple(
+            key.tonic_pitch + 12 * octave + degree for octave in definition["octaves"] for degree in key.scale
+        )
+        self.first = definition.get("first")
+        self.last = definition.get("last")
+        self.phrase = definition.get("phrase", PHRASE_LENGTH)
+
+        # Static rules ahead of the first rule with side effects can run before everything else
+        self._static = []
+        self._checks = []
+        hoisting = True
+        for rule_name, params in definition["rules"]:
+            factory, static, side_effects, keyed = RULES[rule_name]
+            check = factory(key, **params) if keyed else factory(**params)
+            if side_effects:
+                hoisting = False
+            if static and hoisting:
+                self._static.append(check)
+            elif static:
+                self._checks.append(_dynamic(check))
+            else:
+                self._checks.append(check)
+        self._candidate_table = {}
+
+    def _static_candidates(self, position, top_pitch, length):
+        # Static rules may only single out the first two and last two positions, so every
+        # other position shares one entry and the table does not grow with the line length
+        if position < 2:
+            key = (position, top_pitch)
+        elif position >= length - 2:
+            key = (position - length, top_pitch)
+        else:
+            key = (2, top_pitch)
+        candidates = self._candidate_table.get(key)
+        if candidates is None:
+            candidates = tuple(
+                c for c in self.candidates
+                if all(check(c, top_pitch, position, length) for check in self._static)
+            )
+            self._candidate_table[key] = candidates
+        return candidates
+
+    def new_line(self, top_line):
+        return LineState(top_line, self.tonic_pitch, self.phrase)
+
+    def choose(self, state, position):
+        """Return the bottom note for `position`, or None if every candidate is rejected."""
+        state.position = position
+        state.top_pitch = state.top_line[position]
+        if position == 0 and self.first is not None:
+            return self.tonic_pitch + self.first
+        if position == state.length - 1 and self.last is not None:
+            return self.tonic_pitch + self.last
+
+        best = None
+        best_score = None
+        for candidate in self._static_candidates(position, state.top_pitch, state.length):
+            total = 0
+            for check in self._checks:
+                result = check(candidate, state)
+                if result is None:
+                    break
+                total += result
+            else:
+                if best is None or total < best_score:
+                    best, best_score = candidate, total
+        return best
+
+    def iter_bottom_line(self, top_line):
+        """Yield the bottom line for `top_line` note by note, falling back to the tonic where nothing fits."""
+        state = self.new_line(top_line)
+        for position in range(len(top_line)):
+            pitch = self.choose(state, position)
+            if pitch is None:
+                pitch = self.tonic_pitch
+            state.add(pitch)
+            yield pitch
+
+    def bottom_line(self, top_line):
+        """Choose the whole bottom line for `top_line`."""
+        return list(self.iter_bottom_line(top_line))
+
+    def _expand(self, state, position, candidates=None):
+        """
+        Yield (candidate, score, next state) for every candidate the rules allow at `position`.
+
+        The rules run against a copy of `state` per candidate, so side effects only follow the
+        path being extended.
+        """
+        state.position = position
+        state.top_pitch = top_pitch = state.top_line[position]
+        allowed = self._static_candidates(position, top_pitch, state.length)
+        checks = self._checks
+        for candidate in allowed if candidates is None else (c for c in candidates if c in allowed):
+            child = state.copy()
+            total = 0
+            for check in checks:
+                result = check(candidate, child)
+                if result is None:
+                    break
+                total += result
+            else:
+                child.add(candidate)
+                yield candidate, total, child
+
+    def _fixed_pitch(self, position, length):
+        if position == 0 and self.first is not None:
+            return self.tonic_pitch + self.first
+        if position == length - 1 and self.last is not None:
+            return self.tonic_pitch + self.last
+        return None
+
+    def search_line(self, top_line, beam_width=None):
+        """
+        Return the best bottom line for `top_line`, searched as a shortest path over the positions.
+
+        Paths are ranked by (broken rules, score). Every rule is applied to the path alone:
+        unlike bottom_line, a candidate that loses does not ban notes or record leaps. A partial
+        line with no legal next note continues on the tonic and counts one broken rule, as the
+        greedy fallback would. Partial lines that reach the same state (last note, repeat count,
+        last leap, bans and note counts) are merged, keeping the better one, and at most
+        `beam_width` states survive each position (None keeps them all).
+        """
+        length = len(top_line)
+        beam = [((0, 0), self.new_line(top_line), ())]
+        for position in range(length):
+            fixed = self._fixed_pitch(position, length)
+            merged = {}
+
+            def keep(cost, child, pitch, path):
+                key = child.signature()
+                if key not in merged or cost < merged[key][0]:
+                    merged[key] = (cost, child, (pitch, path))
+
+            for (violations, score), state, path in beam:
+                if fixed is not None:
+                    child = state.copy()
+                    child.add(fixed)
+                    keep((violations, score), child, fixed, path)
+                    continue
+
+                extended = False
+                for candidate, delta, child in self._expand(state, position):
+                    keep((violations, score + delta), child, candidate, path)
+                    extended = True
+                if not extended:
+                    child = state.copy()
+                    child.add(self.tonic_pitch)
+                    keep((violations + 1, score), child, self.tonic_pitch, path)
+
+            beam = sorted(merged.values(), key=lambda entry: entry[0])
+            if beam_width:
+                beam = beam[:beam_width]
+
+        path = beam[0][2]
+        pitches = []
+        while path:
+            pitch, path = path
+            pitches.append(pitch)
+        return pitches[::-1]
+
+    def evaluate(self, top_line, bottom_line):
+        """Return (score, violations) of a finished bottom line, replaying the rules along it."""
+        state = self.new_line(top_line)
+        score = 0
+        violations = 0
+        for position, pitch in enumerate(bottom_line):
+            if self._fixed_pitch(position, len(top_line)) is not None:
+                state.position = position
+                state.add(pitch)
+                continue
+            judged = next(self._expand(state, position, (pitch,)), None)
+            if judged is None:
+                violations += 1
+                state = state.copy()
+                state.add(pitch)
+            else:
+                _, delta, state = judged
+                score += delta
+        return score, violations
+
+
+def _dynamic(check):
+    # Run a static rule in place, after a rule with side effects
+    def run(candidate, state):
+        return 0 if check(candidate, state.top_pitch, state.position, state.length) else None
+    return run
+
+
+_compiled = {}
+
+
+def compile_ruleset(name, key=DEFAULT_KEY):
+    """Return the ruleset `name` compiled for `key` (a keys.Key), compiling it on first use."""
+    cache_key = (name, key.name)
+    compiled = _compiled.get(cache_key)
+    if compiled is None:
+        compiled = _compiled[cache_key] = CompiledRuleset(name, RULESETS[name], key)
+    return compiled
@@ -0,0 +1,118 @@
+"""
+Lookup tables in memory-mapped files, so every worker process shares one copy.
+
+pitch_math's interval tables and keys.py's per-key spellings take about 75 ms
+to build at import. Every process that imports them holds its own copy:
+gunicorn workers without preload, uvicorn workers, batch pool processes. Even
+preloaded copies drift apart as reference counts are written. load_tables
+builds a module's tables once and writes them, in a fixed layout, to a file
+named after the module and a fingerprint of its source. Every later import
+maps that file read-only and wraps its arrays in memoryviews. The pages come
+from the page cache, so N workers share one physical copy and an import costs
+a file open and a JSON header parse.
+
+File layout:
+
+    MAGIC                  8 bytes
+    header length          uint32, little-endian
+    header                 JSON: {"tables": {name: [typecode, offset, count]}, "values": {...}}
+    arrays                 each at its offset, 64-byte aligned, in native byte order
+
+"values" carries the small non-array data built alongside (interval names,
+note names), so the file is all a module needs.
+
+A missing or stale file is rebuilt and renamed into place, so concurrent
+first imports never map a partial file. If the folder cannot be written, the
+tables are used from memory as before. SHARED_TABLES_DIR sets the folder
+(tables/ beside this module by default).
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"TABLES01"
+_HEADER = struct.Struct("<8sI")
+_ALIGNMENT = 64
+
+TABLES_DIR = os.environ.get("SHARED_TABLES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tables"))
+
+
+def source_fingerprint(*paths):
+    """Hash the source files the tables are built from, with the byte order they are stored in."""
+    digest = hashlib.sha256(sys.byteorder.encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def table_path(name, fingerprint):
+    return os.path.join(TABLES_DIR, f"{name}-{fingerprint}.bin")
+
+
+def _write(path, tables, values):
+    layout = {}
+    offset = 0
+    for table_name, table in tables.items():
+        typecode = table.typecode if isinstance(table, array) else "B"
+        offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+        layout[table_name] = [typecode, offset, len(table)]
+        offset += len(table) * array(typecode).itemsize
+    header = json.dumps({"tables": layout, "values": values}, sort_keys=True).encode()
+
+    start = -(-(_HEADER.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(header)) + header)
+        for table_name, table in tables.items():
+            f.seek(start + layout[table_name][1])
+            f.write(bytes(table))
+    os.replace(partial, path)
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_length = _HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a table file")
+    header = json.loads(mapped[_HEADER.size:_HEADER.size + header_length])
+    start = -(-(_HEADER.size + header_length) // _ALIGNMENT) * _ALIGNMENT
+    view = memoryview(mapped)
+    tables = {}
+    for table_name, (typecode, offset, count) in header["tables"].items():
+        size = count * array(typecode).itemsize
+        if start + offset + size > len(mapped):
+            raise ValueError(f"{path} is truncated")
+        tables[table_name] = view[start + offset:start + offset + size].cast(typecode)
+    return tables, header["values"]
+
+
+def load_tables(name, fingerprint, build):
+    """
+    Return (tables, values) for `name`, mapped from its table file, building and writing it first if needed.
+
+    build() returns ({table name: array or bytes}, {value name: anything JSON can hold}). Mapped tables
+    are read-only memoryviews with the same typecode and indexing as the arrays.
+    """
+    path = table_path(name, fingerprint)
+    try:
+        return _map(path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Rebuilding %s: %s", path, str(e))
+
+    tables, values = build()
+    try:
+        os.makedirs(TABLES_DIR, exist_ok=True)
+        _write(path, tables, values)
+        return _map(path)
+    except OSError as e:
+        logging.warning("Keeping the %s tables in memory, %s could not be written: %s", name, path, str(e))
+        return {table_name: memoryview(table) for table_name, table in tables.items()}, values
@@ -0,0 +1,352 @@
+"""
+Sheet music rendering: a bounded pool of MuseScore batch workers with an SVG fallback.
+
+score.write("musicxml.png") starts a fresh MuseScore process for every score,
+and MuseScore's start-up dominates the render. MuseScore has no resident server
+mode, so the pool gets the same effect from its batch mode instead: a fixed
+number of worker threads each collect whatever scores are waiting (up to
+`batch_size`) and convert them with a single `mscore -j job.json` run, paying
+start-up once per batch rather than once per score.
+
+Concurrency is bounded in three places: at most `workers` MuseScore processes
+run at once, at most `max_pending` scores wait for one, and every MuseScore run
+is killed after `timeout` seconds. A caller waits at most `timeout` seconds too,
+so a slow or hung render cannot hold a web worker for longer than that.
+
+When MuseScore is not installed (a headless Linux box), the queue is full, or a
+render fails or times out, render() and store() fall back to engraving the
+score as SVG in pure Python. The SVG covers what the generators produce: one
+staff per part, clefs, time signatures, accidentals, ledger lines, whole, half,
+quarter and eighth notes, and systems wrapped to the page width.
+"""
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from keys import get_key
+from pitch_math import PITCH_CLASS_NAMES
+
+
+class RenderError(Exception):
+    pass
+
+
+class SheetRenderer:
+    def __init__(self, musescore_path, musicxml, workers=2, batch_size=8, batch_wait=0.05, timeout=30,
+                 max_pending=64, dpi=None):
+        self.musescore_path = musescore_path
+        self.musicxml = musicxml  # spec -> MusicXML bytes
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait  # Seconds a worker waits for more scores to fill a batch
+        self.timeout = timeout
+        self.dpi = dpi
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._workers_pid = None
+        self._lock = threading.Lock()
+        self._warned = False
+
+    @property
+    def available(self):
+        """Whether MuseScore can be run at all; if not, every score is rendered as SVG."""
+        available = os.path.isfile(self.musescore_path) and os.access(self.musescore_path, os.X_OK)
+        if not available and not self._warned:
+            self._warned = True
+            logging.warning("MuseScore not found at %s; sheet music is rendered as SVG", self.musescore_path)
+        return available
+
+    def render_png(self, spec, timeout=None):
+        """Render a score spec to PNG bytes through the MuseScore pool, or raise RenderError."""
+        future = Future()
+        self._start_workers()
+        try:
+            self._queue.put_nowait((spec, future))
+        except queue.Full:
+            raise RenderError("too many sheet music renders pending") from None
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            future.cancel()  # Dropped if still queued; a running batch is bounded by its own timeout
+            raise RenderError("timed out rendering sheet music") from None
+
+    def render(self, spec):
+        """Return (bytes, extension) for a score spec: a PNG from MuseScore, or SVG if that is not possible."""
+        if self.available:
+            try:
+                return self.render_png(spec), "png"
+            except RenderError as e:
+                logging.warning("Falling back to SVG sheet music: %s", str(e))
+        return score_svg(spec).encode(), "svg"
+
+    def store(self, spec, store, key):
+        """Render a score spec into an ArtifactStore under `key` and return the artifact name."""
+        if self.available:
+            try:
+                return store.put_rendered(key, "png", lambda path: _write_file(path, self.render_png(spec)))
+            except RenderError as e:
+                logging.warning("Falling back to SVG sheet music: %s", str(e))
+        return store.put_rendered(key, "svg", lambda path: _write_file(path, score_svg(spec).encode()))
+
+    def _start_workers(self):
+        # Threads do not survive a fork, so every gunicorn worker starts its own pool on first use
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            self._workers_pid = os.getpid()
+            if self._queue.qsize():
+                # Scores queued by the parent before the fork have no one waiting on them here
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"sheet-render-{index}", daemon=True).start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Callers that already gave up have cancelled their futures
+        return [(spec, future) for spec, future in batch if future.set_running_or_notify_cancel()]
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logging.error("Error rendering sheet music batch: %s", str(e))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RenderError(str(e)))
+
+    def _run_batch(self, batch):
+        with tempfile.TemporaryDirectory() as folder:
+            jobs = []
+            for index, (spec, future) in enumerate(batch):
+                source = os.path.join(folder, f"{index}.musicxml")
+                try:
+                    _write_file(source, self.musicxml(spec))
+                except Exception as e:
+                    future.set_exception(RenderError(f"could not export MusicXML: {e}"))
+                    continue
+                jobs.append((os.path.join(folder, f"{index}.png"), future, source))
+            if not jobs:
+                return
+
+            job_path = os.path.join(folder, "job.json")
+            _write_file(job_path, json.dumps([{"in": source, "out": out} for out, _, source in jobs]).encode())
+
+            command = [self.musescore_path, "-T", "0"]
+            if self.dpi:
+                command += ["-r", str(self.dpi)]
+            command += ["-j", job_path]
+            env = dict(os.environ)
+            if sys.platform.startswith("linux"):
+                env.setdefault("QT_QPA_PLATFORM", "offscreen")  # No display on a server
+            try:
+                subprocess.run(command, env=env, cwd=folder, capture_output=True, timeout=self.timeout, check=True)
+                error = None
+            except subprocess.TimeoutExpired:
+                error = f"MuseScore took longer than {self.timeout}s"
+            except (OSError, subprocess.CalledProcessError) as e:
+                error = f"MuseScore failed: {e}"
+
+            for out, future, _ in jobs:
+                # MuseScore numbers PNG pages: score.png becomes score-1.png
+                path = next((p for p in (out[:-4] + "-1.png", out) if os.path.exists(p)), None)
+                if path is None:
+                    future.set_exception(RenderError(error or "MuseScore wrote no PNG"))
+                    continue
+                with open(path, "rb") as f:
+                    future.set_result(f.read())
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+# SVG engraving, in staff spaces of SPACE pixels
+SPACE = 10
+PAGE_WIDTH = 1000
+MARGIN = 20
+STAFF_GAP = 8 * SPACE        # Between the staves of one system
+SYSTEM_GAP = 10 * SPACE      # Between systems
+NOTE_SPACE = 3.5 * SPACE     # Width given to each note
+MEASURE_PADDING = 2 * SPACE
+
+_STEPS = "CDEFGAB"
+# Diatonic index (octave * 7 + letter) of each clef's bottom line, and its glyph
+_CLEFS = {
+    "G2": (4 * 7 + 2, "\U0001D11E"),  # E4
+    "F4": (2 * 7 + 4, "\U0001D122"),  # G2
+    "C3": (3 * 7 + 3, "\U0001D121"),  # F3
+    "C4": (3 * 7 + 1, "\U0001D121"),  # D3
+}
+_ACCIDENTALS = {"#": "♯", "-": "♭", "##": "\U0001D12A", "--": "\U0001D12B"}
+
+
+def _spell(midi, key=None):
+    # (diatonic index, accidental glyph); pitches take the key's spelling when there is one, e.g. Ab not G#
+    if key is None or midi < 12:
+        name = PITCH_CLASS_NAMES[midi % 12]
+        return (midi // 12 - 1) * 7 + _STEPS.index(name[0]), _ACCIDENTALS.get(name[1:])
+    name = key.note_name(midi)
+    octave = len(name.rstrip("0123456789"))
+    return int(name[octave:]) * 7 + _STEPS.index(name[0]), _ACCIDENTALS.get(name[1:octave])
+
+
+def _clef(part):
+    if part.get("clef") in _CLEFS:
+        return part["clef"]
+    # Like music21's bestClef for a part without one: treble unless the line sits below middle C
+    pitches = [pitch for pitch, _ in part["notes"]]
+    return "G2" if not pitches or sum(pitches) / len(pitches) >= 60 else "F4"
+
+
+def _measure_length(time_signature):
+    numerator, denominator = (int(v) for v in (time_signature or "4/4").split("/"))
+    return numerator * 4 / denominator
+
+
+def _measures(notes, length):
+    measures = [[]]
+    offset = 0.0
+    for pitch, quarter_length in notes:
+        if offset >= length - 1e-9:
+            measures.append([])
+            offset = 0.0
+        measures[-1].append((offset, pitch, quarter_length))
+        offset += quarter_length
+    return measures
+
+
+def _note(out, x, staff_top, bottom_line, pitch, quarter_length, key=None):
+    diatonic, accidental = _spell(pitch, key)
+    y = staff_top + (bottom_line + 8 - diatonic) * SPACE / 2
+
+    # Ledger lines every other step outside the staff
+    for step in range(bottom_line - 2, diatonic - 1, -2):
+        ly = staff_top + (bottom_line + 8 - step) * SPACE / 2
+        out.append(f'<line x1="{x - 9:g}" y1="{ly:g}" x2="{x + 9:g}" y2="{ly:g}" class="staff"/>')
+    for step in range(bottom_line + 10, diatonic + 1, 2):
+        ly = staff_top + (bottom_line + 8 - step) * SPACE / 2
+        out.append(f'<line x1="{x - 9:g}" y1="{ly:g}" x2="{x + 9:g}" y2="{ly:g}" class="staff"/>')
+
+    if accidental:
+        out.append(f'<text x="{x - 16:g}" y="{y + 5:g}" class="accidental">{accidental}</text>')
+
+    hollow = quarter_length >= 2
+    out.append(f'<ellipse cx="{x:g}" cy="{y:g}" rx="6" ry="4.5" transform="rotate(-20 {x:g} {y:g})" '
+               f'class="{"hollow" if hollow else "head"}"/>')
+    if quarter_length >= 4:
+        return  # Whole notes have no stem
+
+    up = diatonic < bottom_line + 4
+    stem_x = x + 5.5 if up else x - 5.5
+    stem_end = y - 3.5 * SPACE if up else y + 3.5 * SPACE
+    out.append(f'<line x1="{stem_x:g}" y1="{y:g}" x2="{stem_x:g}" y2="{stem_end:g}" class="stem"/>')
+    if quarter_length <= 0.5:
+        direction = 1 if up else -1
+        out.append(f'<path d="M{stem_x:g} {stem_end:g} q {SPACE:g} {direction * SPACE:g} {SPACE * 0.6:g} '
+                   f'{direction * 2.5 * SPACE:g}" class="flag"/>')
+
+
+def score_svg(spec):
+    """Engrave a score spec as a standalone SVG document."""
+    parts = spec["parts"]
+    key = get_key(spec["key"]) if spec.get("key") else None
+    time_signature = next((part["timeSignature"] for part in parts if part.get("timeSignature")), None)
+    length = _measure_length(time_signature)
+    clefs = [_clef(part) for part in parts]
+    measures = [_measures(part["notes"], length) for part in parts]
+    measure_count = max(len(part_measures) for part_measures in measures)
+
+    # Measures are as wide as their busiest part needs, and wrap into systems across the page
+    widths = []
+    for index in range(measure_count):
+        notes = max(len(part_measures[index]) if index < len(part_measures) else 0 for part_measures in measures)
+        widths.append(MEASURE_PADDING * 2 + max(notes, 1) * NOTE_SPACE)
+
+    systems = []
+    prefix = 7 * SPACE if time_signature else 5 * SPACE
+    x = MARGIN + prefix
+    current = []
+    for index, width in enumerate(widths):
+        if current and x + width > PAGE_WIDTH - MARGIN:
+            systems.append(current)
+            current = []
+            x = MARGIN + 5 * SPACE
+        current.append(index)
+        x += width
+    systems.append(current)
+
+    system_height = len(parts) * 4 * SPACE + (len(parts) - 1) * STAFF_GAP
+    height = 2 * MARGIN + 2 * SPACE + len(systems) * system_height + (len(systems) - 1) * SYSTEM_GAP
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{PAGE_WIDTH}" height="{height:g}" '
+        f'viewBox="0 0 {PAGE_WIDTH} {height:g}">',
+        "<style>"
+        ".staff{stroke:#000;stroke-width:1}.bar{stroke:#000;stroke-width:1.2}"
+        ".stem{stroke:#000;stroke-width:1.2}.flag{fill:none;stroke:#000;stroke-width:1.5}"
+        ".head{fill:#000}.hollow{fill:#fff;stroke:#000;stroke-width:1.5}"
+        "text{font-family:'Bravura','Noto Music','DejaVu Sans',serif;fill:#000}"
+        ".clef{font-size:40px}.time{font-size:20px;font-weight:bold}.accidental{font-size:16px}"
+        "</style>",
+        f'<rect width="{PAGE_WIDTH}" height="{height:g}" fill="#fff"/>',
+    ]
+
+    top = MARGIN + SPACE
+    for number, system in enumerate(systems):
+        start = MARGIN + (prefix if number == 0 else 5 * SPACE)
+        end = start + sum(widths[index] for index in system)
+        staff_tops = [top + i * (4 * SPACE + STAFF_GAP) for i in range(len(parts))]
+
+        for part_index, staff_top in enumerate(staff_tops):
+            bottom_line, glyph = _CLEFS[clefs[part_index]]
+            for line in range(5):
+                y = staff_top + line * SPACE
+                out.append(f'<line x1="{MARGIN}" y1="{y:g}" x2="{end:g}" y2="{y:g}" class="staff"/>')
+            clef_y = staff_top + (3 if clefs[part_index] == "G2" else 1 if clefs[part_index] == "F4" else 2) * SPACE
+            out.append(f'<text x="{MARGIN + 2}" y="{clef_y:g}" class="clef" dominant-baseline="central">{glyph}</text>')
+            if number == 0 and time_signature:
+                upper, lower = time_signature.split("/")
+                tx = MARGIN + 5 * SPACE
+                out.append(f'<text x="{tx:g}" y="{staff_top + 2 * SPACE - 2:g}" class="time">{upper}</text>')
+                out.append(f'<text x="{tx:g}" y="{staff_top + 4 * SPACE - 2:g}" class="time">{lower}</text>')
+
+            # Notes sit at their offset within the measure, so the parts line up vertically
+            x = start
+            part_measures = measures[part_index]
+            for index in system:
+                usable = widths[index] - 2 * MEASURE_PADDING - NOTE_SPACE
+                for offset, pitch, quarter_length in (part_measures[index] if index < len(part_measures) else ()):
+                    note_x = x + MEASURE_PADDING + NOTE_SPACE / 2 + offset / length * usable
+                    _note(out, note_x, staff_top, bottom_line, pitch, quarter_length, key)
+                x += widths[index]
+
+        # Bar lines run through every staff of the system
+        x = start
+        for index in system:
+            x += widths[index]
+            out.append(f'<line x1="{x:g}" y1="{staff_tops[0]:g}" x2="{x:g}" y2="{staff_tops[-1] + 4 * SPACE:g}" class="bar"/>')
+        out.append(f'<line x1="{MARGIN}" y1="{staff_tops[0]:g}" x2="{MARGIN}" y2="{staff_tops[-1] + 4 * SPACE:g}" class="bar"/>')
+
+        top += system_height + SYSTEM_GAP
+
+    out.append("</svg>")
+    return "\n".join(out)
@@ -0,0 +1,141 @@
+"""
+Cache of generated songs keyed on the sampled pixel grid.
+
+generate_song is deterministic given the greyscale grid and the generator
+version, so the same photo (or any photo that samples to the same grid) can be
+answered without running the counterpoint loops again. Entries live in an
+in-process LRU bounded both by entry count and by the total notes held, since
+one long song can be megabytes; an optional SQLite file adds a second tier
+that every gunicorn worker on the box shares. The file is trimmed to its
+newest db_max_rows songs every PRUNE_INTERVAL writes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Writes by one process between trims of the shared tier
+PRUNE_INTERVAL = 100
+
+
+def cache_key(pixel_values, version):
+    """Hash the pixel grid together with the generator version/parameters."""
+    digest = hashlib.sha256(version.encode())
+    digest.update(b"\0")
+    digest.update(bytes(pixel_values))
+    return digest.hexdigest()
+
+
+def _note_count(note_data):
+    return len(note_data["topLine"]) + len(note_data["bottomLine"])
+
+
+class SongCache:
+    def __init__(self, max_entries=1024, db_path=None, max_notes=200000, db_max_rows=100000):
+        self.max_entries = max_entries
+        self.max_notes = max_notes  # Songs longer than this are never kept in memory
+        self.db_path = db_path
+        self.db_max_rows = db_max_rows
+        self._writes = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._notes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _connection(self):
+        # Connections must not cross a fork, so each worker opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS songs (key TEXT PRIMARY KEY, note_data TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS songs_created ON songs (created)")
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, note_data):
+        notes = _note_count(note_data)
+        if notes > self.max_notes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._notes -= _note_count(previous)
+        self._entries[key] = note_data
+        self._notes += notes
+        while len(self._entries) > self.max_entries or self._notes > self.max_notes:
+            _, evicted = self._entries.popitem(last=False)
+            self._notes -= _note_count(evicted)
+
+    def get(self, key):
+        """Return the cached note data for `key`, or None on a miss."""
+        with self._lock:
+            note_data = self._entries.get(key)
+            if note_data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return note_data
+
+            if self.db_path:
+                row = self._connection().execute("SELECT note_data FROM songs WHERE key = ?", (key,)).fetchone()
+                if row:
+                    note_data = json.loads(row[0])
+                    self._remember(key, note_data)
+                    self.shared_hits += 1
+                    return note_data
+
+            self.misses += 1
+            return None
+
+    def put(self, key, note_data):
+        with self._lock:
+            if self.max_entries > 0:
+                self._remember(key, note_data)
+            if self.db_path:
+                with self._connection() as db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO songs (key, note_data, created) VALUES (?, ?, ?)",
+                        (key, json.dumps(note_data), time.time()),
+                    )
+                    self._writes += 1
+                    if self._writes % PRUNE_INTERVAL == 0:
+                        # Keep the newest rows; every worker trims, so the file stays near db_max_rows
+                        db.execute(
+                            "DELETE FROM songs WHERE created <= "
+                            "(SELECT created FROM songs ORDER BY created DESC LIMIT 1 OFFSET ?)",
+                            (self.db_max_rows,),
+                        )
+
+    def counts(self):
+        """Return (hits, shared hits, misses) so far."""
+        with self._lock:
+            return self.hits, self.shared_hits, self.misses
+
+    def add_counts(self, hits=0, shared_hits=0, misses=0):
+        """Count lookups made by another process's copy of the cache (batch pool workers)."""
+        with self._lock:
+            self.hits += hits
+            self.shared_hits += shared_hits
+            self.misses += misses
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "hits": self.hits,
+                "sharedHits": self.shared_hits,
+                "misses": self.misses,
+                "hitRate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "notes": self._notes,
+                "maxNotes": self.max_notes,
+                "shared": bool(self.db_path),
+            }
@@ -0,0 +1,262 @@
+"""
+Precomputed bottom lines for every top line app.py can compose.
+
+The top line starts and ends on the tonic, and each note in between is one of
+the key's 7 candidates, picked by a sampled value modulo 7. For one ruleset,
+key and length that leaves 7 ** (length - 2) possible top lines (5,764,801
+for 10 notes), and the greedy bottom line is a function of the top line. So
+build_index enumerates every top line offline and stores its bottom line as
+`length` bytes of MIDI pitches. Rows are in order of the top line's
+candidate indices read as a base-7 number, so a lookup is arithmetic plus one
+slice.
+
+The enumeration walks the top lines as a tree: notes chosen for a shared
+prefix are chosen once and their LineState is copied into each branch. That
+does roughly one candidate scan per row instead of one per note.
+
+File layout (all little-endian):
+
+    MAGIC                  8 bytes
+    metadata length        uint32
+    metadata               JSON: ruleset, key, length, fingerprint, generator version
+    rows                   7 ** (length - 2) rows of `length` uint8 pitches
+
+SongIndex maps the file read-only, so gunicorn workers share one copy
+through the page cache and opening it costs nothing. The fingerprint
+hashes the ruleset definition and the sources of rules.py, keys.py and
+pitch_math.py. If the fingerprint or the generator version no longer matches,
+the index is not used and songs are generated live.
+
+    python song_index.py build [--output song_index.bin] [--ruleset app] [--key "C major"] [--length 10]
+    python song_index.py verify [--index song_index.bin] [--sample N]
+
+verify recomposes every row (or a random --sample of them) with app.py's
+compose_song and the index switched off, and compares the bottom lines.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+
+import rules
+from keys import DEFAULT_KEY, get_key
+from rules import RULESETS, compile_ruleset
+
+MAGIC = b"SONGIDX1"
+_HEADER = struct.Struct("<8sI")
+
+# Sources whose edits can change a bottom line
+_FINGERPRINTED_MODULES = ("rules.py", "keys.py", "pitch_math.py")
+
+
+def ruleset_fingerprint(ruleset):
+    """Hash the ruleset definition together with the code that applies it."""
+    digest = hashlib.sha256(json.dumps(RULESETS[ruleset], sort_keys=True).encode())
+    folder = os.path.dirname(os.path.abspath(rules.__file__))
+    for name in _FINGERPRINTED_MODULES:
+        with open(os.path.join(folder, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_rows(ruleset, key, length, progress=None):
+    """Return the bottom lines of every top line, `length` bytes per row, in row order."""
+    compiled = compile_ruleset(ruleset, key)
+    candidates = key.top_candidates
+    tonic = key.tonic_pitch
+    rows = bytearray(len(candidates) ** (length - 2) * length)
+
+    # Rules read the top line up to the current position (and its fixed last note), so one list is
+    # rewritten in place as the walk moves between branches
+    top_line = [tonic] * length
+
+    def choose(state, position):
+        pitch = compiled.choose(state, position)
+        if pitch is None:
+            pitch = tonic  # The same fallback as iter_bottom_line
+        state.add(pitch)
+        return pitch
+
+    def extend(state, position, row, line):
+        if position == length - 1:
+            line.append(choose(state, position))
+            rows[row * length:(row + 1) * length] = bytes(line)
+            return
+        for digit, pitch in enumerate(candidates):
+            top_line[position] = pitch
+            child = state.copy()
+            extend(child, position + 1, row * len(candidates) + digit, line + [choose(child, position)])
+            if progress and position == 1:
+                progress(digit + 1, len(candidates))
+
+    root = compiled.new_line(top_line)
+    extend(root, 1, 0, [choose(root, 0)])
+    return rows
+
+
+def build_index(path, ruleset="app", key=DEFAULT_KEY, length=10, generator_version=None, progress=None):
+    """Enumerate every top line for (ruleset, key, length) and write the index to `path`."""
+    rows = build_rows(ruleset, key, length, progress)
+    metadata = json.dumps({
+        "ruleset": ruleset,
+        "key": key.name,
+        "length": length,
+        "candidates": len(key.top_candidates),
+        "fingerprint": ruleset_fingerprint(ruleset),
+        "generatorVersion": generator_version,
+    }, sort_keys=True).encode()
+
+    # Written beside the target and renamed, so workers never map a half-written file
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(metadata)))
+        f.write(metadata)
+        f.write(rows)
+    os.replace(partial, path)
+    return len(rows) // length
+
+
+class SongIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, metadata_length = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a song index")
+        self.metadata = json.loads(self._map[_HEADER.size:_HEADER.size + metadata_length])
+        self.ruleset = self.metadata["ruleset"]
+        self.key = get_key(self.metadata["key"])
+        self.length = self.metadata["length"]
+        self._offset = _HEADER.size + metadata_length
+        self._rows = memoryview(self._map)[self._offset:]
+        self._digits = {pitch: digit for digit, pitch in enumerate(self.key.top_candidates)}
+        self._base = len(self.key.top_candidates)
+        if len(self._rows) != self._base ** (self.length - 2) * self.length:
+            raise ValueError(f"{path} is truncated")
+
+    @classmethod
+    def load(cls, path, generator_version=None):
+        """Open the index at `path`, or return None if there is none or it no longer matches the code."""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            index = cls(path)
+            fingerprint = ruleset_fingerprint(index.ruleset)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Ignoring song index %s: %s", path, str(e))
+            return None
+        if index.metadata["generatorVersion"] != generator_version:
+            logging.warning("Ignoring song index %s: built for generator %s", path, index.metadata["generatorVersion"])
+            return None
+        if index.metadata["fingerprint"] != fingerprint:
+            logging.warning("Ignoring song index %s: the %s ruleset has changed since it was built", path, index.ruleset)
+            return None
+        return index
+
+    def covers(self, ruleset, beam_width, length, key):
+        """Return True if songs for these generation options can be looked up."""
+        return ruleset == self.ruleset and not beam_width and length == self.length and key is self.key
+
+    def row(self, top_line):
+        """Return the row number of a top line, or None if it is not one the index enumerates."""
+        if len(top_line) != self.length:
+            return None
+        row = 0
+        for pitch in top_line[1:-1]:
+            digit = self._digits.get(pitch)
+            if digit is None:
+                return None
+            row = row * self._base + digit
+        return row
+
+    def bottom_line(self, top_line, ruleset, beam_width, key):
+        """Return the stored bottom line for `top_line`, or None if the index does not cover the request."""
+        if not self.covers(ruleset, beam_width, len(top_line), key):
+            return None
+        row = self.row(top_line)
+        if row is None:
+            return None
+        return list(self._rows[row * self.length:(row + 1) * self.length])
+
+    def __len__(self):
+        return len(self._rows) // self.length
+
+
+def verify_index(index, rows=None):
+    """Recompose `rows` (default: every row) live and return the rows whose bottom line differs."""
+    import app
+
+    saved, app.song_index = app.song_index, None  # Compose live, not from the index being checked
+    try:
+        mismatches = []
+        for row in range(len(index)) if rows is None else rows:
+            digits = []
+            rest = row
+            for _ in range(index.length - 2):
+                rest, digit = divmod(rest, index._base)
+                digits.append(digit)
+            # compose_top_line pops from the end, so the last value is the second note
+            note_data = app.compose_song(digits, index.ruleset, 0, index.length, index.key)
+            expected = [note["pitch"] for note in note_data["bottomLine"]]
+            top = [note["pitch"] for note in note_data["topLine"]]
+            if index.row(top) != row or expected != index.bottom_line(top, index.ruleset, 0, index.key):
+                mismatches.append(row)
+        return mismatches
+    finally:
+        app.song_index = saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="enumerate every top line and write the index")
+    build.add_argument("--output", default=os.environ.get("SONG_INDEX", "song_index.bin"))
+    build.add_argument("--ruleset", default="app", choices=sorted(RULESETS))
+    build.add_argument("--key", default=DEFAULT_KEY.name)
+    build.add_argument("--length", type=int, default=10)
+    verify = commands.add_parser("verify", help="check index rows against live generation")
+    verify.add_argument("--index", default=os.environ.get("SONG_INDEX", "song_index.bin"))
+    verify.add_argument("--sample", type=int, help="check this many random rows instead of all of them")
+    verify.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from app import GENERATOR_VERSION
+
+    if args.command == "build":
+        key = get_key(args.key)
+        if key is None:
+            parser.error(f"Unknown key: {args.key}")
+        if args.length < 3:
+            parser.error("length must be at least 3")
+        start = time.perf_counter()
+
+        def progress(done, total):
+            print(f"\r{done}/{total} of the tree ({time.perf_counter() - start:.0f} s)", end="", file=sys.stderr)
+
+        count = build_index(args.output, args.ruleset, key, args.length, GENERATOR_VERSION, progress)
+        print(f"\n{count} songs for {args.ruleset}, {key.name}, length {args.length} "
+              f"in {time.perf_counter() - start:.1f} s -> {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB)")
+        return
+
+    index = SongIndex.load(args.index, GENERATOR_VERSION)
+    if index is None:
+        print(f"{args.index} is missing or out of date; rebuild it with `python song_index.py build`")
+        sys.exit(1)
+    rows = None if args.sample is None else random.Random(args.seed).sample(range(len(index)), min(args.sample, len(index)))
+    start = time.perf_counter()
+    mismatches = verify_index(index, rows)
+    checked = len(index) if rows is None else len(rows)
+    print(f"{checked} rows checked in {time.perf_counter() - start:.1f} s, {len(mismatches)} mismatches")
+    if mismatches:
+        print("first mismatching rows:", mismatches[:10])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
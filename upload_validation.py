@@ -0,0 +1,265 @@
+"""
+Reject uploads that are not usable photos from their first bytes, before the rest is read.
+
+Werkzeug writes each uploaded file into a stream from Request._get_file_stream
+as the multipart body arrives. SniffedUpload wraps that stream and, as the
+first chunks go through, reads the image header: format and dimensions only,
+nothing is decoded. Bytes that do not start like an accepted format, or an
+image with more pixels than the decompression-bomb limit, raise
+UploadRejected (a 4xx) right there, so parsing stops and the rest of the body
+is never buffered or decoded. A part that ends before its header was
+recognised is caught by check_upload once parsing is done.
+
+Some valid photos keep their dimensions further in than HEADER_LIMIT: a
+compressed TIFF whose IFD follows the image data, or a JPEG whose ICC and EXIF
+segments push the SOF marker past it. When the magic bytes are those of an
+accepted format, such a file is let through and checked again, whole, by
+check_upload.
+
+Batch uploads keep going past a bad photo: their streams record the rejection,
+drop the remaining bytes and the batch reports it as that photo's error.
+
+MultipartSniffer does the same for a raw multipart body, chunk by chunk, for
+servers (asgi.py) that receive the body before the Flask app parses it.
+
+Every rejection is counted by reason in upload_rejections_total on /metrics.
+"""
+import io
+
+from PIL import Image
+from werkzeug.exceptions import HTTPException
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+import metrics
+
+# Formats the generators are tested with; anything else PIL can open is refused
+ACCEPTED_FORMATS = ("JPEG", "MPO", "PNG", "WEBP", "GIF", "BMP", "TIFF")
+
+# Default pixel limit, the same as PIL's own decompression-bomb warning threshold
+MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS
+
+# Dimensions are looked for in this many bytes; past it, a file with accepted magic bytes is checked whole
+HEADER_LIMIT = 256 * 1024
+
+# Leading bytes of each accepted format (WebP is RIFF....WEBP, MPO starts like a JPEG)
+_MAGIC = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+)
+_MAGIC_LENGTH = 12
+
+REJECTED_UPLOADS = metrics.Counter("upload_rejections_total", "Uploads refused before decoding", ["reason"])
+
+
+class UploadRejected(HTTPException):
+    def __init__(self, code, reason, description):
+        super().__init__(description)
+        self.code = code
+        self.reason = reason
+
+
+def reject(code, reason, description):
+    REJECTED_UPLOADS.inc(reason)
+    return UploadRejected(code, reason, description)
+
+
+def _webp_header(header):
+    # (width, height) from a WebP's first chunk, which Image.open cannot read from a partial file
+    if len(header) < 30:
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8X":
+        return 1 + int.from_bytes(header[24:27], "little"), 1 + int.from_bytes(header[27:30], "little")
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        return (int.from_bytes(header[26:28], "little") & 0x3FFF,
+                int.from_bytes(header[28:30], "little") & 0x3FFF)
+    if chunk == b"VP8L" and header[20] == 0x2F:
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    raise ValueError("Unknown WebP chunk")
+
+
+def _magic_format(header):
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    return next((image_format for magic, image_format in _MAGIC if header.startswith(magic)), None)
+
+
+def _read_size(fp, webp=False):
+    # (format, (width, height)) as far as the bytes in `fp` go, or (None, None) if they do not tell
+    try:
+        if webp:
+            return "WEBP", _webp_header(fp.read(30))
+        with Image.open(fp) as img:
+            return img.format, img.size
+    except Image.DecompressionBombError:
+        raise reject(413, "too_many_pixels", "Image has too many pixels")
+    except Exception:
+        return None, None  # Truncated or not an image; the caller knows which
+
+
+def _check_size(image_format, size, max_pixels):
+    if image_format not in ACCEPTED_FORMATS:
+        raise reject(415, "unsupported_format", f"Unsupported image format: {image_format}")
+    if size[0] * size[1] > max_pixels:
+        raise reject(413, "too_many_pixels", f"Image has too many pixels: {size[0]}x{size[1]}")
+    return image_format, size
+
+
+def sniff_image(header, final=False, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Return (format, (width, height)) from the first bytes of an image, or None if more bytes are needed.
+
+    Returns (format, None) when the magic bytes are those of an accepted format but the dimensions are
+    not within HEADER_LIMIT bytes; check_image_file then checks the whole file. Raises UploadRejected for
+    an unsupported format or too many pixels, and for an unreadable image once `final` (no more bytes
+    are coming).
+    """
+    magic_format = _magic_format(header)
+    if magic_format is None:
+        if len(header) < _MAGIC_LENGTH and not final:
+            return None
+        image_format, _ = _read_size(io.BytesIO(header))
+        if image_format is not None:
+            raise reject(415, "unsupported_format", f"Unsupported image format: {image_format}")
+        raise reject(415, "unrecognised", "Unsupported or unreadable image")
+
+    image_format, size = _read_size(io.BytesIO(header), webp=magic_format == "WEBP")
+    if size is None:
+        if final:
+            raise reject(415, "unrecognised", "Unsupported or unreadable image")
+        return (magic_format, None) if len(header) >= HEADER_LIMIT else None
+    return _check_size(image_format, size, max_pixels)
+
+
+def check_image_file(fp, max_pixels=MAX_IMAGE_PIXELS):
+    """Return (format, (width, height)) of a whole image file, raising UploadRejected as sniff_image does."""
+    position = fp.tell()
+    fp.seek(0)
+    try:
+        image_format, size = _read_size(fp)
+    finally:
+        fp.seek(position)
+    if size is None:
+        raise reject(415, "unrecognised", "Unsupported or unreadable image")
+    return _check_size(image_format, size, max_pixels)
+
+
+class SniffedUpload:
+    def __init__(self, stream, max_pixels=MAX_IMAGE_PIXELS, abort=True):
+        self.stream = stream
+        self.max_pixels = max_pixels
+        self.abort = abort  # Raise on a bad header; otherwise record it and drop the rest of the part
+        self.image = None  # (format, (width, height)) once the header has been read; (format, None) until finish
+        self.rejection = None
+        self._header = bytearray()
+
+    def write(self, data):
+        if self.rejection is not None:
+            return len(data)
+        if self.image is None:
+            self._header += data[:HEADER_LIMIT - len(self._header)]
+            self._sniff(final=False)
+            if self.rejection is not None:
+                return len(data)
+        return self.stream.write(data)
+
+    def finish(self):
+        """Check a part whose header was not recognised while it arrived; return the rejection, if any."""
+        if self.rejection is None:
+            if self.image is None:
+                self._sniff(final=True)
+            elif self.image[1] is None:
+                # Dimensions beyond HEADER_LIMIT: now that the whole part is here, read them from the file
+                try:
+                    self.image = check_image_file(self.stream, self.max_pixels)
+                except UploadRejected as e:
+                    self.rejection = e
+                    self.stream.truncate(0)
+        return self.rejection
+
+    def _sniff(self, final):
+        try:
+            self.image = sniff_image(bytes(self._header), final, self.max_pixels)
+        except UploadRejected as e:
+            self.rejection = e
+            self.stream.truncate(0)
+            if self.abort:
+                raise
+        if self.image is not None:
+            self._header = None
+
+    def __getattr__(self, name):
+        # read, seek, tell, ... go to the real stream
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+
+class _Discard:
+    # A stream for SniffedUpload that keeps nothing
+    def write(self, data):
+        return len(data)
+
+    def truncate(self, size=None):
+        return 0
+
+
+class MultipartSniffer:
+    def __init__(self, boundary, max_pixels=MAX_IMAGE_PIXELS):
+        self.max_pixels = max_pixels
+        self._decoder = MultipartDecoder(boundary.encode("latin-1"))
+        self._upload = None  # SniffedUpload of the file part being received, until its header is read
+        self._done = False
+
+    def feed(self, data):
+        """
+        Sniff the next chunk of the body (b"" at its end), raising UploadRejected for a file part that
+        check_upload would refuse. Zip archives and malformed bodies are left to the Flask app.
+        """
+        if self._done:
+            return
+        try:
+            self._decoder.receive_data(data or None)
+            event = self._decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    is_zip = event.filename.lower().endswith(".zip")
+                    self._upload = None if is_zip else SniffedUpload(_Discard(), self.max_pixels)
+                elif isinstance(event, Field):
+                    self._upload = None
+                elif isinstance(event, Data) and self._upload is not None:
+                    self._upload.write(event.data)
+                    if not event.more_data and self._upload.image is None:
+                        rejection = self._upload.finish()
+                        if rejection is not None:
+                            raise rejection
+                    if self._upload.image is not None:
+                        self._upload = None  # Recognised; the app checks the rest once it has the whole file
+                event = self._decoder.next_event()
+            self._done = isinstance(event, Epilogue)
+        except ValueError:
+            self._done = True  # Not multipart as Werkzeug reads it; the app answers that
+
+
+def check_upload(photo):
+    """Raise UploadRejected if an uploaded FileStorage was not recognised as a usable image."""
+    if isinstance(photo.stream, SniffedUpload):
+        rejection = photo.stream.finish()
+        if rejection is not None:
+            raise rejection
+
+
+def upload_rejection(photo):
+    """Return the reason a batch photo was refused, or None if it looks usable."""
+    if isinstance(photo.stream, SniffedUpload):
+        rejection = photo.stream.finish()
+        if rejection is not None:
+            return rejection.description
+    return None